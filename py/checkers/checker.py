@@ -7,6 +7,7 @@ import heapq
 import itertools
 import json
 import logging
+import multiprocessing
 import optparse
 import os
 import cPickle as pickle
@@ -54,6 +55,84 @@ def parse_database_url(url, password_map):
   return params
 
 
+def load_password_map(password_map_file):
+  if not password_map_file:
+    return {}
+  with open(password_map_file, "r") as f:
+    return json.load(f)
+
+
+def get_table_data(table_name, params):
+  table = {'columns': [], 'pk': []}
+  conn = MySQLdb.connect(**params)
+  cursor = conn.cursor()
+  cursor.execute("SELECT avg_row_length FROM information_schema.tables WHERE table_schema = %s AND table_name = %s", (params['db'], table_name))
+  table['avg_row_length'] = cursor.fetchone()[0]
+
+  cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s ORDER BY table_name, ordinal_position", (params['db'], table_name))
+  for row in cursor.fetchall():
+    table['columns'].append(row[0])
+
+  cursor.execute("select column_name FROM information_schema.key_column_usage WHERE table_schema=%s AND constraint_name='PRIMARY' AND table_name = %s ORDER BY table_name, ordinal_position", (params['db'], table_name))
+  for row in cursor.fetchall():
+    table['pk'].append(row[0])
+  return table
+
+
+def get_schema_data(params, tables=None):
+  """Returns the table data (see get_table_data) of the base tables of
+  the database, or only of tables, with their data_length and
+  table_rows. Tables without a primary key are skipped.
+  """
+  schema = {}
+  conn = MySQLdb.connect(**params)
+  cursor = conn.cursor()
+  cursor.execute("SELECT table_name, avg_row_length, data_length, table_rows FROM information_schema.tables WHERE table_schema = %s AND table_type = 'BASE TABLE'", (params['db'],))
+  for table_name, avg_row_length, data_length, table_rows in cursor.fetchall():
+    if tables is None or table_name in tables:
+      schema[table_name] = {'columns': [], 'pk': [],
+                            'avg_row_length': avg_row_length or 0,
+                            'data_length': data_length or 0,
+                            'table_rows': table_rows or 0}
+
+  cursor.execute("SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = %s ORDER BY table_name, ordinal_position", (params['db'],))
+  for table_name, column_name in cursor.fetchall():
+    if table_name in schema:
+      schema[table_name]['columns'].append(column_name)
+
+  cursor.execute("select table_name, column_name FROM information_schema.key_column_usage WHERE table_schema=%s AND constraint_name='PRIMARY' ORDER BY table_name, ordinal_position", (params['db'],))
+  for table_name, column_name in cursor.fetchall():
+    if table_name in schema:
+      schema[table_name]['pk'].append(column_name)
+
+  for table_name in tables or []:
+    if table_name not in schema:
+      logging.warning("Skipping %s: no such table.", table_name)
+  for table_name, table in schema.items():
+    if not table['pk']:
+      logging.warning("Skipping %s: no primary key.", table_name)
+      del schema[table_name]
+  return schema
+
+
+def host_key(params):
+  """Identifies the MySQL server of connection params."""
+  return params.get('unix_socket') or '{0!s}:{1!s}'.format(params.get('host'), params.get('port', 3306))
+
+
+def format_duration(seconds):
+  return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def split_range(start, end, count):
+  """Returns the boundaries that split [start, end) in count ranges of
+  about the same size. There are fewer boundaries if the range is too
+  small.
+  """
+  boundaries = set(start + (end - start) * i // count for i in xrange(1, count))
+  return sorted(b for b in boundaries if start < b < end)
+
+
 class AtomicWriter(object):
   """AtomicWriter is a file-like object that allows you to do an
   atomic write (on close), using os.rename.
@@ -98,6 +177,55 @@ def sql_tuple_comparison(tablename, columns, column_name_prefix=''):
                 'column_name_prefix': column_name_prefix})
 
 
+def chunk_sql(tablename, use_index, filter_sql, primary_key, select, bounded, order=True):
+  """Returns SQL selecting from the rows with a primary key in
+  (%(pk)s, %(max_pk)s], or after %(pk)s if the chunk is not bounded.
+  """
+  range_sql = sql_tuple_comparison(tablename, primary_key)
+  if bounded:
+    range_sql = '({0!s}) and not ({1!s})'.format(
+        range_sql, sql_tuple_comparison(tablename, primary_key, column_name_prefix='max_'))
+  sql = """
+           select
+             {select!s}
+           from {tablename!s} {use_index!s}
+           where {filter_sql!s}
+             ({range_sql!s})""".format(**{
+               'select': select,
+               'tablename': tablename,
+               'use_index': use_index,
+               'filter_sql': filter_sql,
+               'range_sql': range_sql})
+  if order:
+    sql += " order by {0!s}".format(', '.join(primary_key))
+  return sql
+
+
+def checksum_sql(columns):
+  """Returns the count and the checksum of the rows. The checksums of
+  disjoint sets of rows can be combined by xor. NULL columns are
+  flagged, since CONCAT_WS skips them.
+
+  The row hash is the xor of the two 64-bit halves of an MD5. It must
+  not be linear like CRC32: the xor of linear hashes cancels out
+  differences, e.g. values swapped between two rows.
+  """
+  row_sql = "concat_ws('#', {0!s}, concat({1!s}))".format(
+      ', '.join(columns), ', '.join('isnull({0!s})'.format(c) for c in columns))
+  half_sql = "cast(conv(substr(md5({0!s}), {1:d}, 16), 16, 10) as unsigned)"
+  return "count(*), coalesce(bit_xor({0!s} ^ {1!s}), 0)".format(
+      half_sql.format(row_sql, 1), half_sql.format(row_sql, 17))
+
+
+def rows_size(rows, sample=16):
+  """Estimates the size in bytes of rows from the first few of them."""
+  if not rows:
+    return 0
+  sample_rows = rows[:sample]
+  size = sum(len(v) if isinstance(v, basestring) else 8 for row in sample_rows for v in row)
+  return size * len(rows) // len(sample_rows)
+
+
 def sorted_row_list_difference(expected, actual, key_length):
   """Finds elements in only one or the other of two, sorted input lists.
 
@@ -112,34 +240,60 @@ def sorted_row_list_difference(expected, actual, key_length):
   unexpected = []
   different = []
 
+  # Rows are tuples, never None.
   expected, actual = iter(expected), iter(actual)
-  enext = expected.next
-  anext = actual.next
-  try:
-    e, a = enext(), anext()
-    while True:
-      if a == e:
-        e, a = enext(), anext()
-        continue
-
-      ekey, akey = e[:key_length], a[:key_length]
-
-      if ekey < akey:
-        missing.append(e)
-        e = enext()
-      elif ekey > akey:
-        unexpected.append(a)
-        a = anext()
-      else:
-        different.append((a, e))
-        e, a = enext(), anext()
-  except StopIteration:
+  e, a = next(expected, None), next(actual, None)
+  while e is not None and a is not None:
+    if a == e:
+      e, a = next(expected, None), next(actual, None)
+      continue
+
+    ekey, akey = e[:key_length], a[:key_length]
+
+    if ekey < akey:
+      missing.append(e)
+      e = next(expected, None)
+    elif ekey > akey:
+      unexpected.append(a)
+      a = next(actual, None)
+    else:
+      different.append((a, e))
+      e, a = next(expected, None), next(actual, None)
+  # The row read last from a list is kept when the other one ends.
+  if e is not None:
+    missing.append(e)
     missing.extend(expected)
+  if a is not None:
+    unexpected.append(a)
     unexpected.extend(actual)
 
   return missing, unexpected, different
 
 
+def create_comparer_pool(processes):
+  """Returns a pool of processes for compare_serialized_batch, or None
+  if processes is 0. Create it before starting any thread: forking a
+  process with threads holding locks can deadlock the children.
+  """
+  if not processes:
+    return None
+  return multiprocessing.Pool(processes)
+
+
+def compare_serialized_batch(payload, key_length):
+  """Compares a batch serialized by the merger, in a comparer process.
+
+  payload is the pickled (destination_data, sources_data) of the
+  batch. Returns the pickled result of sorted_row_list_difference, or
+  None if the rows are the same.
+  """
+  destination_data, sources_data = pickle.loads(payload)
+  result = sorted_row_list_difference(heapq.merge(*sources_data), destination_data, key_length)
+  if not any(result):
+    return None
+  return pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+
+
 class Datastore(object):
   """Datastore is database which expects that all queries sent to it
   will use the same primary key.
@@ -149,6 +303,7 @@ class Datastore(object):
     self.connection_params = dict((str(key), value) for key, value in connection_params.items())
     self.dbname = connection_params['db']
     self._cursor = None
+    self.last_query_time = 0.0
 
   @property
   def cursor(self):
@@ -162,7 +317,9 @@ class Datastore(object):
     start = time.time()
     self.cursor.execute(sql, params)
     if self.stats:
-      self.stats.update(self.dbname, start)
+      self.last_query_time = self.stats.update(self.dbname, start)
+    else:
+      self.last_query_time = time.time() - start
     return self.cursor.fetchall()
 
 
@@ -247,6 +404,10 @@ class Mismatch(Exception):
 
 
 class Stats(object):
+  """Stats gathers the time spent in each stage of the checkers that
+  share it. The speed is reported in items per second of wall clock
+  time, so that it is the combined speed of all the checkers.
+  """
 
   def __init__(self, interval=0, name=""):
     self.lock = threading.Lock()
@@ -257,6 +418,7 @@ class Stats(object):
   def clear(self):
     self.times = collections.defaultdict(float)
     self.items = 0
+    self.start_time = None
     self.clear_local()
 
   def clear_local(self):
@@ -268,22 +430,28 @@ class Stats(object):
     with self.lock:
       logging.debug("update: key: %s, from_time: %s, items: %s", key, from_time, items)
       # Items are incremented only by 'total'
+      if self.start_time is None:
+        self.start_time = from_time
       t = time.time() - from_time
       self.local_times[key] += t
       self.times[key] += t
       self.items += items
       self.local_items += items
+      return t
 
   def maybe_print_local(self, force=False):
     if self.interval == 0:
       return
-    if force or (time.time() - self.last_flush) >= self.interval:
+    with self.lock:
+      elapsed = time.time() - self.last_flush
+      if not (force or elapsed >= self.interval):
+        return
       try:
         total = self.local_times.pop('total')
       except KeyError:
         pass
       else:
-        data = [self.name, "total speed: {0:0.2f} items/s".format((self.local_items / total))]
+        data = [self.name, "total speed: {0:0.2f} items/s".format((self.local_items / elapsed))]
         data.extend("\t{0!s}: {1:0.2f}%".format(k, (v * 100) / total) for k, v in self.local_times.items())
         logging.info('\t'.join(data))
       self.clear_local()
@@ -294,18 +462,106 @@ class Stats(object):
     except KeyError:
       logging.info('No stats: no work was necessary.')
     else:
-      data = [self.name, "(FINAL) total speed: {0:0.2f} items/s".format((self.items / total))]
+      elapsed = time.time() - self.start_time
+      data = [self.name, "(FINAL) total speed: {0:0.2f} items/s".format((self.items / elapsed))]
       data.extend("\t{0!s}: {1:0.2f}%".format(k, (v * 100) / total) for k, v in self.times.items())
       logging.info('\t'.join(data))
 
 
+class BatchSizer(object):
+  """BatchSizer adapts the batch size so that the queries take about
+  target_latency seconds and return about target_bytes bytes.
+
+  The latency and size per row are measured separately for each kind
+  of query (e.g. destination and sources), and the batch size is set
+  by the slowest of them. It can shrink at once, but it grows by at
+  most growth_factor at a time, and stays within [min_batch_size,
+  max_batch_size]. last_good_size is the last batch size whose queries
+  were within the targets.
+  """
+
+  def __init__(self, batch_size, target_latency=0, target_bytes=0,
+               min_batch_size=10, max_batch_size=100000, growth_factor=2.0):
+    self.lock = threading.Lock()
+    self.target_latency = target_latency
+    self.target_bytes = target_bytes
+    self.min_batch_size = min_batch_size
+    self.max_batch_size = max_batch_size
+    self.growth_factor = growth_factor
+    # key -> (seconds per row, bytes per row)
+    self.rates = {}
+    self.reset(batch_size)
+
+  def clamp(self, batch_size):
+    return int(max(self.min_batch_size, min(self.max_batch_size, batch_size)))
+
+  def reset(self, batch_size):
+    with self.lock:
+      self.batch_size = self.last_good_size = self.clamp(batch_size)
+      return self.batch_size
+
+  def update(self, key, rows, latency, size=0, limit=None):
+    """Records the latency and size of a query that returned rows rows,
+    and returns the new batch size. limit is the batch size the query
+    was run with, the current one by default. It is the one recorded
+    as last_good_size, since the batch size may have changed since the
+    query was sent.
+    """
+    with self.lock:
+      # Small results are dominated by the per query overhead.
+      if rows < self.min_batch_size:
+        return self.batch_size
+      self.rates[key] = (float(latency) / rows, float(size) / rows)
+      if ((not self.target_latency or latency <= self.target_latency) and
+          (not self.target_bytes or size <= self.target_bytes)):
+        self.last_good_size = self.clamp(self.batch_size if limit is None else limit)
+
+      limits = [self.batch_size * self.growth_factor]
+      for latency_per_row, size_per_row in self.rates.values():
+        if self.target_latency and latency_per_row > 0:
+          limits.append(self.target_latency / latency_per_row)
+        if self.target_bytes and size_per_row > 0:
+          limits.append(self.target_bytes / size_per_row)
+      self.batch_size = self.clamp(min(limits))
+      return self.batch_size
+
+
 class Checker(object):
+  """Checker compares a table in the destination with the same table
+  in the sources, walking its primary key in batches.
+
+  A Checker created with a partition only checks the rows whose
+  partition column is in [partition['start'], partition['end']), see
+  ParallelChecker.
+
+  In checksum mode, the rows are not fetched: the destination and the
+  sources compute a checksum of each chunk of batch_size rows, and
+  only the chunks with different checksums are compared row by row.
+  These chunks are bisected until they have at most
+  checksum_leaf_size rows, so that only the rows around the
+  differences are fetched.
+
+  With a target_latency or target_bytes, the batch size is adapted
+  after each query, see BatchSizer, and the last good batch size is
+  saved in the checkpoint.
+
+  With comparer_processes, the batches are compared in a pool of
+  processes instead of the merger thread. Each batch is sent as a
+  single pickled string, and the results are handled in batch order.
+  The pool forks, so it must be created before any thread is started:
+  checkers running in threads must be given a comparer_pool created
+  beforehand, see create_comparer_pool. Otherwise the Checker creates
+  its own, before starting its datastore threads.
+  """
 
   def __init__(self, destination_url, sources_urls, table, directory='.',
                source_column_map=None, source_table_name=None, source_force_index_pk=True,
                destination_force_index_pk=True,
                keyrange=None, batch_count=0, blocks=1, ratio=1.0, block_size=16384,
-               logging_level=logging.INFO, stats_interval=1, temp_directory=None, password_map_file=None):
+               logging_level=logging.INFO, stats_interval=1, temp_directory=None, password_map_file=None,
+               partition=None, stats=None, table_data=None, checksum=False, checksum_leaf_size=64,
+               target_latency=0, target_bytes=0, min_batch_size=10, max_batch_size=100000,
+               comparer_processes=0, comparer_pool=None):
     if keyrange is None:
       keyrange = {}
     self.table_name = table
@@ -314,13 +570,12 @@ class Checker(object):
     else:
       self.source_table_name = source_table_name
 
-    if password_map_file:
-      with open(password_map_file, "r") as f:
-        password_map = json.load(f)
-    else:
-      password_map = {}
+    password_map = load_password_map(password_map_file)
 
-    self.table_data = self.get_table_data(table, parse_database_url(destination_url, password_map))
+    if table_data is None:
+      self.table_data = self.get_table_data(table, parse_database_url(destination_url, password_map))
+    else:
+      self.table_data = dict(table_data, columns=list(table_data['columns']), pk=list(table_data['pk']))
     self.primary_key = self.table_data['pk']
 
     if source_column_map:
@@ -340,13 +595,32 @@ class Checker(object):
      self.ratio, self.blocks) = batch_count, block_size, ratio, blocks
 
     self.calculate_batch_size()
+    if target_latency or target_bytes:
+      self.batch_sizer = BatchSizer(self.batch_size, target_latency, target_bytes,
+                                    min_batch_size, max_batch_size)
+      self.batch_size = self.batch_sizer.batch_size
+    else:
+      self.batch_sizer = None
+
+    self.checksum = checksum
+    self.checksum_leaf_size = checksum_leaf_size
+    self.comparer_processes = comparer_processes
+    self.owns_comparer_pool = comparer_pool is None and bool(comparer_processes)
+    if self.owns_comparer_pool:
+      comparer_pool = create_comparer_pool(comparer_processes)
+    self.comparer_pool = comparer_pool
 
     self.current_pk = dict((k, 0) for k in self.primary_key)
 
     self.iterations = 0
     self.temp_directory = temp_directory
-    self.checkpoint_file = os.path.join(directory, table + '.pickle')
-    self.mismatches_file = os.path.join(directory, table + '_mismatches.txt')
+    self.partition = partition
+    if partition is None:
+      file_prefix = table
+    else:
+      file_prefix = '{0!s}_{1:d}'.format(table, partition['index'])
+    self.checkpoint_file = os.path.join(directory, file_prefix + '.pickle')
+    self.mismatches_file = os.path.join(directory, file_prefix + '_mismatches.txt')
     self.done = False
     try:
       self.restore_checkpoint()
@@ -368,15 +642,27 @@ class Checker(object):
       if keyrange.get('end'):
         keyspace_sql_parts.append("keyspace_id < {0!s} and".format(keyrange.get('end')))
 
+    partition_sql_parts = []
+    if partition is not None:
+      column = partition['column']
+      source_column = self.source_column_map.get(column, column)
+      for bound, operator in (('start', '>='), ('end', '<')):
+        if partition.get(bound) is not None:
+          partition_sql_parts.append("{0!s}.{1!s} {2!s} {3!s} and".format(
+              self.table_name, column, operator, partition[bound]))
+          keyspace_sql_parts.append("{0!s}.{1!s} {2!s} {3!s} and".format(
+              self.source_table_name, source_column, operator, partition[bound]))
+
     self.destination_sql = """
            select
              {columns!s}
            from {table_name!s} {use_index!s}
-           where
-             {range_sql!s}
+           where {partition_sql!s}
+             ({range_sql!s})
            order by {pk_columns!s} limit %(limit)s""".format(**{
                'table_name': self.table_name,
                'use_index': destination_use_index,
+               'partition_sql': ' '.join(partition_sql_parts),
                'columns': ', '.join(self.columns),
                'pk_columns': ', '.join(self.primary_key),
                'range_sql': sql_tuple_comparison(self.table_name, self.primary_key)})
@@ -411,7 +697,36 @@ class Checker(object):
                'min_range_sql': sql_tuple_comparison(self.source_table_name, self.source_primary_key),
                'max_range_sql': sql_tuple_comparison(self.source_table_name, self.source_primary_key, column_name_prefix='max_')})
 
-    self.stats = Stats(interval=stats_interval, name=self.table_name)
+    # Checksum mode: "last" queries are for the last chunk, which has no
+    # upper bound.
+    destination_chunk_args = (self.table_name, destination_use_index,
+                              ' '.join(partition_sql_parts), self.primary_key)
+    source_chunk_args = (self.source_table_name, source_use_index,
+                         ' '.join(keyspace_sql_parts), self.source_primary_key)
+    self.destination_boundary_sql = chunk_sql(
+        *destination_chunk_args, select=', '.join(self.primary_key),
+        bounded=False) + " limit 1 offset %(offset)s"
+    self.destination_checksum_sql = chunk_sql(
+        *destination_chunk_args, select=checksum_sql(self.columns), bounded=True, order=False)
+    self.last_destination_checksum_sql = chunk_sql(
+        *destination_chunk_args, select=checksum_sql(self.columns), bounded=False, order=False)
+    self.source_checksum_sql = chunk_sql(
+        *source_chunk_args, select=checksum_sql(self.source_columns), bounded=True, order=False)
+    self.last_source_checksum_sql = chunk_sql(
+        *source_chunk_args, select=checksum_sql(self.source_columns), bounded=False, order=False)
+    self.destination_chunk_sql = chunk_sql(
+        *destination_chunk_args, select=', '.join(self.columns), bounded=True)
+    self.last_destination_chunk_sql = chunk_sql(
+        *destination_chunk_args, select=', '.join(self.columns), bounded=False)
+    self.source_chunk_page_sql = chunk_sql(
+        *source_chunk_args, select=', '.join(self.source_columns),
+        bounded=True) + " limit %(limit)s"
+
+    # A shared Stats is printed by its owner.
+    self.owns_stats = stats is None
+    if stats is None:
+      stats = Stats(interval=stats_interval, name=self.table_name)
+    self.stats = stats
     self.destination = Datastore(parse_database_url(destination_url, password_map), stats=self.stats)
     self.sources = MultiDatastore([parse_database_url(s, password_map) for s in sources_urls], 'all-sources', stats=self.stats)
 
@@ -420,20 +735,7 @@ class Checker(object):
     logging.debug("source sql template: %s", clean(self.source_sql))
 
   def get_table_data(self, table_name, params):
-    table = {'columns': [], 'pk': []}
-    conn = MySQLdb.connect(**params)
-    cursor = conn.cursor()
-    cursor.execute("SELECT avg_row_length FROM information_schema.tables WHERE table_schema = %s AND table_name = %s", (params['db'], table_name))
-    table['avg_row_length'] = cursor.fetchone()[0]
-
-    cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s ORDER BY table_name, ordinal_position", (params['db'], table_name))
-    for row in cursor.fetchall():
-      table['columns'].append(row[0])
-
-    cursor.execute("select column_name FROM information_schema.key_column_usage WHERE table_schema=%s AND constraint_name='PRIMARY' AND table_name = %s ORDER BY table_name, ordinal_position", (params['db'], table_name))
-    for row in cursor.fetchall():
-      table['pk'].append(row[0])
-    return table
+    return get_table_data(table_name, params)
 
   def calculate_batch_size(self):
     if self.batch_count != 0:
@@ -445,10 +747,146 @@ class Checker(object):
         rows_per_block = 20
       self.batch_size = int(rows_per_block * self.ratio * self.blocks)
 
+  def adapt_batch_size(self, key, rows, latency, size=0, limit=None):
+    if self.batch_sizer is not None:
+      self.batch_size = self.batch_sizer.update(key, rows, latency, size, limit)
+
   def get_pk(self, row):
     return dict((k, v) for k, v in zip(self.primary_key, row))
 
+  def destination_params(self, start_pk, end_pk=None):
+    params = dict(start_pk)
+    if end_pk is not None:
+      for k, v in end_pk.items():
+        params['max_' + k] = v
+    return params
+
+  def source_params(self, start_pk, end_pk=None):
+    params = dict((self.source_column_map.get(k, k), v) for k, v in start_pk.items())
+    if end_pk is not None:
+      for k, v in end_pk.items():
+        params['max_' + self.source_column_map.get(k, k)] = v
+    return params
+
+  def chunk_boundary(self, start_pk, offset):
+    """Returns the primary key of the destination row offset rows after
+    start_pk, or None if there is no such row.
+    """
+    params = dict(start_pk, offset=offset)
+    rows = self.destination.query(self.destination_boundary_sql, params)
+    if not rows:
+      return None
+    return self.get_pk(rows[0])
+
+  def chunk_checksums(self, start_pk, end_pk, limit=None):
+    """Returns the number of destination rows in the chunk, and whether
+    the checksums of the destination and the sources are the same.
+
+    The batch size is only adapted for top-level chunks, whose limit is
+    given: the per query overhead dominates on bisected chunks.
+    """
+    bounded = end_pk is not None
+    start = time.time()
+    destination_count, destination_checksum = self.destination.query(
+        self.destination_checksum_sql if bounded else self.last_destination_checksum_sql,
+        self.destination_params(start_pk, end_pk))[0]
+    latency = self.stats.update('destination', start)
+    if limit is not None:
+      self.adapt_batch_size('destination', destination_count, latency, limit=limit)
+
+    start = time.time()
+    sources_count, sources_checksum = 0, 0
+    for rows in self.sources.query(
+        self.source_checksum_sql if bounded else self.last_source_checksum_sql,
+        self.source_params(start_pk, end_pk)):
+      count, checksum = rows[0]
+      sources_count += count
+      sources_checksum ^= int(checksum)
+    latency = self.stats.update('sources', start)
+    if limit is not None:
+      self.adapt_batch_size('sources', sources_count, latency, limit=limit)
+    return destination_count, (destination_count == sources_count and
+                               int(destination_checksum) == sources_checksum)
+
+  def compare_chunk(self, start_pk, end_pk):
+    """Compares the rows in (start_pk, end_pk] one by one. The chunk has
+    few destination rows, but the sources may have many more, so they
+    are read in pages of at most checksum_leaf_size rows per source.
+    """
+    while True:
+      params = self.source_params(start_pk, end_pk)
+      params['limit'] = self.checksum_leaf_size
+      sources_data = self.sources.query(
+          self.source_chunk_page_sql if end_pk is not None else self.last_source_sql,
+          params)
+      # A source with a full page may have more rows, so the page ends
+      # at the smallest last primary key of the full pages.
+      full_pages = [rows for rows in sources_data if len(rows) >= self.checksum_leaf_size]
+      if full_pages:
+        page_end = min(tuple(rows[-1][:self.pk_length]) for rows in full_pages)
+        page_end_pk = self.get_pk(page_end)
+        sources_data = [[row for row in rows if tuple(row[:self.pk_length]) <= page_end]
+                        for rows in sources_data]
+      else:
+        page_end_pk = end_pk
+      destination_data = self.destination.query(
+          self.destination_chunk_sql if page_end_pk is not None else self.last_destination_chunk_sql,
+          self.destination_params(start_pk, page_end_pk))
+      start = time.time()
+      missing, unexpected, different = sorted_row_list_difference(
+          heapq.merge(*sources_data), destination_data, self.pk_length)
+      self.stats.update('comparer', start)
+      if any([missing, unexpected, different]):
+        self.handle_mismatch(Mismatch(missing, unexpected, different))
+      if not full_pages:
+        return
+      start_pk = page_end_pk
+
+  def check_chunk(self, start_pk, end_pk, limit=None):
+    """Checks the rows in (start_pk, end_pk] with checksums, bisecting
+    the chunk while they differ. Returns the number of destination rows
+    in the chunk. limit is the batch size of a top-level chunk.
+    """
+    count, same = self.chunk_checksums(start_pk, end_pk, limit)
+    if same:
+      return count
+    if count > self.checksum_leaf_size:
+      middle_pk = self.chunk_boundary(start_pk, count // 2 - 1)
+      if middle_pk is not None:
+        self.check_chunk(start_pk, middle_pk)
+        self.check_chunk(middle_pk, end_pk)
+        return count
+    self.compare_chunk(start_pk, end_pk)
+    return count
+
+  def _run_checksum(self):
+    while True:
+      start = time.time()
+      # The last chunk has no upper bound, so that the rows that are
+      # only in the sources are checked.
+      limit = self.batch_size
+      end_pk = self.chunk_boundary(self.current_pk, limit - 1)
+      count = self.check_chunk(self.current_pk, end_pk, limit)
+      self.stats.update('total', start, count)
+      self.stats.maybe_print_local()
+      if end_pk is None:
+        self.checkpoint(self.current_pk, done=True)
+        if self.owns_stats:
+          self.stats.print_total()
+        return
+      self.checkpoint(end_pk)
+
   def _run(self):
+    try:
+      if self.checksum:
+        return self._run_checksum()
+      return self._run_pipeline()
+    finally:
+      if self.owns_comparer_pool and self.comparer_pool is not None:
+        self.comparer_pool.terminate()
+        self.comparer_pool = None
+
+  def _run_pipeline(self):
     # initialize destination_in_queue, sources_in_queue, merger_in_queue, comparer_in_queue, comparare_out_queue
     self.destination_in_queue = Queue.Queue(maxsize=3)
     self.sources_in_queue = Queue.Queue(maxsize=3)
@@ -480,7 +918,9 @@ class Checker(object):
       if error_or_done:
         self.destination_in_queue.put((None, True))
       if error_or_done is True:
-        self.stats.print_total()
+        self.checkpoint(self.current_pk, done=True)
+        if self.owns_stats:
+          self.stats.print_total()
         return
       elif error_or_done is not None:
         raise error_or_done
@@ -494,18 +934,22 @@ class Checker(object):
       start_pk, done = self.destination_in_queue.get()
       start = time.time()
       if done:
-        self.sources_in_queue.put((None, None, None, True))
+        self.sources_in_queue.put((None, None, None, None, True))
         return
 
-      params = {'limit': self.batch_size}
+      limit = self.batch_size
+      params = {'limit': limit}
       params.update(start_pk)
 
       # query the destination -> data
       try:
         destination_data = self.destination.query(self.destination_sql, params)
       except MySQLdb.ProgrammingError as e:
-        self.sources_in_queue.put((None, None, None, e))
+        self.sources_in_queue.put((None, None, None, None, e))
         return
+      self.adapt_batch_size('destination', len(destination_data),
+                            self.destination.last_query_time, rows_size(destination_data),
+                            limit)
 
       try:
         end_pk = self.get_pk(destination_data[-1])
@@ -513,18 +957,18 @@ class Checker(object):
         # There's no more data in the destination. The next object we
         # get from the in-queue is going to be put there by _run or is
         # going to be an error.
-        self.sources_in_queue.put((start_pk, None, [], None))
+        self.sources_in_queue.put((start_pk, None, [], limit, None))
       else:
         # put the (range-pk, data) on the sources in-queue
-        self.sources_in_queue.put((start_pk, end_pk, destination_data, None))
+        self.sources_in_queue.put((start_pk, end_pk, destination_data, limit, None))
         self.destination_in_queue.put((end_pk, None))
       self.stats.update('destination', start)
 
 
   def sources_worker(self):
     while True:
-      # get (range-pk, data) from the sources in-queue
-      (start_pk, end_pk, destination_data, error_or_done) = self.sources_in_queue.get()
+      # get (range-pk, data, batch size of the range) from the sources in-queue
+      (start_pk, end_pk, destination_data, limit, error_or_done) = self.sources_in_queue.get()
       start = time.time()
       if error_or_done:
         self.merger_comparer_in_queue.put((None, None, error_or_done))
@@ -538,24 +982,31 @@ class Checker(object):
           params['max_' + self.source_column_map.get(k, k)] = v
         sources_data = self.sources.query(self.source_sql, params)
       else:
-        params['limit'] = self.batch_size
+        limit = params['limit'] = self.batch_size
         sources_data = self.sources.query(self.last_source_sql, params)
       # put (sources_data, data, done) on the merger in-queue
       done = not (sources_data or destination_data)
-      self.stats.update('sources', start)
+      self.adapt_batch_size('sources', sum(len(d) for d in sources_data),
+                            self.stats.update('sources', start),
+                            sum(rows_size(d) for d in sources_data), limit)
       self.merger_comparer_in_queue.put((destination_data, sources_data, done))
 
   def merger_comparer_worker(self):
+    # (async result, last pk, destination rows) of the batches sent to
+    # the comparer pool, in order.
+    pending = collections.deque()
     while True:
       destination_data, sources_data, error_or_done = self.merger_comparer_in_queue.get()
       start = time.time()
 
       if error_or_done:
+        self.finish_comparisons(pending)
         self.merger_comparer_out_queue.put((error_or_done, 0))
         return
       # No more data in both the sources and the destination, we are
       # done.
       if destination_data == [] and not any(len(s) for s in sources_data):
+        self.finish_comparisons(pending)
         self.merger_comparer_out_queue.put((True, 0))
         return
 
@@ -567,34 +1018,69 @@ class Checker(object):
         # Only sources data: short-circuit
         merged_data = list(merged_data)
         last_pk = self.get_pk(merged_data[-1])
-        missing, unexpected, different = merged_data, [], []
+        result = merged_data, [], []
       else:
+        if self.comparer_pool is not None:
+          payload = pickle.dumps((destination_data, sources_data), pickle.HIGHEST_PROTOCOL)
+          pending.append((self.comparer_pool.apply_async(compare_serialized_batch, (payload, self.pk_length)),
+                          last_pk, len(destination_data)))
+          self.stats.update('comparer', start)
+          self.finish_comparisons(pending, max_pending=2 * self.comparer_processes)
+          continue
         # compare the data
-        missing, unexpected, different = sorted_row_list_difference(merged_data, destination_data, self.pk_length)
+        result = sorted_row_list_difference(merged_data, destination_data, self.pk_length)
 
       self.stats.update('comparer', start)
+      self.finish_comparisons(pending)
+      self.put_comparison(result, last_pk, len(destination_data))
 
-      # put the mismatch or None on comparer out-queue.
-      if any([missing, unexpected, different]):
-        self.merger_comparer_out_queue.put((Mismatch(missing, unexpected, different), len(destination_data)))
+  def finish_comparisons(self, pending, max_pending=0):
+    """Waits for the oldest batches sent to the comparer pool, until at
+    most max_pending are left.
+    """
+    while len(pending) > max_pending:
+      async_result, last_pk, processed_rows = pending.popleft()
+      start = time.time()
+      try:
+        payload = async_result.get()
+      except Exception as e:
+        self.merger_comparer_out_queue.put((e, 0))
+        raise
+      if payload is None:
+        result = [], [], []
       else:
-        self.merger_comparer_out_queue.put((None, len(destination_data)))
+        result = pickle.loads(payload)
+      self.stats.update('comparer', start)
+      self.put_comparison(result, last_pk, processed_rows)
+
+  def put_comparison(self, result, last_pk, processed_rows):
+    missing, unexpected, different = result
+    # put the mismatch or None on comparer out-queue.
+    if any([missing, unexpected, different]):
+      self.merger_comparer_out_queue.put((Mismatch(missing, unexpected, different), processed_rows))
+    else:
+      self.merger_comparer_out_queue.put((None, processed_rows))
 
-      # checkpoint
-      self.checkpoint(last_pk, done=False)
+    # checkpoint
+    self.checkpoint(last_pk, done=False)
 
   def restore_checkpoint(self):
     with open(self.checkpoint_file) as fi:
       checkpoint = pickle.load(fi)
     self.current_pk, self.done = checkpoint['current_pk'], checkpoint['done']
+    if self.batch_sizer is not None and checkpoint.get('batch_size'):
+      self.batch_size = self.batch_sizer.reset(checkpoint['batch_size'])
 
   def checkpoint(self, pk, done=False):
     start = time.time()
     data = {'current_pk': pk,
             'done': done,
             'timestamp': str(datetime.datetime.now())}
+    if self.batch_sizer is not None:
+      data['batch_size'] = self.batch_sizer.last_good_size
     with AtomicWriter(self.checkpoint_file, self.temp_directory) as fi:
       pickle.dump(data, fi)
+    self.current_pk, self.done = pk, done
     self.stats.update('checkpoint', start)
 
   def run(self):
@@ -603,6 +1089,279 @@ class Checker(object):
     except Mismatch as e:
       print e
 
+
+class ParallelChecker(object):
+  """ParallelChecker splits a table in ranges of one column and checks
+  the ranges in parallel, each with its own Checker.
+
+  By default the ranges split the leading primary key column, between
+  its minimum and maximum values in the destination. The first and
+  last ranges are open, so rows only present in the sources are still
+  checked. The ranges can also split the keyspace_id column, within
+  the keyrange. This needs a keyspace_id column in the destination,
+  and each range then scans the whole primary key.
+
+  Each range has its own connections, checkpoint and mismatches files,
+  and all of them update the same Stats. The ranges are saved on the
+  first run, so that a resumed run uses the same ones. With
+  comparer_processes, the checkers share one comparer pool.
+  """
+  checker_class = Checker
+
+  def __init__(self, destination_url, sources_urls, table, partitions,
+               partition_column=None, directory='.', keyrange=None,
+               stats_interval=1, temp_directory=None, password_map_file=None,
+               **kwargs):
+    if keyrange is None:
+      keyrange = {}
+    self.table_name = table
+    self.keyrange = keyrange
+    # Created before the checkers start their threads.
+    self.owns_comparer_pool = kwargs.get('comparer_pool') is None and bool(
+        kwargs.get('comparer_processes'))
+    if self.owns_comparer_pool:
+      kwargs['comparer_pool'] = create_comparer_pool(kwargs['comparer_processes'])
+    self.comparer_pool = kwargs.get('comparer_pool')
+    self.destination_params = parse_database_url(
+        destination_url, load_password_map(password_map_file))
+    self.table_data = get_table_data(table, self.destination_params)
+    self.stats = Stats(interval=stats_interval, name=table)
+
+    self.partitions_file = os.path.join(directory, table + '_partitions.pickle')
+    try:
+      with open(self.partitions_file) as fi:
+        self.partitions = pickle.load(fi)
+    except IOError:
+      self.partitions = self.calculate_partitions(partitions, partition_column)
+      with AtomicWriter(self.partitions_file, temp_directory) as fi:
+        pickle.dump(self.partitions, fi)
+    else:
+      if len(self.partitions) != partitions:
+        logging.warning("Resuming with the %d ranges of %s.",
+                        len(self.partitions), self.partitions_file)
+
+    self.checkers = [
+        self.checker_class(destination_url, sources_urls, table, directory,
+                           keyrange=keyrange, stats_interval=stats_interval,
+                           temp_directory=temp_directory,
+                           password_map_file=password_map_file,
+                           partition=partition, stats=self.stats,
+                           table_data=self.table_data, **kwargs)
+        for partition in self.partitions]
+
+  def calculate_partitions(self, count, column=None):
+    if column is None:
+      column = self.table_data['pk'][0]
+    if column == 'keyspace_id':
+      start, end = self.keyrange.get('start', 0), self.keyrange.get('end', 2**64)
+    else:
+      sql = "SELECT MIN({0!s}), MAX({0!s}) FROM {1!s}".format(column, self.table_name)
+      start, end = Datastore(self.destination_params).query(sql, None)[0]
+      if not (isinstance(start, (int, long)) and isinstance(end, (int, long))):
+        logging.warning("Cannot split %s.%s (%r, %r), checking it in one range.",
+                        self.table_name, column, start, end)
+        start = end = 0
+      end += 1
+    edges = [None] + split_range(start, end, count) + [None]
+    return [{'index': i, 'column': column, 'start': edges[i], 'end': edges[i + 1]}
+            for i in xrange(len(edges) - 1)]
+
+  def _run(self):
+    errors = []
+
+    def run_checker(checker):
+      try:
+        checker._run()
+      except Exception as e:
+        logging.exception("Error checking range %s", checker.partition)
+        errors.append(e)
+
+    threads = []
+    for checker in self.checkers:
+      if checker.done:
+        continue
+      t = threading.Thread(target=run_checker, args=(checker,),
+                           name='checker_{0:d}'.format(checker.partition['index']))
+      t.daemon = True
+      threads.append(t)
+      t.start()
+    for t in threads:
+      t.join()
+    if self.owns_comparer_pool:
+      self.comparer_pool.terminate()
+      self.owns_comparer_pool = False
+    self.stats.print_total()
+    if errors:
+      raise errors[0]
+
+  def run(self):
+    try:
+      self._run()
+    except Mismatch as e:
+      print e
+
+
+class TableScheduler(object):
+  """TableScheduler checks many tables, each with its own Checker.
+
+  The tables are given or discovered in information_schema, and are
+  checked largest first. A table is started when the servers it uses
+  have fewer than max_connections_per_host connections to it open
+  (a Checker opens one connection to the destination, and one to each
+  source). All the checkers share one Stats, and the progress and the
+  estimated time left are logged every stats_interval seconds.
+
+  The tables and the ones that are done are saved in a global
+  checkpoint, so that a resumed run skips the tables already checked.
+  Tables that were being checked resume from their own checkpoints.
+  A resumed run only checks the tables it selects: the saved tables
+  that are not selected are skipped, and new ones are added.
+  With comparer_processes, all the checkers share one comparer pool.
+  """
+  checker_class = Checker
+
+  def __init__(self, destination_url, sources_urls, tables=None, directory='.',
+               max_connections_per_host=4, stats_interval=1, temp_directory=None,
+               password_map_file=None, **kwargs):
+    self.destination_url = destination_url
+    self.sources_urls = sources_urls
+    self.directory = directory
+    self.max_connections_per_host = max_connections_per_host
+    self.stats_interval = stats_interval
+    self.temp_directory = temp_directory
+    self.password_map_file = password_map_file
+    self.checker_kwargs = kwargs
+    self.stats = Stats(interval=stats_interval, name='all tables')
+    self.owns_comparer_pool = kwargs.get('comparer_pool') is None and bool(
+        kwargs.get('comparer_processes'))
+    if self.owns_comparer_pool:
+      kwargs['comparer_pool'] = create_comparer_pool(kwargs['comparer_processes'])
+
+    password_map = load_password_map(password_map_file)
+    destination_params = parse_database_url(destination_url, password_map)
+    self.connections_per_host = collections.defaultdict(int)
+    for params in [destination_params] + [parse_database_url(s, password_map) for s in sources_urls]:
+      self.connections_per_host[host_key(params)] += 1
+    self.open_connections = collections.defaultdict(int)
+
+    self.schema = get_schema_data(destination_params, tables)
+    self.checkpoint_file = os.path.join(directory, 'checker_scheduler.checkpoint')
+    try:
+      with open(self.checkpoint_file) as fi:
+        checkpoint = pickle.load(fi)
+    except IOError:
+      self.tables = sorted(self.schema, key=lambda t: (-self.schema[t]['data_length'], t))
+      self.done = set()
+      self.checkpoint()
+    else:
+      self.tables = [t for t in checkpoint['tables'] if t in self.schema]
+      self.done = set(checkpoint['done'])
+      skipped = [t for t in checkpoint['tables'] if t not in self.schema]
+      if skipped:
+        logging.warning("Not checking tables of %s that are not selected: %s",
+                     self.checkpoint_file, ', '.join(skipped))
+      # Tables selected since the checkpoint was saved are added,
+      # largest first, after the ones already scheduled.
+      added = sorted((t for t in self.schema if t not in self.tables),
+                     key=lambda t: (-self.schema[t]['data_length'], t))
+      if added:
+        logging.info("Adding tables to %s: %s", self.checkpoint_file, ', '.join(added))
+        self.tables.extend(added)
+        self.checkpoint()
+
+    self.condition = threading.Condition()
+    self.checkers = {}
+    self.running = set()
+    self.errors = {}
+
+  def checkpoint(self):
+    data = {'tables': self.tables,
+            'done': sorted(self.done),
+            'timestamp': str(datetime.datetime.now())}
+    with AtomicWriter(self.checkpoint_file, self.temp_directory) as fi:
+      pickle.dump(data, fi)
+
+  def can_start(self):
+    # A host without connections can always be used, even if a checker
+    # needs more connections to it than the limit.
+    return all(self.open_connections[host] == 0 or
+               self.open_connections[host] + count <= self.max_connections_per_host
+               for host, count in self.connections_per_host.items())
+
+  def check_table(self, table):
+    try:
+      checker = self.checker_class(
+          self.destination_url, self.sources_urls, table, self.directory,
+          stats_interval=self.stats_interval, temp_directory=self.temp_directory,
+          password_map_file=self.password_map_file, stats=self.stats,
+          table_data=self.schema[table], **self.checker_kwargs)
+      self.checkers[table] = checker
+      checker._run()
+    except Exception as e:
+      logging.exception("Error checking %s", table)
+      error = e
+    else:
+      error = None
+    with self.condition:
+      for host, count in self.connections_per_host.items():
+        self.open_connections[host] -= count
+      self.running.discard(table)
+      if error is None:
+        self.done.add(table)
+        self.checkpoint()
+      else:
+        self.errors[table] = error
+      self.condition.notify()
+
+  def print_progress(self, start, total_rows):
+    elapsed = time.time() - start
+    rows = self.stats.items
+    data = ["{0:d}/{1:d} tables done".format(len(self.done), len(self.tables)),
+            "{0:d} running".format(len(self.running)),
+            "{0:d} of ~{1:d} rows".format(rows, total_rows)]
+    if rows and elapsed:
+      speed = rows / elapsed
+      data.append("{0:0.2f} rows/s".format(speed))
+      data.append("ETA {0!s}".format(format_duration(max(0, total_rows - rows) / speed)))
+    logging.info(', '.join(data))
+
+  def _run(self):
+    pending = [t for t in self.tables if t not in self.done]
+    total_rows = sum(self.schema[t]['table_rows'] for t in pending)
+    start = time.time()
+    last_report = start
+    with self.condition:
+      while pending or self.running:
+        # Tables are started in order, so the largest ones are not
+        # delayed by smaller ones.
+        while pending and self.can_start():
+          table = pending.pop(0)
+          for host, count in self.connections_per_host.items():
+            self.open_connections[host] += count
+          self.running.add(table)
+          t = threading.Thread(target=self.check_table, args=(table,),
+                               name='checker_{0!s}'.format(table))
+          t.daemon = True
+          t.start()
+        self.condition.wait(self.stats_interval or None)
+        if self.stats_interval and time.time() - last_report >= self.stats_interval:
+          self.print_progress(start, total_rows)
+          last_report = time.time()
+    if self.owns_comparer_pool:
+      self.checker_kwargs['comparer_pool'].terminate()
+      self.owns_comparer_pool = False
+    self.print_progress(start, total_rows)
+    self.stats.print_total()
+    if self.errors:
+      raise self.errors.values()[0]
+
+  def run(self):
+    try:
+      self._run()
+    except Mismatch as e:
+      print e
+
+
 def get_range(start, end):
   ret = {}
   if start != "":
@@ -652,9 +1411,46 @@ def main():
                     help="keyrange end (hexadecimal)")
   parser.add_option('--password-map-file', type='string', default=None,
                     help="password map file")
+  parser.add_option('--target-latency', type='float', default=0,
+                    dest='target_latency',
+                    help='Adapt the batch size so that queries take about this many seconds.')
+  parser.add_option('--target-bytes', type='int', default=0,
+                    dest='target_bytes',
+                    help='Adapt the batch size so that queries return about this many bytes.')
+  parser.add_option('--min-batch-size', type='int', default=10,
+                    dest='min_batch_size',
+                    help='Lower bound of the adapted batch size.')
+  parser.add_option('--max-batch-size', type='int', default=100000,
+                    dest='max_batch_size',
+                    help='Upper bound of the adapted batch size.')
+  parser.add_option('--comparer-processes', type='int', default=0,
+                    dest='comparer_processes',
+                    help='Compare the rows in this many processes.')
+  parser.add_option('--checksum', dest='checksum', action='store_true',
+                    default=False,
+                    help='Compare checksums of the chunks, and only fetch the rows of the chunks that differ.')
+  parser.add_option('--partitions', type='int', default=1, dest='partitions',
+                    help="check this many ranges of the table in parallel")
+  parser.add_option('--partition-column', type='string', default=None,
+                    dest='partition_column',
+                    help="column the ranges are split on, the first primary key column by default (or keyspace_id)")
+
+  parser.add_option('--tables', type='string', default='', dest='tables',
+                    help="check these tables (comma separated), the arguments are then the destination and the sources")
+  parser.add_option('--all-tables', dest='all_tables', action='store_true',
+                    default=False,
+                    help="check all the tables of the destination, the arguments are then the destination and the sources")
+  parser.add_option('--max-connections-per-host', type='int', default=4,
+                    dest='max_connections_per_host',
+                    help="with --tables or --all-tables, the maximum number of connections to one server")
 
   (options, args) = parser.parse_args()
-  table, destination, sources = args[0], args[1], args[2:]
+  # Forked before any thread is started, and shared by all the checkers.
+  comparer_pool = create_comparer_pool(options.comparer_processes)
+  if options.tables or options.all_tables:
+    table, destination, sources = None, args[0], args[1:]
+  else:
+    table, destination, sources = args[0], args[1], args[2:]
 
   source_column_map = {}
   if options.source_column_map:
@@ -662,17 +1458,42 @@ def main():
       k, v = pair.split(':')
       source_column_map[k] = v
 
-  checker = Checker(destination, sources, table, options.checkpoint_directory,
-                    source_column_map=source_column_map,
-                    source_force_index_pk=options.source_force_index,
-                    destination_force_index_pk=options.destination_force_index,
-                    source_table_name=options.source_table_name,
-                    keyrange=get_range(options.start, options.end),
-                    stats_interval=options.stats, batch_count=options.batch_count,
-                    block_size=options.block_size, ratio=options.ratio,
-                    temp_directory=options.checkpoint_directory,
-                    password_map_file=options.password_map_file)
-  checker.run()
+  kwargs = dict(source_column_map=source_column_map,
+                source_force_index_pk=options.source_force_index,
+                destination_force_index_pk=options.destination_force_index,
+                source_table_name=options.source_table_name,
+                keyrange=get_range(options.start, options.end),
+                stats_interval=options.stats, batch_count=options.batch_count,
+                block_size=options.block_size, ratio=options.ratio,
+                temp_directory=options.checkpoint_directory,
+                password_map_file=options.password_map_file,
+                checksum=options.checksum,
+                target_latency=options.target_latency,
+                target_bytes=options.target_bytes,
+                min_batch_size=options.min_batch_size,
+                max_batch_size=options.max_batch_size,
+                comparer_processes=options.comparer_processes,
+                comparer_pool=comparer_pool)
+  if table is None:
+    del kwargs['source_table_name']
+    tables = None
+    if options.tables:
+      tables = options.tables.split(',')
+    checker = TableScheduler(destination, sources, tables,
+                             directory=options.checkpoint_directory,
+                             max_connections_per_host=options.max_connections_per_host,
+                             **kwargs)
+  elif options.partitions > 1:
+    checker = ParallelChecker(destination, sources, table, options.partitions,
+                              partition_column=options.partition_column,
+                              directory=options.checkpoint_directory, **kwargs)
+  else:
+    checker = Checker(destination, sources, table, options.checkpoint_directory, **kwargs)
+  try:
+    checker.run()
+  finally:
+    if comparer_pool is not None:
+      comparer_pool.terminate()
 
 if __name__ == '__main__':
   main()
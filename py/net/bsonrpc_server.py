@@ -0,0 +1,167 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+# Minimal Go-style RPC server using BSON as the codec.
+#
+# This speaks the same protocol as the Go servers: the client sends an
+# HTTP CONNECT to /_bson_rpc_, gets a '200 Connected' line back, and
+# then exchanges (header, body) BSON document pairs over the hijacked
+# socket. It is meant to fake out vitess servers in tests and load
+# drivers, it is not a production server.
+
+import logging
+import SocketServer
+import socket
+import threading
+
+import bson
+
+from net import bsonrpc
+from net import gorpc
+
+CONNECTED = 'HTTP/1.0 200 Connected to Go RPC\n\n'
+
+
+# The response header echoes the request, plus an 'Error' field that is
+# empty on success.
+def make_response_header(method, sequence_id, error=''):
+  header = gorpc.make_header(method, sequence_id)
+  header['Error'] = error
+  return header
+
+
+class BsonRpcHandler(SocketServer.BaseRequestHandler):
+  """Serves the requests of a single client connection, in order."""
+
+  def setup(self):
+    self.data = ''
+    # streaming sends many small replies, don't let Nagle delay them.
+    self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  def handle(self):
+    try:
+      if not self._read_connect():
+        return
+      while True:
+        request = self._read_request()
+        if request is None:
+          return
+        header, body = request
+        # simple values are wrapped by the client, see bsonrpc.WRAPPED_FIELD
+        if isinstance(body, dict) and bsonrpc.WRAPPED_FIELD in body:
+          body = body[bsonrpc.WRAPPED_FIELD]
+        self.server.serve_request(self, header, body)
+    except socket.error as e:
+      logging.debug('bsonrpc_server: connection closed: %s', e)
+
+  def _fill(self, size):
+    while len(self.data) < size:
+      d = self.request.recv(max(size - len(self.data), gorpc.default_read_buffer_size))
+      if not d:
+        return False
+      self.data += d
+    return True
+
+  def _consume(self, size):
+    chunk, self.data = self.data[:size], self.data[size:]
+    return chunk
+
+  def _read_connect(self):
+    while '\n\n' not in self.data:
+      d = self.request.recv(1024)
+      if not d:
+        return False
+      self.data += d
+    index = self.data.index('\n\n') + 2
+    if not self.data.startswith('CONNECT '):
+      self.request.sendall('HTTP/1.0 405 must CONNECT\n\n')
+      return False
+    self._consume(index)
+    self.request.sendall(CONNECTED)
+    return True
+
+  def _read_document(self):
+    if not self._fill(bsonrpc.len_struct_size):
+      return None
+    length = bsonrpc.unpack_length(self.data)[0]
+    if not self._fill(length):
+      return None
+    return bson.loads(self._consume(length))
+
+  def _read_request(self):
+    header = self._read_document()
+    if header is None:
+      return None
+    body = self._read_document()
+    if body is None:
+      return None
+    return header, body
+
+  def write_response(self, header, reply):
+    if not isinstance(reply, dict):
+      reply = {bsonrpc.WRAPPED_FIELD: reply}
+    self.request.sendall(bson.dumps(header) + bson.dumps(reply))
+
+
+class BsonRpcServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  """A threaded BSON RPC server.
+
+  Methods are registered by their full service name, for instance
+  'VTGate.Execute'. A method is called with the decoded request body
+  and returns the reply. A streaming method returns an iterable of
+  replies instead. Raising an exception sends the error to the client
+  as a gorpc.AppError.
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, host='localhost', port=0):
+    SocketServer.TCPServer.__init__(self, (host, port), BsonRpcHandler)
+    self.methods = {}
+    self.stream_methods = {}
+    self.thread = None
+
+  @property
+  def port(self):
+    return self.server_address[1]
+
+  @property
+  def addr(self):
+    return 'localhost:{0:d}'.format(self.port)
+
+  def register(self, method, func):
+    self.methods[method] = func
+
+  def register_stream(self, method, func):
+    self.stream_methods[method] = func
+
+  def serve_request(self, handler, header, body):
+    method = header['ServiceMethod']
+    seq = header['Seq']
+    try:
+      if method in self.stream_methods:
+        for reply in self.stream_methods[method](body):
+          handler.write_response(make_response_header(method, seq), reply)
+        handler.write_response(
+            make_response_header(method, seq, gorpc._lastStreamResponseError), {})
+        return
+      if method not in self.methods:
+        raise gorpc.AppError("rpc: can't find method {0!s}".format(method))
+      reply = self.methods[method](body)
+    except socket.error:
+      raise
+    except Exception as e:
+      handler.write_response(make_response_header(method, seq, str(e)), {})
+      return
+    handler.write_response(make_response_header(method, seq), reply)
+
+  def start(self):
+    self.thread = threading.Thread(target=self.serve_forever,
+                                   name='bsonrpc_server')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
@@ -326,6 +326,11 @@ class GoRpcClient(object):
         raise TimeoutError(e, self.timeout, method)
       raise GoRpcError(e, method)
 
+  # Returns True if part of the next streamed value was already read,
+  # so that stream_next won't wait for the server to send it.
+  def stream_buffered(self):
+    return bool(self.data)
+
   # Returns the next value, or None if we're done.
   # Note the timeout is longer as we don't mind for streaming queries
   # since they get their own bigger connection pool on the vttablet side
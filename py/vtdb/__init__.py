@@ -5,7 +5,10 @@
 # PEP 249 complient db api for Vitess
 
 apilevel = '2.0'
-threadsafety = 0  # Threads may not share the module because multi_client is not thread safe
+# Threads may share the module but not connections: each thread needs its
+# own DatabaseContext, see database_context.DatabaseContextRegistry. The
+# VTGateConnectionPool only hands a connection to one context at a time.
+threadsafety = 1
 paramstyle = 'named'
 
 from vtdb.dbexceptions import *
@@ -15,6 +15,9 @@ class Cursor(object):
   results = None
   description = None
   index = None
+  # Optional sql_normalizer.SQLNormalizer created with pyformat=False,
+  # to turn the literals of execute into bind variables.
+  sql_normalizer = None
 
   def __init__(self, connection, tablet_type):
     self._conn = connection
@@ -49,6 +52,9 @@ class Cursor(object):
       self.rollback()
       return
 
+    if self.sql_normalizer is not None:
+      sql, bind_variables = self.sql_normalizer.normalize(sql, bind_variables)
+
     self.results, self.rowcount, self.lastrowid, self.description = self._conn._execute(
         sql,
         bind_variables,
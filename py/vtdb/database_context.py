@@ -18,8 +18,10 @@ management.
 import contextlib
 import functools
 import logging
+import threading
 
 from vtdb import dbexceptions
+from vtdb import hedged_vtgate
 from vtdb import shard_constants
 from vtdb import vtdb_logger
 from vtdb import vtgatev2
@@ -27,6 +29,8 @@ from vtdb import vtgatev2
 
 #TODO: verify that these values make sense.
 DEFAULT_CONNECTION_TIMEOUT = 5.0
+# Maximum number of idle connections kept by a VTGateConnectionPool.
+DEFAULT_POOL_SIZE = 16
 
 __app_read_only_mode_method = lambda:False
 __vtgate_connect_method = vtgatev2.connect
@@ -54,15 +58,25 @@ class DatabaseContext(object):
     transaction_stack_depth: This allows nesting of transactions and makes
     commit rpc to VTGate when the outer-most commits.
     vtgate_connection: Connection to VTGate.
+    connection_pool: Optional VTGateConnectionPool. When set, the connection
+    is borrowed from the pool for each db operation, and given back when
+    the operation is done and no transaction is open.
+    hedged_read_connection: HedgedVTGateConnection used for replica reads
+    outside of transactions, see enable_hedged_reads.
   """
 
-  def __init__(self, vtgate_addrs=None, lag_tolerant_mode=False, master_access_disabled=False):
+  def __init__(self, vtgate_addrs=None, lag_tolerant_mode=False, master_access_disabled=False,
+               connection_pool=None):
     self.vtgate_addrs = vtgate_addrs
     self.lag_tolerant_mode = lag_tolerant_mode
     self.master_access_disabled = master_access_disabled
     self.vtgate_connection = None
+    self.connection_pool = connection_pool
+    self.hedged_read_connection = None
     self.change_master_read_to_replica = False
     self._transaction_stack_depth = 0
+    # Set when the connection of the open transaction was discarded.
+    self._transaction_broken = False
     self.event_logger = vtdb_logger.get_logger()
     self.connection_timeout = DEFAULT_CONNECTION_TIMEOUT
     self._tablet_type = None
@@ -85,15 +99,69 @@ class DatabaseContext(object):
     Transactions and some of the consistency guarantees rely on vtgate
     connections being sticky hence this class caches the connection.
     """
+    if self._transaction_broken:
+      raise dbexceptions.OperationalError(
+          "The connection of the transaction was lost.")
     if self.vtgate_connection is not None and not self.vtgate_connection.is_closed():
       return self.vtgate_connection
 
+    if self.connection_pool is not None:
+      self.vtgate_connection = self.connection_pool.get()
+      return self.vtgate_connection
+
     #TODO: the connect method needs to be extended to include query n txn timeouts as well
     #FIXME: what is the best way of passing other params ?
     connect_method = get_vtgate_connect_method()
     self.vtgate_connection = connect_method(self.vtgate_addrs, self.connection_timeout)
     return self.vtgate_connection
 
+  def enable_hedged_reads(self, **hedge_kargs):
+    """Hedges the replica reads done outside of transactions.
+
+    Args:
+      hedge_kargs: HedgedVTGateConnection parameters.
+    """
+    if self.hedged_read_connection is not None:
+      self.hedged_read_connection.close()
+    self.hedged_read_connection = hedged_vtgate.HedgedVTGateConnection(
+        self.vtgate_addrs, self.connection_timeout, **hedge_kargs)
+
+  def _use_hedged_reads(self, writable):
+    return (self.hedged_read_connection is not None and
+            not writable and not self.in_transaction and
+            self.tablet_type != shard_constants.TABLET_TYPE_MASTER)
+
+  def release_vtgate_connection(self):
+    """Gives the connection back to the pool, outside of transactions.
+
+    Without a pool, the connection stays cached on this context.
+    """
+    if self.connection_pool is None or self.in_transaction:
+      return
+    if self.vtgate_connection is not None:
+      self.connection_pool.put(self.vtgate_connection)
+      self.vtgate_connection = None
+
+  def discard_vtgate_connection(self):
+    """Closes the connection after an OperationalError.
+
+    It is not given back to the pool. An open transaction is lost with
+    it: it is marked broken, so that its commit raises OperationalError
+    even if the caller caught the first error.
+    """
+    if self.in_transaction:
+      self._transaction_broken = True
+    if self.vtgate_connection is not None:
+      self.vtgate_connection.close()
+      self.vtgate_connection = None
+
+  def leave_broken_transaction(self):
+    """Leaves one level of a transaction marked broken."""
+    if self._transaction_stack_depth:
+      self._transaction_stack_depth -= 1
+    if self._transaction_stack_depth == 0:
+      self._transaction_broken = False
+
   def degrade_master_read_to_replica(self):
     self.change_master_read_to_replica = True
 
@@ -104,6 +172,11 @@ class DatabaseContext(object):
     self._transaction_stack_depth += 1
 
   def commit(self):
+    if self._transaction_broken:
+      self.leave_broken_transaction()
+      raise dbexceptions.OperationalError(
+          "The connection of the transaction was lost, it was not committed.")
+
     if self._transaction_stack_depth:
       self._transaction_stack_depth -= 1
 
@@ -113,9 +186,11 @@ class DatabaseContext(object):
     if self.vtgate_connection is None:
       return
     self.vtgate_connection.commit()
+    self.release_vtgate_connection()
 
   def rollback(self):
     self._transaction_stack_depth = 0
+    self._transaction_broken = False
     try:
       if self.vtgate_connection is not None:
         self.vtgate_connection.rollback()
@@ -124,10 +199,19 @@ class DatabaseContext(object):
       self.vtgate_connection = None
     except Exception as e:
       raise
+    self.release_vtgate_connection()
 
   def close(self):
     if self._transaction_stack_depth:
       self.rollback()
+    if self.hedged_read_connection is not None:
+      self.hedged_read_connection.close()
+      self.hedged_read_connection = None
+    if self.vtgate_connection is None:
+      return
+    if self.connection_pool is not None:
+      self.release_vtgate_connection()
+      return
     self.vtgate_connection.close()
 
   def read_from_master_setup(self):
@@ -154,13 +238,18 @@ class DatabaseContext(object):
 
   def close_db_operation(self):
     self._tablet_type = None
+    self.release_vtgate_connection()
 
   def create_cursor(self, writable, table_class, **cursor_kargs):
     if not self.in_db_operation:
       raise dbexceptions.ProgrammingError(
           "Cannot execute queries outside db operations context.")
 
-    cursor = table_class.create_vtgate_cursor(self.get_vtgate_connection(),
+    if self._use_hedged_reads(writable):
+      vtgate_conn = self.hedged_read_connection
+    else:
+      vtgate_conn = self.get_vtgate_connection()
+    cursor = table_class.create_vtgate_cursor(vtgate_conn,
                                               self.tablet_type,
                                               writable,
                                               **cursor_kargs)
@@ -168,6 +257,91 @@ class DatabaseContext(object):
     return cursor
 
 
+class VTGateConnectionPool(object):
+  """Thread-safe pool of vtgate connections, shared by DatabaseContexts.
+
+  Connections are created on demand, with the registered vtgate connect
+  method. Only up to size idle connections are kept, the others are
+  closed when they are given back.
+  """
+
+  def __init__(self, vtgate_addrs, size=DEFAULT_POOL_SIZE,
+               connection_timeout=DEFAULT_CONNECTION_TIMEOUT):
+    self.vtgate_addrs = vtgate_addrs
+    self.size = size
+    self.connection_timeout = connection_timeout
+    self.lock = threading.Lock()
+    self.idle = []
+    self.closed = False
+
+  def get(self):
+    with self.lock:
+      if self.closed:
+        raise dbexceptions.ProgrammingError("Connection pool is closed.")
+      while self.idle:
+        conn = self.idle.pop()
+        if not conn.is_closed():
+          return conn
+    connect_method = get_vtgate_connect_method()
+    return connect_method(self.vtgate_addrs, self.connection_timeout)
+
+  def put(self, conn):
+    # A connection with an open session would leak the transaction to
+    # the next user, throw it away.
+    if conn.is_closed():
+      return
+    if not conn.session:
+      with self.lock:
+        if not self.closed and len(self.idle) < self.size:
+          self.idle.append(conn)
+          return
+    conn.close()
+
+  def close(self):
+    with self.lock:
+      self.closed = True
+      idle, self.idle = self.idle, []
+    for conn in idle:
+      conn.close()
+
+
+class DatabaseContextRegistry(object):
+  """Gives each thread its own DatabaseContext.
+
+  All the contexts share a VTGateConnectionPool, so a thread only holds
+  a connection during its db operations, and for the whole duration of
+  its transactions. Greenlet based servers can pass their local class,
+  e.g. gevent.local.local, as local_class.
+  """
+
+  def __init__(self, vtgate_addrs, pool_size=DEFAULT_POOL_SIZE,
+               connection_timeout=DEFAULT_CONNECTION_TIMEOUT,
+               local_class=threading.local, **context_kargs):
+    self.vtgate_addrs = vtgate_addrs
+    self.connection_pool = VTGateConnectionPool(
+        vtgate_addrs, size=pool_size, connection_timeout=connection_timeout)
+    self.context_kargs = context_kargs
+    self.local = local_class()
+
+  def get_context(self):
+    dc = getattr(self.local, 'context', None)
+    if dc is None:
+      dc = DatabaseContext(self.vtgate_addrs,
+                           connection_pool=self.connection_pool,
+                           **self.context_kargs)
+      dc.connection_timeout = self.connection_pool.connection_timeout
+      self.local.context = dc
+    return dc
+
+  def close(self):
+    """Closes the context of this thread and the idle connections."""
+    dc = getattr(self.local, 'context', None)
+    if dc is not None:
+      dc.close()
+      self.local.context = None
+    self.connection_pool.close()
+
+
 class DBOperationBase(object):
   """Base class for database read and write operations.
 
@@ -193,13 +367,14 @@ class ReadFromMaster(DBOperationBase):
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
+    # A broken connection is discarded before the pool can get it back.
+    if exc_type is not None and issubclass(exc_type,
+                                           dbexceptions.OperationalError):
+      self.dc.event_logger.vtgatev2_exception(exc_value)
+      self.dc.discard_vtgate_connection()
     self.dc.close_db_operation()
     if exc_type is None:
       return True
-    if isinstance(exc_type, dbexceptions.OperationalError):
-      self.dc.event_logger.vtgatev2_exception(exc_value)
-      self.dc.vtgate_connection.close()
-      self.dc.vtgate_connection = None
 
 
 class ReadFromReplica(DBOperationBase):
@@ -209,13 +384,14 @@ class ReadFromReplica(DBOperationBase):
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
+    # A broken connection is discarded before the pool can get it back.
+    if exc_type is not None and issubclass(exc_type,
+                                           dbexceptions.OperationalError):
+      self.dc.event_logger.vtgatev2_exception(exc_value)
+      self.dc.discard_vtgate_connection()
     self.dc.close_db_operation()
     if exc_type is None:
       return True
-    if isinstance(exc_type, dbexceptions.OperationalError):
-      self.dc.event_logger.vtgatev2_exception(exc_value)
-      self.dc.vtgate_connection.close()
-      self.dc.vtgate_connection = None
 
 
 class WriteTransaction(DBOperationBase):
@@ -227,15 +403,18 @@ class WriteTransaction(DBOperationBase):
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
+    operational_error = (exc_type is not None and
+                         issubclass(exc_type, dbexceptions.OperationalError))
+    # A broken connection is discarded before the pool can get it back.
+    if operational_error:
+      self.dc.discard_vtgate_connection()
+      self.dc.leave_broken_transaction()
     self.dc.close_db_operation()
     if exc_type is None:
       self.dc.commit()
       return True
 
-    if isinstance(exc_type, dbexceptions.OperationalError):
-      self.dc.vtgate_connection.close()
-      self.dc.vtgate_connection = None
-    else:
+    if not operational_error:
       if self.dc.vtgate_connection is not None:
         self.dc.rollback()
       if isinstance(exc_type, dbexceptions.IntegrityError):
@@ -317,3 +496,32 @@ def close():
   if __database_context is not None:
     __database_context.close()
     __database_context = None
+
+
+# The global registry is for multi-threaded applications, see
+# DatabaseContextRegistry.
+__context_registry = None
+__context_registry_lock = threading.Lock()
+
+def open_thread_context(*pargs, **kargs):
+  """Returns the database context of the calling thread.
+
+  The arguments are used to create the global DatabaseContextRegistry
+  on the first call.
+  """
+  global __context_registry
+
+  with __context_registry_lock:
+    if __context_registry is None:
+      __context_registry = DatabaseContextRegistry(*pargs, **kargs)
+    registry = __context_registry
+  return registry.get_context()
+
+
+def close_thread_contexts():
+  """Close the global registry and its idle connections."""
+  global __context_registry
+  with __context_registry_lock:
+    if __context_registry is not None:
+      __context_registry.close()
+      __context_registry = None
@@ -17,6 +17,7 @@ from vtdb import keyrange
 from vtdb import keyrange_constants
 from vtdb import shard_constants
 from vtdb import sql_builder
+from vtdb import topology
 from vtdb import vtgate_cursor
 
 class __EmptyBindVariables(frozenset):
@@ -51,6 +52,105 @@ def _is_iterable_container(x):
   return hasattr(x, '__iter__')
 
 
+# IN lists with more values than this are split into several queries
+# by select_by_columns and select_by_ids, so that huge lists don't go
+# over the mysql packet size or run as one slow query.
+MAX_IN_LIST_SIZE = 5000
+
+
+def _unique(values):
+  seen = set()
+  result = []
+  for value in values:
+    if value not in seen:
+      seen.add(value)
+      result.append(value)
+  return result
+
+
+def split_in_clause(where_column_value_pairs, column_name, values, chunk_size):
+  """Splits the IN list of a where clause into chunks.
+
+  Args:
+    where_column_value_pairs: where clause, as a list of (column, value).
+    column_name: column of the IN list.
+    values: values of the IN list, duplicates are dropped.
+    chunk_size: maximum number of values per chunk.
+
+  Returns:
+    A copy of where_column_value_pairs per chunk, with the value of
+    column_name replaced by the chunk.
+  """
+  values = _unique(values)
+  result = []
+  for start in xrange(0, len(values), chunk_size):
+    chunk = values[start:start + chunk_size]
+    result.append([(column, chunk if column == column_name else value)
+                   for column, value in where_column_value_pairs])
+  return result
+
+
+def _keyrange_shards(cursor):
+  """Returns the names of the shards of the keyranges of a cursor.
+
+  The batch rpcs can't route by keyrange, so the keyranges are resolved
+  with the cached topology. Returns None if it isn't known.
+  """
+  if not cursor.keyranges:
+    return None
+  keyspace_obj = topology.get_keyspace(cursor.keyspace)
+  if keyspace_obj is None:
+    return None
+  shards = []
+  for shard in keyspace_obj.get_shards(cursor.tablet_type):
+    start = shard['KeyRange']['Start']
+    end = shard['KeyRange']['End']
+    for kr in cursor.keyranges:
+      if ((kr.End == keyrange_constants.MAX_KEY or start < kr.End) and
+          (end == keyrange_constants.MAX_KEY or kr.Start < end)):
+        shards.append(shard['Name'])
+        break
+  return shards or None
+
+
+def _execute_read_batch(cursor, queries):
+  """Runs the (query, bind_vars) of queries with the routing of cursor.
+
+  They are sent as one batch rpc when the routing allows it, else one
+  after the other.
+
+  Returns:
+    The rows of all the queries.
+  """
+  keyspace_ids = cursor.keyspace_ids
+  shards = cursor.shards
+  if keyspace_ids is None and shards is None:
+    shards = _keyrange_shards(cursor)
+  rows = []
+  if keyspace_ids is None and shards is None:
+    for query, bind_vars in queries:
+      cursor.execute(query, bind_vars)
+      rows.extend(cursor.fetchall())
+    return rows
+  batch_cursor = vtgate_cursor.BatchVTGateCursor(
+      cursor._conn, cursor.keyspace, cursor.tablet_type,
+      keyspace_ids=keyspace_ids, writable=cursor.is_writable(), shards=shards)
+  for query, bind_vars in queries:
+    batch_cursor.execute(query, bind_vars)
+  batch_cursor.flush()
+  # rowset is (results, rowcount, lastrowid, fields)
+  for rowset in batch_cursor.rowsets:
+    rows.extend(rowset[0])
+  return rows
+
+
+def _oversize_in_list(where_column_value_pairs, max_size):
+  for column, value in where_column_value_pairs:
+    if isinstance(value, (list, tuple, set)) and len(value) > max_size:
+      return column, value
+  return None, None
+
+
 INSERT_KW = "insert"
 UPDATE_KW = "update"
 DELETE_KW = "delete"
@@ -120,7 +220,8 @@ def create_stream_cursor_from_cursor(original_cursor):
       original_cursor.tablet_type,
       keyspace_ids=original_cursor.keyspace_ids,
       keyranges=original_cursor.keyranges,
-      writable=False)
+      writable=False,
+      shards=original_cursor.shards)
   return stream_cursor
 
 
@@ -141,7 +242,8 @@ def create_batch_cursor_from_cursor(original_cursor, writable=False):
       original_cursor._conn, original_cursor.keyspace,
       original_cursor.tablet_type,
       keyspace_ids=original_cursor.keyspace_ids,
-      writable=writable)
+      writable=writable,
+      shards=original_cursor.shards)
   return batch_cursor
 
 
@@ -251,9 +353,10 @@ def execute_batch_write(cursor, query_list, bind_vars_list):
     raise dbexceptions.ProgrammingError(
         "cursor is not of the type VTGateCursor.")
   batch_cursor = create_batch_cursor_from_cursor(cursor, writable=True)
-  if batch_cursor.is_writable() and len(batch_cursor.keyspace_ids) != 1:
+  if batch_cursor.is_writable() and len(batch_cursor.keyspace_ids or
+                                        batch_cursor.shards or ()) != 1:
     raise dbexceptions.ProgrammingError(
-        "writable batch execute can also execute on one keyspace_id.")
+        "writable batch execute can also execute on one keyspace_id or shard.")
   for q, bv in zip(query_list, bind_vars_list):
     if not is_dml(q):
       raise dbexceptions.ProgrammingError("query {0!s} is not a dml".format(q))
@@ -294,6 +397,12 @@ class DBObjectBase(object):
   id_column_name = None
   is_mysql_view = False
   utf8_columns = None
+  # Optional result_cache.ResultCache for the replica reads of
+  # select_by_columns. Its entries expire after its ttl, see the
+  # ResultCache docstring for the consistency it provides.
+  result_cache = None
+  # Longer IN lists are split by select_by_columns and select_by_ids.
+  max_in_list_size = MAX_IN_LIST_SIZE
 
 
   @classmethod
@@ -335,16 +444,73 @@ class DBObjectBase(object):
                         limit=None):
     if columns_list is None:
       columns_list = class_.columns_list
-    query, bind_vars = class_.create_select_query(where_column_value_pairs,
-                                                  columns_list=columns_list,
-                                                  order_by=order_by,
-                                                  group_by=group_by,
-                                                  limit=limit)
 
-    rowcount = cursor.execute(query, bind_vars)
-    rows = cursor.fetchall()
+    # An oversize IN list is run as several queries, sent as one batch
+    # rpc. With the result cache, they are run one after the other, so
+    # that each one is cached. The results of a split query wouldn't be
+    # ordered, grouped or limited as a whole, so those are never split.
+    chunks = [where_column_value_pairs]
+    if order_by is None and group_by is None and limit is None:
+      in_column, in_values = _oversize_in_list(where_column_value_pairs,
+                                               class_.max_in_list_size)
+      if in_column is not None:
+        chunks = split_in_clause(where_column_value_pairs, in_column,
+                                 in_values, class_.max_in_list_size)
+
+    use_result_cache = class_._use_result_cache(cursor)
+    rows = []
+    queries = []
+    for chunk_column_value_pairs in chunks:
+      query, bind_vars = class_.create_select_query(chunk_column_value_pairs,
+                                                    columns_list=columns_list,
+                                                    order_by=order_by,
+                                                    group_by=group_by,
+                                                    limit=limit)
+      if use_result_cache:
+        rows.extend(class_._cached_select(cursor, query, bind_vars,
+                                          chunk_column_value_pairs))
+      else:
+        queries.append((query, bind_vars))
+    if len(queries) == 1:
+      cursor.execute(*queries[0])
+      rows.extend(cursor.fetchall())
+    elif queries:
+      rows.extend(_execute_read_batch(cursor, queries))
     return [sql_builder.DBRow(columns_list, row) for row in rows]
 
+  @classmethod
+  def _use_result_cache(class_, cursor):
+    return (class_.result_cache is not None and
+            class_.result_cache.active and
+            cursor.tablet_type in (shard_constants.TABLET_TYPE_REPLICA,
+                                   shard_constants.TABLET_TYPE_BATCH) and
+            not cursor.is_writable() and
+            not cursor._conn.session)
+
+  @classmethod
+  def _cached_select(class_, cursor, query, bind_vars,
+                     where_column_value_pairs):
+    cache = class_.result_cache
+    key = cursor._query_key(query, bind_vars)
+    if key is None:
+      cursor.execute(query, bind_vars)
+      return cursor.fetchall()
+    rows = cache.get(key)
+    if rows is not None:
+      return rows
+
+    # Reads of a single row by id can be invalidated by primary key.
+    pk = None
+    if (len(where_column_value_pairs) == 1 and
+        where_column_value_pairs[0][0] == class_.id_column_name and
+        not _is_iterable_container(where_column_value_pairs[0][1])):
+      pk = (where_column_value_pairs[0][1],)
+    generation = cache.generation(class_.table_name)
+    cursor.execute(query, bind_vars)
+    rows = cursor.fetchall()
+    cache.put(class_.table_name, key, rows, generation, pk=pk)
+    return rows
+
   @classmethod
   def create_insert_query(class_, **bind_vars):
     class_._validate_column_value_pairs_for_write(**bind_vars)
@@ -27,24 +27,27 @@ class DBObjectCustomSharded(db_object.DBObjectBase):
 
   @classmethod
   def create_shard_routing(class_, *pargs, **kwargs):
-    routing = db_object.ShardRouting(keyspace)
-    routing.shard_name = kargs.get('shard_name')
+    routing = db_object.ShardRouting(class_.keyspace)
+    routing.shard_name = kwargs.get('shard_name')
     if routing.shard_name is None:
-      dbexceptions.InternalError("For custom sharding, shard_name cannot be None.")
-
-    if (_is_iterable_container(routing.shard_name)
-        and is_dml):
       raise dbexceptions.InternalError(
-          "Writes are not allowed on multiple shards.")
+          "For custom sharding, shard_name cannot be None.")
     return routing
 
   @classmethod
   def create_vtgate_cursor(class_, vtgate_conn, tablet_type, is_dml, **cursor_kargs):
-    # FIXME:extend VTGateCursor's api to accept shard_names
-    # and allow queries based on that.
     routing = class_.create_shard_routing(**cursor_kargs)
+    if db_object._is_iterable_container(routing.shard_name):
+      shards = list(routing.shard_name)
+    else:
+      shards = [routing.shard_name,]
+    if is_dml and len(shards) != 1:
+      raise dbexceptions.InternalError(
+          "Writes are not allowed on multiple shards.")
+
     cursor = vtgate_cursor.VTGateCursor(vtgate_conn, class_.keyspace,
                                         tablet_type,
-                                        keyranges=[routing.shard_name,],
+                                        shards=shards,
                                         writable=is_dml)
+    cursor.routing = routing
     return cursor
@@ -22,6 +22,11 @@ class LookupDBObject(db_object_unsharded.DBObjectUnsharded):
   """This is an example implementation of lookup class where it is stored
   in unsharded db.
   """
+  # Optional lookup_cache.LookupCache of entity id to sharding key,
+  # used by the range-sharded classes for routing. Its keys include the
+  # table name, so it can be shared by several lookup classes.
+  lookup_cache = None
+
   @classmethod
   def get(class_, cursor, entity_id_column, entity_id):
     where_column_value_pairs = [(entity_id_column, entity_id),]
@@ -37,10 +42,16 @@ class LookupDBObject(db_object_unsharded.DBObjectUnsharded):
              entity_id_column, new_entity_id):
     where_column_value_pairs = [(sharding_key_column_name, sharding_key),]
     update_column_value_pairs = [(entity_id_column,new_entity_id),]
-    return class_.update_columns(cursor, where_column_value_pairs,
-                                 update_column_value_pairs)
+    rowcount = class_.update_columns(cursor, where_column_value_pairs,
+                                     update_column_value_pairs)
+    if class_.lookup_cache is not None:
+      class_.lookup_cache.invalidate_value(sharding_key)
+    return rowcount
 
   @classmethod
   def delete(class_, cursor, sharding_key_column_name, sharding_key):
     where_column_value_pairs = [(sharding_key_column_name, sharding_key),]
-    return class_.delete_by_columns(cursor, where_column_value_pairs)
+    rowcount = class_.delete_by_columns(cursor, where_column_value_pairs)
+    if class_.lookup_cache is not None:
+      class_.lookup_cache.invalidate_value(sharding_key)
+    return rowcount
@@ -9,7 +9,9 @@ This module also contains helper methods for cursor creation for accessing looku
 and methods for dml and select for the above mentioned base classes.
 """
 import functools
+import Queue
 import struct
+import threading
 
 from vtdb import db_object
 from vtdb import dbexceptions
@@ -17,6 +19,7 @@ from vtdb import keyrange
 from vtdb import keyrange_constants
 from vtdb import shard_constants
 from vtdb import sql_builder
+from vtdb import topology
 from vtdb import vtgate_cursor
 
 
@@ -32,6 +35,15 @@ def unpack_keyspace_id(kid):
  return struct.Struct('!Q').unpack(kid)[0]
 
 
+# Multi-row insert statements built by bulk_insert are capped to about
+# this many bytes, well under the default mysql max_allowed_packet.
+BULK_INSERT_MAX_STATEMENT_SIZE = 256 * 1024
+
+# Entity ids are mapped to sharding keys with IN queries on the lookup
+# tables of at most this many ids.
+LOOKUP_BATCH_SIZE = 500
+
+
 class DBObjectRangeSharded(db_object.DBObjectBase):
   """Base class for range-sharded db classes.
 
@@ -179,15 +191,96 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
 
     Args:
       entity_id_column: Non-sharding key indexes that can be used for query routing.
-      entity_id: entity id value.
+      entity_id: entity id value, or a list of them.
 
     Returns:
-      sharding key to be used for routing.
+      map of entity id to the sharding key to be used for routing.
     """
+    if db_object._is_iterable_container(entity_id):
+      return class_.lookup_sharding_keys_from_entity_ids(
+          cursor_method, entity_id_column, entity_id)
+
     entity_lookup_column = class_.get_lookup_column_name(entity_id_column)
     lookup_class = class_.entity_id_lookup_map[entity_id_column]
+    cache = lookup_class.lookup_cache
+    generation = None
+    if cache is not None:
+      sharding_key = cache.get(
+          (lookup_class.table_name, entity_lookup_column, entity_id))
+      if sharding_key is not None:
+        return {entity_id: sharding_key}
+      generation = cache.generation
+
     rows = lookup_class.get(cursor_method, entity_lookup_column, entity_id)
+    entity_id_sharding_key_map = class_._make_entity_id_sharding_key_map(
+        entity_lookup_column, rows)
+    class_._cache_sharding_keys(lookup_class, entity_lookup_column,
+                                entity_id_sharding_key_map, generation)
+    return entity_id_sharding_key_map
+
+  @classmethod
+  def lookup_sharding_keys_from_entity_ids(class_, cursor_method,
+                                           entity_id_column, entity_ids):
+    """Maps a set of entity ids to their sharding keys.
+
+    The ids are looked up with one IN query per LOOKUP_BATCH_SIZE ids,
+    instead of one query per id. Ids found in the lookup class cache
+    are not queried.
+
+    Args:
+      entity_id_column: Non-sharding key indexes that can be used for query routing.
+      entity_ids: list of entity id values.
 
+    Returns:
+      map of entity id to the sharding key to be used for routing.
+    """
+    entity_lookup_column = class_.get_lookup_column_name(entity_id_column)
+    lookup_class = class_.entity_id_lookup_map[entity_id_column]
+    cache = lookup_class.lookup_cache
+    generation = None
+    if cache is not None:
+      generation = cache.generation
+    entity_id_sharding_key_map = {}
+    unique_entity_ids = []
+    seen = set()
+    for entity_id in entity_ids:
+      if entity_id in seen:
+        continue
+      seen.add(entity_id)
+      if cache is not None:
+        sharding_key = cache.get(
+            (lookup_class.table_name, entity_lookup_column, entity_id))
+        if sharding_key is not None:
+          entity_id_sharding_key_map[entity_id] = sharding_key
+          continue
+      unique_entity_ids.append(entity_id)
+    if not unique_entity_ids:
+      return entity_id_sharding_key_map
+
+    rows = []
+    for i in xrange(0, len(unique_entity_ids), LOOKUP_BATCH_SIZE):
+      rows.extend(lookup_class.get(cursor_method, entity_lookup_column,
+                                   unique_entity_ids[i:i + LOOKUP_BATCH_SIZE]))
+    looked_up_map = class_._make_entity_id_sharding_key_map(
+        entity_lookup_column, rows)
+    class_._cache_sharding_keys(lookup_class, entity_lookup_column,
+                                looked_up_map, generation)
+    entity_id_sharding_key_map.update(looked_up_map)
+    return entity_id_sharding_key_map
+
+  @classmethod
+  def _cache_sharding_keys(class_, lookup_class, entity_lookup_column,
+                           entity_id_sharding_key_map, generation):
+    # generation is the one of the cache before the lookup query.
+    cache = lookup_class.lookup_cache
+    if cache is None:
+      return
+    for entity_id, sharding_key in entity_id_sharding_key_map.iteritems():
+      cache.put((lookup_class.table_name, entity_lookup_column, entity_id),
+                sharding_key, generation)
+
+  @classmethod
+  def _make_entity_id_sharding_key_map(class_, entity_lookup_column, rows):
     entity_id_sharding_key_map = {}
     if len(rows) == 0:
       #return entity_id_sharding_key_map
@@ -202,7 +295,7 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
       if len(lookup_column_names) != 2:
         raise dbexceptions.ProgrammingError(
             "lookup table has more than two columns.")
-      sk_lookup_column = list(set(lookup_column_names) - set(list(entity_lookup_column)))[0]
+      sk_lookup_column = list(set(lookup_column_names) - set([entity_lookup_column]))[0]
     for row in rows:
       en_id = row[entity_lookup_column]
       sk = row[sk_lookup_column]
@@ -213,24 +306,23 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
   @db_object.db_class_method
   def select_by_ids(class_, cursor, where_column_value_pairs,
                         columns_list=None, order_by=None, group_by=None,
-                        limit=None, **kwargs):
+                        limit=None, connection_factory=None, max_workers=4,
+                        **kwargs):
     """This method is used to perform in-clause queries.
 
     Such queries can cause vtgate to scatter over multiple shards.
     This uses execute_entity_ids method of vtgate cursor and the entity
     column and the associated entity_keyspace_id_map is computed based
     on the routing used - sharding_key or entity_id_map.
+
+    When the entity column IN list has more than max_in_list_size ids,
+    the ids are grouped by shard and split into chunks instead, see
+    _select_by_ids_in_chunks. connection_factory and max_workers are
+    only used then.
     """
     if columns_list is None:
       columns_list = class_.columns_list
 
-    query, bind_vars = class_.create_select_query(where_column_value_pairs,
-                                                  columns_list=columns_list,
-                                                  order_by=order_by,
-                                                  group_by=group_by,
-                                                  limit=limit,
-                                                  **kwargs)
-
     entity_col_name = None
     entity_id_keyspace_id_map = {}
     if cursor.routing.sharding_key is not None:
@@ -250,6 +342,26 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
     else:
       dbexceptions.ProgrammingError("Invalid routing method used.")
 
+    # The results of a split query wouldn't be ordered, grouped or
+    # limited as a whole, so those are never split.
+    if (order_by is None and group_by is None and limit is None and
+        len(entity_id_keyspace_id_map) > class_.max_in_list_size):
+      entity_ids = dict(where_column_value_pairs).get(entity_col_name)
+      if db_object._is_iterable_container(entity_ids):
+        rows = class_._select_by_ids_in_chunks(
+            cursor, where_column_value_pairs, columns_list, entity_col_name,
+            [en_id for en_id in entity_ids
+             if en_id in entity_id_keyspace_id_map],
+            entity_id_keyspace_id_map, connection_factory, max_workers,
+            **kwargs)
+        return [sql_builder.DBRow(columns_list, row) for row in rows]
+
+    query, bind_vars = class_.create_select_query(where_column_value_pairs,
+                                                  columns_list=columns_list,
+                                                  order_by=order_by,
+                                                  group_by=group_by,
+                                                  limit=limit,
+                                                  **kwargs)
     # cursor.routing.entity_column_name is set while creating shard routing.
     rowcount = cursor.execute_entity_ids(query, bind_vars,
                                          entity_id_keyspace_id_map,
@@ -257,6 +369,60 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
     rows = cursor.fetchall()
     return [sql_builder.DBRow(columns_list, row) for row in rows]
 
+  @classmethod
+  def _select_by_ids_in_chunks(class_, cursor, where_column_value_pairs,
+                               columns_list, entity_col_name, entity_ids,
+                               entity_id_keyspace_id_map,
+                               connection_factory=None, max_workers=4,
+                               **kwargs):
+    """Runs an oversize IN query as chunks of at most max_in_list_size ids.
+
+    The ids are grouped by shard, like in bulk_insert, so that each
+    chunk only goes to the shard of its ids. The chunks of a shard are
+    sent as one batch rpc, and the batches of the shards are sent
+    concurrently when connection_factory is set and the cursor isn't in
+    a transaction. kwargs are passed to create_select_query for each
+    chunk, like for the unsplit query.
+
+    Returns:
+      The rows of all the chunks.
+    """
+    keyspace_obj = topology.get_keyspace(class_.keyspace)
+    # shard name (or keyspace_id) -> (keyspace_ids, entity_ids)
+    groups = {}
+    for en_id in entity_ids:
+      kid = entity_id_keyspace_id_map[en_id]
+      group_key = class_._shard_group_key(keyspace_obj, cursor.tablet_type,
+                                          unpack_keyspace_id(kid))
+      group_keyspace_ids, group_entity_ids = groups.setdefault(group_key,
+                                                               (set(), []))
+      group_keyspace_ids.add(kid)
+      group_entity_ids.append(en_id)
+
+    batches = []
+    for group_keyspace_ids, group_entity_ids in groups.itervalues():
+      queries = [class_.create_select_query(chunk_column_value_pairs,
+                                            columns_list=columns_list,
+                                            **kwargs)
+                 for chunk_column_value_pairs in db_object.split_in_clause(
+                     where_column_value_pairs, entity_col_name,
+                     group_entity_ids, class_.max_in_list_size)]
+      batches.append((sorted(group_keyspace_ids), queries))
+
+    if (connection_factory is None or len(batches) == 1 or
+        cursor._conn.session):
+      results = [class_._execute_read_batch(cursor._conn, cursor.tablet_type,
+                                            keyspace_ids, queries)
+                 for keyspace_ids, queries in batches]
+    else:
+      results = class_._execute_batches_concurrently(
+          connection_factory, class_._execute_read_batch, cursor.tablet_type,
+          batches, max_workers)
+    rows = []
+    for batch_rows in results:
+      rows.extend(batch_rows)
+    return rows
+
   @classmethod
   def is_sharding_key_valid(class_, sharding_key):
     """Method to check the validity of sharding key for the table.
@@ -297,6 +463,168 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
     cursor.execute(query, bind_vars)
     return cursor.lastrowid
 
+  @classmethod
+  def bulk_insert(class_, cursor_method, rows,
+                  max_statement_size=BULK_INSERT_MAX_STATEMENT_SIZE,
+                  connection_factory=None, max_workers=4):
+    """Inserts many rows using multi-row insert statements.
+
+    The keyspace_id of rows that don't set it is computed from the
+    sharding key column. Rows are grouped by destination shard, using
+    the SrvKeyspace partitions cached by the topology module (or by
+    keyspace_id when the keyspace isn't cached), and each group is sent
+    as one batch rpc of insert statements of at most max_statement_size
+    bytes.
+
+    Args:
+      cursor_method: method to create a writable cursor.
+      rows: list of bind variable dicts, one per row.
+      max_statement_size: approximate size limit of each statement.
+      connection_factory: if set, a callable returning a new dialed
+        vtgate connection. Outside of a transaction, the shard groups
+        are then sent concurrently, over up to max_workers connections.
+      max_workers: maximum number of concurrent batch rpcs.
+
+    Returns:
+      The total rowcount.
+    """
+    if class_.columns_list is None:
+      raise dbexceptions.ProgrammingError("DB class should define columns_list")
+    if class_.is_mysql_view:
+      raise dbexceptions.ProgrammingError("writes disabled on view", class_)
+    if not rows:
+      return 0
+
+    cursor = cursor_method(class_, keyrange=keyrange_constants.NON_PARTIAL_KEYRANGE)
+    if not cursor.is_writable():
+      raise dbexceptions.ProgrammingError(
+          "Executing dmls on a non-writable cursor is not allowed.")
+
+    keyspace_obj = topology.get_keyspace(class_.keyspace)
+    # shard name (or keyspace_id) -> (keyspace_ids, rows)
+    groups = {}
+    for row in rows:
+      row = dict(row)
+      keyspace_id = row.get('keyspace_id', None)
+      if keyspace_id is None:
+        if class_.sharding_key_column_name is None:
+          raise dbexceptions.ProgrammingError(
+              "keyspace_id or sharding key is needed for bulk_insert")
+        keyspace_id = class_.sharding_key_to_keyspace_id(
+            row[class_.sharding_key_column_name])
+        row['keyspace_id'] = keyspace_id
+      class_._validate_column_value_pairs_for_write(**row)
+      group_key = class_._shard_group_key(keyspace_obj, cursor.tablet_type,
+                                          keyspace_id)
+      group_keyspace_ids, group_rows = groups.setdefault(group_key, (set(), []))
+      group_keyspace_ids.add(keyspace_id)
+      group_rows.append(row)
+
+    batches = []
+    for group_keyspace_ids, group_rows in groups.itervalues():
+      keyspace_ids = [pack_keyspace_id(kid) for kid in sorted(group_keyspace_ids)]
+      queries = sql_builder.insert_rows_queries(class_.table_name,
+                                                class_.columns_list,
+                                                group_rows,
+                                                max_statement_size)
+      batches.append((keyspace_ids, queries))
+
+    # A transaction is bound to the cursor connection, so its batches
+    # can only be sent one at a time.
+    if (connection_factory is None or len(batches) == 1 or
+        cursor._conn.session):
+      return sum(class_._execute_insert_batch(cursor._conn, cursor.tablet_type,
+                                              keyspace_ids, queries)
+                 for keyspace_ids, queries in batches)
+    return sum(class_._execute_batches_concurrently(
+        connection_factory, class_._execute_insert_batch, cursor.tablet_type,
+        batches, max_workers))
+
+  @classmethod
+  def _shard_group_key(class_, keyspace_obj, tablet_type, keyspace_id):
+    if keyspace_obj is not None:
+      try:
+        return keyspace_obj.keyspace_id_to_shard_name_for_db_type(keyspace_id,
+                                                                  tablet_type)
+      except ValueError:
+        pass
+    return keyspace_id
+
+  @classmethod
+  def _execute_insert_batch(class_, vtgate_conn, tablet_type, keyspace_ids,
+                            queries):
+    batch_cursor = vtgate_cursor.BatchVTGateCursor(vtgate_conn,
+                                                   class_.keyspace,
+                                                   tablet_type,
+                                                   keyspace_ids=keyspace_ids,
+                                                   writable=True)
+    for query, bind_vars in queries:
+      batch_cursor.execute(query, bind_vars)
+    batch_cursor.flush()
+    # rowset is (results, rowcount, lastrowid, fields)
+    return sum(rowset[1] for rowset in batch_cursor.rowsets)
+
+  @classmethod
+  def _execute_read_batch(class_, vtgate_conn, tablet_type, keyspace_ids,
+                          queries):
+    batch_cursor = vtgate_cursor.BatchVTGateCursor(vtgate_conn,
+                                                   class_.keyspace,
+                                                   tablet_type,
+                                                   keyspace_ids=keyspace_ids)
+    for query, bind_vars in queries:
+      batch_cursor.execute(query, bind_vars)
+    batch_cursor.flush()
+    rows = []
+    for rowset in batch_cursor.rowsets:
+      rows.extend(rowset[0])
+    return rows
+
+  @classmethod
+  def _execute_batches_concurrently(class_, connection_factory, batch_method,
+                                    tablet_type, batches, max_workers):
+    """Runs batch_method on each batch, over up to max_workers connections.
+
+    Returns:
+      The results of batch_method, in the order of batches.
+    """
+    batch_queue = Queue.Queue()
+    for i, batch in enumerate(batches):
+      batch_queue.put((i, batch))
+    lock = threading.Lock()
+    results = [None] * len(batches)
+    errors = []
+
+    def _worker():
+      try:
+        vtgate_conn = connection_factory()
+      except Exception as e:
+        with lock:
+          errors.append(e)
+        return
+      try:
+        while not errors:
+          try:
+            i, (keyspace_ids, queries) = batch_queue.get_nowait()
+          except Queue.Empty:
+            return
+          results[i] = batch_method(vtgate_conn, tablet_type, keyspace_ids,
+                                    queries)
+      except Exception as e:
+        with lock:
+          errors.append(e)
+      finally:
+        vtgate_conn.close()
+
+    threads = [threading.Thread(target=_worker)
+               for _ in xrange(min(max_workers, len(batches)))]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    if errors:
+      raise errors[0]
+    return results
+
   @classmethod
   def _add_keyspace_id(class_, keyspace_id, where_column_value_pairs):
     where_col_dict = dict(where_column_value_pairs)
@@ -0,0 +1,351 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""A fake vtgate server for client-side testing and load testing.
+
+FakeVTGate answers the VTGate, TopoReader, SqlQuery and UpdateStream
+BSON RPC methods with synthetic results, so the vtgatev2, vtgatev3,
+tablet, zkocc and update stream clients can be exercised without
+mysqld, vttablet or a topology server.
+The result size, the latency and the error rate are configurable.
+
+It can run in-process (see start_server) or as a separate process:
+  python fake_vtgate.py --port 15991 --rows 100 --row-size 256
+In the latter case, the serving port is printed on stdout.
+"""
+
+import optparse
+import random
+import sys
+import threading
+import time
+
+from bson import codec
+from net import bsonrpc_server
+from vtdb import field_types
+from vtdb import keyrange
+
+
+DEFAULT_KEYSPACE = 'test_keyspace'
+DEFAULT_SHARDS = (('-80', '', '\x80'), ('80-', '\x80', ''))
+DEFAULT_TABLET_TYPES = ('master', 'replica', 'rdonly')
+
+VTGATE_EXECUTE_METHODS = ('VTGate.Execute',
+                          'VTGate.ExecuteShard',
+                          'VTGate.ExecuteKeyspaceIds',
+                          'VTGate.ExecuteKeyRanges',
+                          'VTGate.ExecuteEntityIds')
+VTGATE_BATCH_METHODS = ('VTGate.ExecuteBatch',
+                        'VTGate.ExecuteBatchShard',
+                        'VTGate.ExecuteBatchKeyspaceIds')
+VTGATE_STREAM_METHODS = ('VTGate.StreamExecute',
+                         'VTGate.StreamExecuteShard',
+                         'VTGate.StreamExecuteKeyRanges',
+                         'VTGate.StreamExecuteKeyspaceIds')
+
+# KeyRange objects are sent with their class name, the server side
+# needs the class to decode them.
+codec.import_class(keyrange.KeyRange)
+
+
+class FakeError(Exception):
+  pass
+
+
+class FakeVTGate(object):
+  """Synthetic implementation of the vitess RPC services.
+
+  Attributes:
+    row_count: number of rows returned by every read query.
+    row_size: size in bytes of the string column of every row.
+    stream_batch_size: rows sent per streaming reply.
+    latency: seconds to wait before answering any call.
+    error_rate: probability in [0, 1] for a call to fail.
+    keyspace: keyspace served by the fake topology.
+    shards: list of (shard_name, keyrange_start, keyrange_end).
+  """
+
+  def __init__(self, row_count=10, row_size=64, stream_batch_size=100,
+               latency=0.0, error_rate=0.0, keyspace=DEFAULT_KEYSPACE,
+               shards=DEFAULT_SHARDS):
+    self.row_count = row_count
+    self.row_size = row_size
+    self.stream_batch_size = stream_batch_size
+    self.latency = latency
+    self.error_rate = error_rate
+    self.keyspace = keyspace
+    self.shards = shards
+    self.fields = [{'Name': 'id', 'Type': field_types.VT_LONGLONG},
+                   {'Name': 'msg', 'Type': field_types.VT_VAR_STRING}]
+    # The rows are built once, so the server is not the bottleneck
+    # of a load test.
+    payload = 'x' * row_size
+    self.rows = [[str(i), payload] for i in xrange(row_count)]
+    self.lock = threading.Lock()
+    self.transaction_id = 0
+    self.call_count = 0
+    # events sent by UpdateStream.ServeUpdateStream, as the raw
+    # StreamEvent dicts.
+    self.update_stream_events = []
+    # positions requested from UpdateStream.ServeUpdateStream
+    self.update_stream_positions = []
+    # port advertised in the end points, set by register
+    self.port = 0
+
+  def _simulate(self):
+    with self.lock:
+      self.call_count += 1
+    if self.latency:
+      time.sleep(self.latency)
+    if self.error_rate and random.random() < self.error_rate:
+      raise FakeError('fake_vtgate: injected error')
+
+  def _result(self, sql):
+    if sql.strip()[:6].lower() == 'select':
+      rows = self.rows
+      rows_affected = len(rows)
+    else:
+      rows = []
+      rows_affected = 1
+    return {'Fields': self.fields,
+            'Rows': rows,
+            'RowsAffected': rows_affected,
+            'InsertId': 0}
+
+  def _next_transaction_id(self):
+    with self.lock:
+      self.transaction_id += 1
+      return self.transaction_id
+
+  #
+  # VTGate service
+  #
+
+  def _session(self, req):
+    # Like vtgate, start a shard transaction for the first statement of
+    # a transaction. All the transactions of the fake go to the first
+    # shard.
+    session = req.get('Session')
+    if (session and session.get('InTransaction') and
+        not session.get('ShardSessions')):
+      session['ShardSessions'] = [{
+          'Keyspace': req.get('Keyspace') or self.keyspace,
+          'Shard': self.shards[0][0],
+          'TabletType': req.get('TabletType'),
+          'TransactionId': self._next_transaction_id()}]
+    return session
+
+  def execute(self, req):
+    self._simulate()
+    return {'Result': self._result(req['Sql']),
+            'Session': self._session(req)}
+
+  def execute_batch(self, req):
+    self._simulate()
+    return {'List': [self._result(q['Sql']) for q in req['Queries']],
+            'Session': self._session(req)}
+
+  def stream_execute(self, req):
+    self._simulate()
+    yield {'Result': {'Fields': self.fields, 'Rows': []}}
+    for i in xrange(0, len(self.rows), self.stream_batch_size):
+      yield {'Result': {'Fields': [],
+                        'Rows': self.rows[i:i + self.stream_batch_size]}}
+
+  def split_query(self, req):
+    # Like vtgate for a range-sharded keyspace: the same number of
+    # splits per shard, each restricted to its shard keyrange. The fake
+    # only tags the splits with bind variables.
+    self._simulate()
+    query = req['Query']
+    per_shard = -(-req['SplitCount'] // len(self.shards))
+    splits = []
+    for _, start, end in self.shards:
+      for i in xrange(per_shard):
+        bind_vars = dict(query['BindVariables'] or {})
+        bind_vars['_splitquery_index'] = i
+        splits.append({'Query': {'Sql': query['Sql'],
+                                 'BindVariables': bind_vars,
+                                 'Keyspace': req['Keyspace'],
+                                 'KeyRanges': [{'Start': start, 'End': end}]},
+                       'QueryShard': None,
+                       'Size': self.row_count})
+    return {'Splits': splits}
+
+  def begin(self, unused_req):
+    self._simulate()
+    return {'InTransaction': True, 'ShardSessions': []}
+
+  def commit(self, unused_session):
+    self._simulate()
+    return {}
+
+  def rollback(self, unused_session):
+    self._simulate()
+    return {}
+
+  #
+  # TopoReader service
+  #
+
+  def get_srv_keyspace_names(self, unused_req):
+    self._simulate()
+    return {'Entries': [self.keyspace]}
+
+  def get_srv_keyspace(self, req):
+    self._simulate()
+    if req['Keyspace'] != self.keyspace:
+      raise FakeError('fake_vtgate: unknown keyspace {0!s}'.format(req['Keyspace']))
+    shard_references = [{'Name': name,
+                         'KeyRange': {'Start': start, 'End': end}}
+                        for name, start, end in self.shards]
+    return {'Partitions': dict((tablet_type, {'ShardReferences': shard_references})
+                               for tablet_type in DEFAULT_TABLET_TYPES),
+            'ShardingColumnName': 'keyspace_id',
+            'ShardingColumnType': 'uint64',
+            'ServedFrom': None}
+
+  def get_end_points(self, req):
+    self._simulate()
+    return {'Entries': [{'Uid': 1,
+                         'Host': 'localhost',
+                         'NamedPortMap': {'vt': self.port}}]}
+
+  #
+  # SqlQuery service (direct tablet access)
+  #
+
+  def tablet_get_session_id(self, unused_req):
+    self._simulate()
+    return {'SessionId': 1}
+
+  def tablet_execute(self, req):
+    self._simulate()
+    reply = self._result(req['Sql'])
+    reply['Err'] = {'Code': 0, 'Message': ''}
+    return reply
+
+  def tablet_execute_batch(self, req):
+    self._simulate()
+    return {'List': [self._result(q['Sql']) for q in req['Queries']]}
+
+  def tablet_stream_execute(self, req):
+    self._simulate()
+    yield {'Fields': self.fields, 'Rows': []}
+    for i in xrange(0, len(self.rows), self.stream_batch_size):
+      yield {'Fields': [], 'Rows': self.rows[i:i + self.stream_batch_size]}
+
+  def tablet_begin(self, unused_req):
+    self._simulate()
+    return {'TransactionId': self._next_transaction_id()}
+
+  def tablet_commit(self, unused_req):
+    self._simulate()
+    return {}
+
+  def tablet_rollback(self, unused_req):
+    self._simulate()
+    return {}
+
+  #
+  # UpdateStream service
+  #
+
+  def serve_update_stream(self, req):
+    self._simulate()
+    self.update_stream_positions.append(req['Position'])
+    for event in self.update_stream_events:
+      yield event
+
+  def register(self, server):
+    """Registers all the fake services with a bsonrpc_server.BsonRpcServer."""
+    self.port = server.port
+    for method in VTGATE_EXECUTE_METHODS:
+      server.register(method, self.execute)
+    for method in VTGATE_BATCH_METHODS:
+      server.register(method, self.execute_batch)
+    for method in VTGATE_STREAM_METHODS:
+      server.register_stream(method, self.stream_execute)
+    server.register('VTGate.SplitQuery', self.split_query)
+    server.register('VTGate.Begin', self.begin)
+    server.register('VTGate.Commit', self.commit)
+    server.register('VTGate.Rollback', self.rollback)
+
+    server.register('TopoReader.GetSrvKeyspaceNames', self.get_srv_keyspace_names)
+    server.register('TopoReader.GetSrvKeyspace', self.get_srv_keyspace)
+    server.register('TopoReader.GetEndPoints', self.get_end_points)
+
+    server.register('SqlQuery.GetSessionId', self.tablet_get_session_id)
+    server.register('SqlQuery.Execute', self.tablet_execute)
+    server.register('SqlQuery.ExecuteBatch', self.tablet_execute_batch)
+    server.register_stream('SqlQuery.StreamExecute', self.tablet_stream_execute)
+    server.register('SqlQuery.Begin', self.tablet_begin)
+    server.register('SqlQuery.Commit', self.tablet_commit)
+    server.register('SqlQuery.Rollback', self.tablet_rollback)
+
+    server.register_stream('UpdateStream.ServeUpdateStream',
+                           self.serve_update_stream)
+
+
+def start_server(port=0, **kwargs):
+  """Starts a fake vtgate in a background thread of this process.
+
+  Args:
+    port: port to listen on, 0 picks a free one.
+    kwargs: FakeVTGate parameters.
+
+  Returns:
+    (server, fake_vtgate) tuple. server.addr is the address to
+    connect to, server.stop() shuts it down.
+  """
+  server = bsonrpc_server.BsonRpcServer(port=port)
+  fake = FakeVTGate(**kwargs)
+  fake.register(server)
+  server.start()
+  return server, fake
+
+
+def add_options(parser):
+  parser.add_option('--rows', type='int', default=10, dest='row_count',
+                    help='Number of rows returned by read queries.')
+  parser.add_option('--row-size', type='int', default=64, dest='row_size',
+                    help='Size in bytes of each returned row.')
+  parser.add_option('--stream-batch-size', type='int', default=100,
+                    dest='stream_batch_size',
+                    help='Number of rows per streaming reply.')
+  parser.add_option('--latency', type='float', default=0.0, dest='latency',
+                    help='Injected latency for every call, in seconds.')
+  parser.add_option('--error-rate', type='float', default=0.0,
+                    dest='error_rate',
+                    help='Probability for a call to fail, between 0 and 1.')
+
+
+def fake_vtgate_params(options):
+  return {'row_count': options.row_count,
+          'row_size': options.row_size,
+          'stream_batch_size': options.stream_batch_size,
+          'latency': options.latency,
+          'error_rate': options.error_rate}
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--port', type='int', default=0,
+                    help='Port to listen on, 0 picks a free one.')
+  add_options(parser)
+  (options, args) = parser.parse_args()
+
+  server = bsonrpc_server.BsonRpcServer(port=options.port)
+  FakeVTGate(**fake_vtgate_params(options)).register(server)
+  print server.port
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+if __name__ == '__main__':
+  main()
@@ -82,6 +82,17 @@ NoneType = type(None)
 # That doesn't seem dramatically better than __sql_literal__ but it might
 # be move self-documenting.
 
+def _convert_list_item(val):
+  # Items of list bind variables, e.g. from sql_builder IN clauses.
+  if hasattr(val, '__sql_literal__'):
+    return val.__sql_literal__()
+  elif isinstance(val, datetime.datetime):
+    return times.DateTimeToString(val)
+  elif isinstance(val, datetime.date):
+    return times.DateToString(val)
+  return val
+
+
 def convert_bind_vars(bind_variables):
   new_vars = {}
   if bind_variables is None:
@@ -94,10 +105,10 @@ def convert_bind_vars(bind_variables):
     elif isinstance(val, datetime.date):
       new_vars[key] = times.DateToString(val)
     elif isinstance(val, set):
-      new_vars[key] = sorted(val)
-    elif isinstance(val, tuple):
-      new_vars[key] = list(val)
-    elif isinstance(val, (int, long, float, str, list, NoneType)):
+      new_vars[key] = [_convert_list_item(v) for v in sorted(val)]
+    elif isinstance(val, (tuple, list)):
+      new_vars[key] = [_convert_list_item(v) for v in val]
+    elif isinstance(val, (int, long, float, str, NoneType)):
       new_vars[key] = val
     else:
       # NOTE(msolomon) begrudgingly I allow this - we just have too much code
@@ -0,0 +1,288 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Read-only vtgate connection with hedged requests.
+
+HedgedVTGateConnection sends a read to one vtgate. If it hasn't
+answered after the hedge delay (a percentile of the recent read
+latencies), the same read is sent to another vtgate, and the first
+successful reply wins. The losing call can't be interrupted: it is
+abandoned, and its connection is closed when it returns. The hedged
+calls are limited by a token bucket: each call adds max_hedge_ratio
+token, up to hedge_burst tokens, and each hedge takes one. A long
+healthy period can't bank more than hedge_burst hedges for a slowdown.
+
+This is only for non-transactional reads from replicas: the
+connection refuses transactions and dmls.
+"""
+
+import collections
+import logging
+import Queue
+import random
+import threading
+import time
+
+from vtdb import dbexceptions
+from vtdb import shard_constants
+from vtdb import vtgate_cursor
+from vtdb import vtgatev2
+
+
+# Number of latency samples needed before the percentile is used as
+# the hedge delay.
+MIN_LATENCY_SAMPLES = 20
+
+
+class _Race(object):
+  """Shared state of the attempts of one hedged call."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.done = False
+    self.results = Queue.Queue()
+
+
+class HedgedVTGateConnection(object):
+  """Connection to several vtgates, hedging the reads among them.
+
+  Like VTGateConnection, it serves one call at a time.
+
+  Attributes:
+    hedge_percentile: the hedge delay is this percentile of the recent
+      call latencies.
+    initial_hedge_delay: hedge delay in seconds, until enough latencies
+      are known.
+    min_hedge_delay: lower bound of the hedge delay, in seconds.
+    max_hedge_ratio: maximum ratio of hedged calls.
+    hedge_burst: maximum number of hedged calls in a row.
+    hedge_tokens: number of hedged calls currently allowed.
+    calls, hedges, hedge_wins: counters.
+  """
+  session = None
+
+  def __init__(self, vtgate_addrs, timeout, hedge_percentile=95.0,
+               initial_hedge_delay=0.05, min_hedge_delay=0.005,
+               max_hedge_ratio=0.05, hedge_burst=10, latency_window=1000,
+               encrypted=False, user=None, password=None):
+    self.addrs = [params['addr'] for params in vtgatev2.get_params_for_vtgate_conn(
+        vtgate_addrs, timeout, encrypted=encrypted, user=user,
+        password=password)]
+    if not self.addrs:
+      raise dbexceptions.OperationalError(
+          "no vtgate addrs in {0!s}".format(vtgate_addrs))
+    self.timeout = timeout
+    self.encrypted = encrypted
+    self.user = user
+    self.password = password
+    self.hedge_percentile = hedge_percentile
+    self.initial_hedge_delay = initial_hedge_delay
+    self.min_hedge_delay = min_hedge_delay
+    self.max_hedge_ratio = max_hedge_ratio
+    self.hedge_burst = hedge_burst
+    self.hedge_tokens = float(hedge_burst)
+    self.latencies = collections.deque(maxlen=latency_window)
+    self.calls = 0
+    self.hedges = 0
+    self.hedge_wins = 0
+    # addr -> idle VTGateConnection
+    self.idle = {}
+    self._stream_conn = None
+    self._closed = False
+
+  def __str__(self):
+    return '<HedgedVTGateConnection {0!s} >'.format(','.join(self.addrs))
+
+  def dial(self):
+    self._closed = False
+
+  def close(self):
+    self._closed = True
+    idle, self.idle = self.idle, {}
+    for conn in idle.itervalues():
+      conn.close()
+    if self._stream_conn is not None:
+      self._stream_conn.close()
+      self._stream_conn = None
+
+  def is_closed(self):
+    return self._closed
+
+  def cursor(self, *pargs, **kwargs):
+    cursorclass = kwargs.pop('cursorclass', None) or vtgate_cursor.VTGateCursor
+    return cursorclass(self, *pargs, **kwargs)
+
+  def begin(self):
+    raise dbexceptions.ProgrammingError(
+        "Transactions are not supported on a hedged connection.")
+
+  def commit(self):
+    raise dbexceptions.ProgrammingError(
+        "Transactions are not supported on a hedged connection.")
+
+  def rollback(self):
+    raise dbexceptions.ProgrammingError(
+        "Transactions are not supported on a hedged connection.")
+
+  def hedge_delay(self):
+    if len(self.latencies) < MIN_LATENCY_SAMPLES:
+      return max(self.min_hedge_delay, self.initial_hedge_delay)
+    latencies = sorted(self.latencies)
+    index = min(len(latencies) - 1,
+                int(len(latencies) * self.hedge_percentile / 100.0))
+    return max(self.min_hedge_delay, latencies[index])
+
+  def _can_hedge(self):
+    if len(self.addrs) < 2:
+      return False
+    return self.hedge_tokens >= 1.0
+
+  def _get_conn(self, addr):
+    conn = self.idle.pop(addr, None)
+    if conn is not None and not conn.is_closed():
+      return conn
+    return vtgatev2.connect([addr], self.timeout, encrypted=self.encrypted,
+                            user=self.user, password=self.password)
+
+  def _release_conn(self, addr, conn):
+    if conn.is_closed():
+      return
+    if self._closed or addr in self.idle:
+      conn.close()
+      return
+    self.idle[addr] = conn
+
+  def _check_read(self, sql_list, tablet_type):
+    if tablet_type == shard_constants.TABLET_TYPE_MASTER:
+      raise dbexceptions.ProgrammingError(
+          "Hedged connections only read from replicas.")
+    for sql in sql_list:
+      if vtgate_cursor.write_sql_pattern.match(sql):
+        raise dbexceptions.ProgrammingError(
+            "Dmls are not allowed on a hedged connection.", sql)
+
+  def _attempt(self, race, addr, method, pargs, kwargs):
+    conn = None
+    try:
+      conn = self._get_conn(addr)
+      result = getattr(conn, method)(*pargs, **kwargs)
+      outcome = (addr, conn, result, None)
+    except Exception as e:
+      outcome = (addr, conn, None, e)
+    with race.lock:
+      if not race.done:
+        race.results.put(outcome)
+        return
+    # This attempt lost the race.
+    if conn is not None:
+      conn.close()
+
+  def _start_attempt(self, race, addr, method, pargs, kwargs):
+    t = threading.Thread(target=self._attempt,
+                         args=(race, addr, method, pargs, kwargs),
+                         name='hedged_vtgate_attempt')
+    t.daemon = True
+    t.start()
+
+  def _hedged_call(self, method, *pargs, **kwargs):
+    if self._closed:
+      raise dbexceptions.ProgrammingError("Connection is closed.")
+    self.calls += 1
+    self.hedge_tokens = min(float(self.hedge_burst),
+                            self.hedge_tokens + self.max_hedge_ratio)
+    start = time.time()
+    race = _Race()
+    primary = self.addrs[0]
+    self._start_attempt(race, primary, method, pargs, kwargs)
+    pending = 1
+    hedged = False
+    first_error = None
+    while True:
+      try:
+        timeout = None
+        if not hedged:
+          timeout = max(0.0, start + self.hedge_delay() - time.time())
+        addr, conn, result, error = race.results.get(timeout=timeout)
+      except Queue.Empty:
+        hedged = True
+        if self._can_hedge():
+          self.hedges += 1
+          self.hedge_tokens -= 1.0
+          self._start_attempt(race, random.choice(self.addrs[1:]), method,
+                              pargs, kwargs)
+          pending += 1
+        continue
+      pending -= 1
+      if error is None:
+        break
+      if conn is not None:
+        conn.close()
+      if first_error is None:
+        first_error = error
+      if not pending:
+        raise first_error
+      # Wait for the other attempt, without hedging again.
+      hedged = True
+
+    with race.lock:
+      race.done = True
+    self.latencies.append(time.time() - start)
+    if addr != primary:
+      # Stick to the vtgate that answered first.
+      self.hedge_wins += 1
+      self.addrs.remove(addr)
+      self.addrs.insert(0, addr)
+      logging.debug('hedged call to %s won over %s', addr, primary)
+    self._release_conn(addr, conn)
+    return result
+
+  def _execute(self, sql, bind_variables, keyspace, tablet_type,
+               keyspace_ids=None, keyranges=None, not_in_transaction=False,
+               shards=None):
+    self._check_read([sql], tablet_type)
+    return self._hedged_call('_execute', sql, bind_variables, keyspace,
+                             tablet_type, keyspace_ids=keyspace_ids,
+                             keyranges=keyranges,
+                             not_in_transaction=not_in_transaction,
+                             shards=shards)
+
+  def _execute_entity_ids(self, sql, bind_variables, keyspace, tablet_type,
+                          entity_keyspace_id_map, entity_column_name,
+                          not_in_transaction=False):
+    self._check_read([sql], tablet_type)
+    return self._hedged_call('_execute_entity_ids', sql, bind_variables,
+                             keyspace, tablet_type, entity_keyspace_id_map,
+                             entity_column_name,
+                             not_in_transaction=not_in_transaction)
+
+  def _execute_batch(self, sql_list, bind_variables_list, keyspace,
+                     tablet_type, keyspace_ids, not_in_transaction=False,
+                     shards=None):
+    self._check_read(sql_list, tablet_type)
+    return self._hedged_call('_execute_batch', sql_list, bind_variables_list,
+                             keyspace, tablet_type, keyspace_ids,
+                             not_in_transaction=not_in_transaction,
+                             shards=shards)
+
+  # Streaming queries are not hedged, they use the primary vtgate.
+  def _stream_execute(self, sql, bind_variables, keyspace, tablet_type,
+                      keyspace_ids=None, keyranges=None,
+                      not_in_transaction=False, shards=None):
+    self._check_read([sql], tablet_type)
+    if self._stream_conn is not None:
+      self._stream_conn.close()
+    self._stream_conn = self._get_conn(self.addrs[0])
+    return self._stream_conn._stream_execute(
+        sql, bind_variables, keyspace, tablet_type, keyspace_ids=keyspace_ids,
+        keyranges=keyranges, not_in_transaction=not_in_transaction,
+        shards=shards)
+
+  def _stream_next(self):
+    if self._stream_conn is None:
+      return None
+    row = self._stream_conn._stream_next()
+    if row is None:
+      self._release_conn(self._stream_conn.addr, self._stream_conn)
+      self._stream_conn = None
+    return row
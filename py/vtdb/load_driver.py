@@ -0,0 +1,358 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Client-side load driver for the vitess python clients.
+
+This runs a number of worker threads, each with its own connection,
+issuing the same operation in a loop, and reports the throughput and
+latency percentiles. Without --server, a fake_vtgate is started (in
+this process, or in a child process with --fork) so client-side
+throughput can be measured without the Go stack:
+
+  python load_driver.py --client vtgatev2 --op execute --threads 4 --fork
+"""
+
+import logging
+import optparse
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from vtdb import cursorv3
+from vtdb import fake_vtgate
+from vtdb import keyrange
+from vtdb import keyrange_constants
+from vtdb import tablet
+from vtdb import vtgate_cursor
+from vtdb import vtgatev2
+from vtdb import vtgatev3
+from zk import zkocc
+
+
+CLIENTS = ('vtgatev2', 'vtgatev3', 'tablet', 'zkocc')
+OPS = ('execute', 'stream', 'batch', 'txn')
+
+SELECT_SQL = 'select id, msg from load_test where id = %(id)s'
+INSERT_SQL = 'insert into load_test (id, msg) values (%(id)s, %(msg)s)'
+
+pack_keyspace_id = struct.Struct('!Q').pack
+
+
+class LoadStats(object):
+  """Collects the latencies and errors of all the workers."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latencies = []
+    self.errors = 0
+    self.elapsed = 0.0
+
+  def add(self, latencies, errors):
+    with self.lock:
+      self.latencies.extend(latencies)
+      self.errors += errors
+
+  def percentile(self, sorted_latencies, p):
+    if not sorted_latencies:
+      return 0.0
+    index = min(len(sorted_latencies) - 1, int(len(sorted_latencies) * p / 100.0))
+    return sorted_latencies[index]
+
+  def report(self):
+    elapsed = self.elapsed
+    latencies = sorted(self.latencies)
+    count = len(latencies)
+    lines = ['requests: {0:d} errors: {1:d} elapsed: {2:0.2f}s qps: {3:0.1f}'.format(
+        count, self.errors, elapsed, count / elapsed if elapsed else 0.0)]
+    for p in (50, 90, 99, 99.9):
+      lines.append('p{0!s}: {1:0.3f}ms'.format(
+          p, self.percentile(latencies, p) * 1000))
+    if latencies:
+      lines.append('max: {0:0.3f}ms'.format(latencies[-1] * 1000))
+    return '\n'.join(lines)
+
+
+class ClientDriver(object):
+  """Base class for a connection issuing one kind of operation."""
+
+  def __init__(self, addr, options):
+    self.addr = addr
+    self.options = options
+    self.keyspace = options.keyspace
+    self.tablet_type = options.tablet_type
+    self.timeout = options.timeout
+    self.conn = None
+
+  def connect(self):
+    raise NotImplementedError
+
+  def close(self):
+    if self.conn is not None:
+      self.conn.close()
+      self.conn = None
+
+  def run_op(self, op, i):
+    getattr(self, op)(i)
+
+  def execute(self, i):
+    raise NotImplementedError
+
+  def stream(self, i):
+    raise NotImplementedError
+
+  def batch(self, i):
+    raise NotImplementedError
+
+  def txn(self, i):
+    raise NotImplementedError
+
+
+class VTGateV2Driver(ClientDriver):
+
+  def connect(self):
+    self.conn = vtgatev2.connect([self.addr], self.timeout)
+    self.keyspace_ids = [pack_keyspace_id(1)]
+
+  def execute(self, i):
+    cursor = self.conn.cursor(self.keyspace, self.tablet_type,
+                              keyspace_ids=self.keyspace_ids)
+    cursor.execute(SELECT_SQL, {'id': i})
+    cursor.fetchall()
+
+  def stream(self, i):
+    cursor = self.conn.cursor(
+        self.keyspace, self.tablet_type,
+        keyranges=[keyrange.KeyRange(keyrange_constants.NON_PARTIAL_KEYRANGE)],
+        cursorclass=vtgate_cursor.StreamVTGateCursor)
+    cursor.execute(SELECT_SQL, {'id': i})
+    cursor.fetchall()
+
+  def batch(self, i):
+    cursor = self.conn.cursor(self.keyspace, self.tablet_type,
+                              keyspace_ids=self.keyspace_ids,
+                              cursorclass=vtgate_cursor.BatchVTGateCursor)
+    for j in xrange(self.options.batch_size):
+      cursor.execute(SELECT_SQL, {'id': i + j})
+    cursor.flush()
+
+  def txn(self, i):
+    cursor = self.conn.cursor(self.keyspace, 'master',
+                              keyspace_ids=self.keyspace_ids, writable=True)
+    cursor.begin()
+    cursor.execute(INSERT_SQL, {'id': i, 'msg': 'load test'})
+    cursor.commit()
+
+
+class VTGateV3Driver(ClientDriver):
+
+  def connect(self):
+    self.conn = vtgatev3.connect(self.addr, self.timeout)
+
+  # vtgatev3 expects the :name bind variable syntax.
+  def execute(self, i):
+    cursor = self.conn.cursor(self.tablet_type)
+    cursor.execute('select id, msg from load_test where id = :id', {'id': i})
+    cursor.fetchall()
+
+  def stream(self, i):
+    cursor = self.conn.cursor(self.tablet_type, cursorclass=cursorv3.StreamCursor)
+    cursor.execute('select id, msg from load_test where id = :id', {'id': i})
+    cursor.fetchall()
+
+  def batch(self, i):
+    sql_list = ['select id, msg from load_test where id = :id'] * self.options.batch_size
+    bind_vars_list = [{'id': i + j} for j in xrange(self.options.batch_size)]
+    self.conn._execute_batch(sql_list, bind_vars_list, self.tablet_type)
+
+  def txn(self, i):
+    cursor = self.conn.cursor('master')
+    cursor.begin()
+    cursor.execute('insert into load_test (id, msg) values (:id, :msg)',
+                   {'id': i, 'msg': 'load test'})
+    cursor.commit()
+
+
+class TabletDriver(ClientDriver):
+
+  def connect(self):
+    self.conn = tablet.connect(self.addr, self.tablet_type, self.keyspace,
+                               '0', self.timeout)
+
+  # the tablet connection expects the :name bind variable syntax.
+  def execute(self, i):
+    self.conn._execute('select id, msg from load_test where id = :id', {'id': i})
+
+  def stream(self, i):
+    self.conn._stream_execute('select id, msg from load_test where id = :id', {'id': i})
+    while self.conn._stream_next() is not None:
+      pass
+
+  def batch(self, i):
+    sql_list = ['select id, msg from load_test where id = :id'] * self.options.batch_size
+    bind_vars_list = [{'id': i + j} for j in xrange(self.options.batch_size)]
+    self.conn._execute_batch(sql_list, bind_vars_list)
+
+  def txn(self, i):
+    self.conn.begin()
+    self.conn._execute('insert into load_test (id, msg) values (:id, :msg)',
+                       {'id': i, 'msg': 'load test'})
+    self.conn.commit()
+
+
+class ZkOccDriver(ClientDriver):
+  """zkocc only has reads: every op reads the SrvKeyspace and end points."""
+
+  def connect(self):
+    self.conn = zkocc.ZkOccConnection(self.addr, 'test_nj', self.timeout)
+    self.conn.dial()
+
+  def execute(self, i):
+    self.conn.get_srv_keyspace('local', self.keyspace)
+
+  def stream(self, i):
+    self.conn.get_end_points('local', self.keyspace, '-80', self.tablet_type)
+
+  def batch(self, i):
+    self.conn.get_srv_keyspace_names('local')
+    self.conn.get_srv_keyspace('local', self.keyspace)
+
+  def txn(self, i):
+    self.execute(i)
+
+
+DRIVERS = {
+    'vtgatev2': VTGateV2Driver,
+    'vtgatev3': VTGateV3Driver,
+    'tablet': TabletDriver,
+    'zkocc': ZkOccDriver,
+}
+
+
+def worker(driver, op, deadline, request_count, stats, worker_id):
+  latencies = []
+  errors = 0
+  i = worker_id * 1000000
+  try:
+    driver.connect()
+  except Exception as e:
+    logging.error('worker %d: cannot connect: %s', worker_id, e)
+    stats.add([], 1)
+    return
+  while True:
+    if deadline and time.time() >= deadline:
+      break
+    if request_count and len(latencies) + errors >= request_count:
+      break
+    i += 1
+    start = time.time()
+    try:
+      driver.run_op(op, i)
+      latencies.append(time.time() - start)
+    except Exception as e:
+      errors += 1
+      logging.debug('worker %d: %s failed: %s', worker_id, op, e)
+      # connections are not reusable after most errors, redial.
+      try:
+        driver.close()
+        driver.connect()
+      except Exception as e:
+        logging.error('worker %d: cannot reconnect: %s', worker_id, e)
+        break
+  driver.close()
+  stats.add(latencies, errors)
+
+
+def fork_fake_vtgate(options):
+  """Starts fake_vtgate.py in a child process, returns (process, addr)."""
+  args = [sys.executable, fake_vtgate.__file__.replace('.pyc', '.py'),
+          '--rows', str(options.row_count),
+          '--row-size', str(options.row_size),
+          '--stream-batch-size', str(options.stream_batch_size),
+          '--latency', str(options.latency),
+          '--error-rate', str(options.error_rate)]
+  proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+  port = int(proc.stdout.readline())
+  return proc, 'localhost:{0:d}'.format(port)
+
+
+def run(options):
+  """Runs the load test described by options, returns the LoadStats."""
+  server = None
+  proc = None
+  addr = options.server
+  if not addr:
+    if options.fork:
+      proc, addr = fork_fake_vtgate(options)
+    else:
+      server, _ = fake_vtgate.start_server(
+          **fake_vtgate.fake_vtgate_params(options))
+      addr = server.addr
+
+  stats = LoadStats()
+  deadline = None
+  if options.duration:
+    deadline = time.time() + options.duration
+  threads = []
+  start = time.time()
+  try:
+    for worker_id in xrange(options.threads):
+      driver = DRIVERS[options.client](addr, options)
+      t = threading.Thread(target=worker,
+                           args=(driver, options.op, deadline,
+                                 options.requests, stats, worker_id),
+                           name='load_worker_{0:d}'.format(worker_id))
+      t.daemon = True
+      threads.append(t)
+      t.start()
+    for t in threads:
+      t.join()
+  finally:
+    stats.elapsed = time.time() - start
+    if server:
+      server.stop()
+    if proc:
+      proc.terminate()
+      proc.wait()
+  return stats
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--client', type='choice', choices=CLIENTS,
+                    default='vtgatev2', help='Client to load: ' + ', '.join(CLIENTS))
+  parser.add_option('--op', type='choice', choices=OPS, default='execute',
+                    help='Operation to issue: ' + ', '.join(OPS))
+  parser.add_option('--server', type='string', default='',
+                    help='host:port of the server to load. If empty, a '
+                    'fake vtgate is started.')
+  parser.add_option('--fork', action='store_true', default=False,
+                    help='Run the fake vtgate in a child process, so it '
+                    'does not share the GIL with the client.')
+  parser.add_option('--threads', type='int', default=1,
+                    help='Number of concurrent workers, one connection each.')
+  parser.add_option('--duration', type='float', default=10.0,
+                    help='Test duration in seconds, 0 to use --requests.')
+  parser.add_option('--requests', type='int', default=0,
+                    help='Number of requests per worker, 0 for no limit.')
+  parser.add_option('--batch-size', type='int', default=10, dest='batch_size',
+                    help='Number of queries per batch for --op batch.')
+  parser.add_option('--keyspace', type='string', default=fake_vtgate.DEFAULT_KEYSPACE)
+  parser.add_option('--tablet-type', type='string', default='replica',
+                    dest='tablet_type')
+  parser.add_option('--timeout', type='float', default=30.0,
+                    help='Connection timeout in seconds.')
+  fake_vtgate.add_options(parser)
+  (options, args) = parser.parse_args()
+  if not options.duration and not options.requests:
+    parser.error('one of --duration or --requests is required')
+
+  logging.basicConfig(level=logging.WARNING)
+  stats = run(options)
+  print '{0!s} {1!s} threads={2:d}'.format(options.client, options.op, options.threads)
+  print stats.report()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,123 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""In-process cache for entity id to sharding key lookups.
+
+Lookup relationships almost never change, so the range-sharded db
+classes can skip the lookup table query when a LookupDBObject has a
+LookupCache. Entries expire after a TTL and are dropped locally when
+the lookup relationship is updated or deleted through LookupDBObject.
+Changes made by other processes are only seen after the TTL.
+
+The keys are (lookup table name, column, entity id), so one cache can
+be shared by several lookup classes.
+"""
+
+import collections
+import threading
+import time
+
+
+class LookupCache(object):
+  """Bounded LRU cache with a TTL, indexed by value for invalidation.
+
+  Attributes:
+    capacity: maximum number of entries.
+    ttl: lifetime of an entry in seconds.
+    generation: incremented by each invalidation, see put.
+    hits, misses, evictions, invalidations: counters.
+  """
+
+  def __init__(self, capacity=10000, ttl=300.0):
+    self.capacity = capacity
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    # key -> (value, expiry time), least recently used first.
+    self.entries = collections.OrderedDict()
+    # value -> set of keys, for invalidate_value.
+    self.keys_by_value = {}
+    self.generation = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  def get(self, key):
+    """Returns the cached value for key, or None."""
+    with self.lock:
+      try:
+        value, expiry = self.entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return None
+      if expiry < time.time():
+        self._unindex(key, value)
+        self.misses += 1
+        return None
+      self.entries[key] = (value, expiry)
+      self.hits += 1
+      return value
+
+  def put(self, key, value, generation):
+    """Caches value for key.
+
+    generation is the value of the generation attribute read before the
+    lookup query. The put is ignored if there was an invalidation in
+    between, so a mapping read before a change can't be cached after it.
+    """
+    with self.lock:
+      if generation != self.generation:
+        return
+      if key in self.entries:
+        self._unindex(key, self.entries.pop(key)[0])
+      self.entries[key] = (value, time.time() + self.ttl)
+      self.keys_by_value.setdefault(value, set()).add(key)
+      while len(self.entries) > self.capacity:
+        old_key, (old_value, _) = self.entries.popitem(last=False)
+        self._unindex(old_key, old_value)
+        self.evictions += 1
+
+  def invalidate(self, key):
+    with self.lock:
+      self.generation += 1
+      if key in self.entries:
+        self._unindex(key, self.entries.pop(key)[0])
+        self.invalidations += 1
+
+  def invalidate_value(self, value):
+    """Drops all the entries that map to value."""
+    with self.lock:
+      self.generation += 1
+      for key in self.keys_by_value.pop(value, ()):
+        del self.entries[key]
+        self.invalidations += 1
+
+  def clear(self):
+    with self.lock:
+      self.generation += 1
+      self.entries.clear()
+      self.keys_by_value.clear()
+
+  def _unindex(self, key, value):
+    keys = self.keys_by_value.get(value)
+    if keys is not None:
+      keys.discard(key)
+      if not keys:
+        del self.keys_by_value[value]
+
+  @property
+  def hit_ratio(self):
+    total = self.hits + self.misses
+    if not total:
+      return 0.0
+    return float(self.hits) / total
+
+  def stats(self):
+    with self.lock:
+      return {'Size': len(self.entries),
+              'Hits': self.hits,
+              'Misses': self.misses,
+              'Evictions': self.evictions,
+              'Invalidations': self.invalidations,
+              'HitRatio': self.hit_ratio}
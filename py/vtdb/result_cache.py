@@ -0,0 +1,250 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Client-side cache of replica query results.
+
+ResultCache keeps the rows of replica reads in process, in LRU order,
+up to a total size. A db class opts in by setting its result_cache
+attribute. Entries are dropped by table, or by primary key for the
+reads that select one row by id_column_name.
+
+UpdateStreamInvalidator follows the update stream of a tablet and
+invalidates the cache as the DMLs and DDLs go by. It disables the
+cache while it is not connected, since changes may be missed, and
+keeps track of the invalidation lag.
+
+A shared cache backend can be used instead of ResultCache as long as it
+provides the same get, put, generation, invalidate_rows,
+invalidate_table, clear and active members.
+"""
+
+import collections
+import threading
+import time
+
+from vtdb import update_stream_service
+
+
+# Default lifetime of the entries, in seconds.
+DEFAULT_TTL = 60.0
+
+
+def _rows_size(rows):
+  # Approximate in-memory size, enough to bound the cache.
+  return sum(sum(len(str(v)) for v in row) + 16 for row in rows) + 64
+
+
+class ResultCache(object):
+  """LRU cache of query results, bounded by their approximate size.
+
+  The entries must expire: the invalidations come from the update
+  stream of one tablet, but vtgate may send a replica read to a replica
+  that lags more. Such a read can return rows older than the last
+  invalidation, which then stay cached until they expire.
+
+  Invalidation by primary key only drops an entry if the primary key
+  values of the update stream are equal to the bind values of the read,
+  with the same python type (e.g. long ids are not equal to their
+  string form). Otherwise the entry is only dropped by a table
+  invalidation or when it expires.
+
+  Attributes:
+    max_bytes: maximum total size of the cached rows.
+    ttl: lifetime of an entry in seconds.
+    active: the cache is bypassed when False.
+    hits, misses, evictions, invalidations: counters.
+  """
+
+  def __init__(self, max_bytes=64 * 1024 * 1024, ttl=DEFAULT_TTL):
+    if ttl is None or ttl <= 0:
+      raise ValueError('ResultCache needs a positive ttl, got {0!r}'.format(ttl))
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.active = True
+    self.lock = threading.Lock()
+    # key -> (table_name, pk, rows, size, expiry), least recently used first.
+    self.entries = collections.OrderedDict()
+    # table_name -> {pk: set of keys}. Entries that are not for a single
+    # primary key are indexed under None.
+    self.keys_by_table = {}
+    # table_name -> number of invalidations, see generation.
+    self.generations = collections.defaultdict(int)
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  def generation(self, table_name):
+    """Returns a token to pass to put, taken before running the query.
+
+    A put is ignored if the table was invalidated in between, so a
+    result read before a change can't be cached after it.
+    """
+    return self.generations[table_name]
+
+  def get(self, key):
+    if not self.active:
+      return None
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return None
+      if entry[4] < time.time():
+        self._unindex(key, entry)
+        self.misses += 1
+        return None
+      self.entries[key] = entry
+      self.hits += 1
+      return entry[2]
+
+  def put(self, table_name, key, rows, generation, pk=None):
+    if not self.active:
+      return
+    size = _rows_size(rows)
+    if size > self.max_bytes:
+      return
+    expiry = time.time() + self.ttl
+    with self.lock:
+      if self.generations[table_name] != generation:
+        return
+      old_entry = self.entries.pop(key, None)
+      if old_entry is not None:
+        self._unindex(key, old_entry)
+      self.entries[key] = (table_name, pk, rows, size, expiry)
+      self.keys_by_table.setdefault(table_name, {}).setdefault(pk, set()).add(key)
+      self.size += size
+      while self.size > self.max_bytes:
+        old_key, old_entry = self.entries.popitem(last=False)
+        self._unindex(old_key, old_entry)
+        self.evictions += 1
+
+  def invalidate_rows(self, table_name, pks):
+    """Drops the entries of the primary keys, and the non-pk entries."""
+    with self.lock:
+      self.generations[table_name] += 1
+      table_keys = self.keys_by_table.get(table_name)
+      if not table_keys:
+        return
+      for pk in list(pks) + [None]:
+        for key in table_keys.pop(pk, ()):
+          self._drop(key)
+      if not table_keys:
+        del self.keys_by_table[table_name]
+
+  def invalidate_table(self, table_name):
+    with self.lock:
+      self.generations[table_name] += 1
+      for keys in self.keys_by_table.pop(table_name, {}).itervalues():
+        for key in keys:
+          self._drop(key)
+
+  def clear(self):
+    with self.lock:
+      for table_name in self.keys_by_table:
+        self.generations[table_name] += 1
+      self.entries.clear()
+      self.keys_by_table.clear()
+      self.size = 0
+
+  def _drop(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      self.size -= entry[3]
+      self.invalidations += 1
+
+  def _unindex(self, key, entry):
+    table_name, pk, _, size, _ = entry
+    self.size -= size
+    table_keys = self.keys_by_table.get(table_name)
+    if table_keys is None:
+      return
+    keys = table_keys.get(pk)
+    if keys is not None:
+      keys.discard(key)
+      if not keys:
+        del table_keys[pk]
+    if not table_keys:
+      del self.keys_by_table[table_name]
+
+  def stats(self):
+    with self.lock:
+      total = self.hits + self.misses
+      return {'Size': self.size,
+              'Entries': len(self.entries),
+              'Hits': self.hits,
+              'Misses': self.misses,
+              'Evictions': self.evictions,
+              'Invalidations': self.invalidations,
+              'HitRatio': float(self.hits) / total if total else 0.0}
+
+
+class UpdateStreamInvalidator(object):
+  """Invalidates a ResultCache from an update stream, in a thread.
+
+  Attributes:
+    position: replication position the stream is (re)started from.
+    lag: seconds between the last DML or DDL and its invalidation.
+  """
+
+  def __init__(self, cache, connection_factory, position,
+               position_append=None, retry_delay=1.0):
+    """Creates the invalidator, call start to run it.
+
+    Args:
+      cache: the ResultCache to invalidate.
+      connection_factory: returns a new UpdateStreamConnection.
+      position: replication position to start from.
+      position_append: function(position, gtid_field) that returns the
+        position after a POS event, mysql_flavor specific. Without it,
+        reconnections restart from the initial position.
+      retry_delay: seconds to wait before reconnecting.
+    """
+    self.cache = cache
+    self.lag = None
+    self.events = 0
+    self.reader = update_stream_service.UpdateStreamReader(
+        connection_factory, position, self.process_event,
+        position_append=position_append, retry_delay=retry_delay,
+        on_connect=self._connected, on_disconnect=self._disconnected,
+        name='update_stream_invalidator')
+    # Nothing is invalidated until the stream is connected.
+    self.cache.active = False
+
+  def start(self):
+    self.reader.start()
+
+  def stop(self):
+    self.reader.stop()
+
+  @property
+  def position(self):
+    return self.reader.position
+
+  def _connected(self):
+    self.cache.active = True
+
+  def _disconnected(self):
+    # Changes may be missed until the stream is back.
+    self.cache.active = False
+    self.cache.clear()
+
+  def process_event(self, event):
+    """Applies one update stream event, as returned by stream_next."""
+    self.events += 1
+    category = event['Category']
+    if category == 'DML':
+      pks = [tuple(value for _, value in pk_row) for pk_row in event['PkRows']]
+      if pks:
+        self.cache.invalidate_rows(event['TableName'], pks)
+      else:
+        self.cache.invalidate_table(event['TableName'])
+    elif category == 'DDL':
+      # The table name isn't known for DDLs.
+      self.cache.clear()
+    elif category == 'POS':
+      return
+    if event.get('Timestamp'):
+      self.lag = max(0.0, time.time() - event['Timestamp'])
@@ -0,0 +1,244 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Parallel, restartable export of a table using vtgate SplitQuery.
+
+SplitQueryExport cuts a query into primary key range splits with
+VTGateConnection.split_query, and streams the splits on a pool of
+worker threads, each with its own connection. The rows are returned
+by an iterator, either in split order or as they arrive.
+
+With a checkpoint, the list of splits and the splits already
+consumed are saved, so an interrupted export resumes with the
+remaining splits. A split is only marked done once all its rows have
+been returned by the iterator. The rows of a split that was being
+consumed when the export stopped are returned again on resume.
+"""
+
+import cPickle
+import logging
+import os
+import Queue
+import threading
+
+from vtdb import shard_constants
+
+
+# Marks the end of the rows of a split in a queue.
+_SPLIT_DONE = object()
+
+
+class _SplitError(object):
+
+  def __init__(self, error):
+    self.error = error
+
+
+class FileCheckpoint(object):
+  """Keeps the state of an export in a local file.
+
+  The state is pickled, the file should not be shared with untrusted
+  processes.
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+  def load(self):
+    """Returns the saved state, or None if there is none."""
+    try:
+      with open(self.path, 'rb') as f:
+        return cPickle.load(f)
+    except IOError:
+      return None
+
+  def save(self, state):
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, self.path)
+
+
+class SplitQueryExport(object):
+  """Streams the rows of a query, split by vtgate, in parallel.
+
+  Attributes:
+    splits: the splits of the query, see VTGateConnection.split_query.
+    done: set of the indexes of the splits already consumed.
+    fields: the fields of the rows, once the first split has started.
+  """
+
+  def __init__(self, connection_factory, keyspace, sql, bind_variables=None,
+               split_count=16, tablet_type=shard_constants.TABLET_TYPE_BATCH,
+               num_workers=4, ordered=False, checkpoint=None,
+               queue_size=1000):
+    """Creates the export, iterate over rows() to run it.
+
+    Args:
+      connection_factory: returns a new dialed VTGateConnection.
+      keyspace: keyspace of the table.
+      sql: select query on one table.
+      bind_variables: bind variables of sql.
+      split_count: desired number of splits.
+      tablet_type: tablet type the splits are streamed from.
+      num_workers: number of splits streamed concurrently.
+      ordered: if True, the rows are returned split after split, in the
+        order of the splits. Otherwise they are returned as they arrive.
+      checkpoint: optional object with load() and save(state) methods,
+        such as FileCheckpoint, to resume an interrupted export.
+      queue_size: maximum number of rows buffered per split (ordered)
+        or overall (unordered).
+    """
+    self.connection_factory = connection_factory
+    self.keyspace = keyspace
+    self.sql = sql
+    self.bind_variables = bind_variables
+    self.split_count = split_count
+    self.tablet_type = tablet_type
+    self.num_workers = num_workers
+    self.ordered = ordered
+    self.checkpoint = checkpoint
+    self.queue_size = queue_size
+    self.splits = None
+    self.done = set()
+    self.fields = None
+    self.stopped = False
+
+  def _load_splits(self):
+    state = None
+    if self.checkpoint is not None:
+      state = self.checkpoint.load()
+    if state is not None:
+      self.splits = state['splits']
+      self.done = set(state['done'])
+      logging.info('resuming export with %d of %d splits done',
+                   len(self.done), len(self.splits))
+      return
+    conn = self.connection_factory()
+    try:
+      self.splits = conn.split_query(self.sql, self.bind_variables,
+                                     self.keyspace, self.split_count)
+    finally:
+      conn.close()
+    self.done = set()
+    self._save()
+
+  def _save(self):
+    if self.checkpoint is not None:
+      self.checkpoint.save({'splits': self.splits, 'done': sorted(self.done)})
+
+  def _put(self, queue, item):
+    # Gives up when the consumer stopped iterating.
+    while not self.stopped:
+      try:
+        queue.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def _worker(self, tasks, queues):
+    conn = None
+    try:
+      while not self.stopped:
+        try:
+          index = tasks.get_nowait()
+        except Queue.Empty:
+          return
+        queue = queues[index]
+        try:
+          if conn is None:
+            conn = self.connection_factory()
+          _, _, _, fields = conn._stream_execute_split(self.splits[index],
+                                                       self.tablet_type)
+          if self.fields is None:
+            self.fields = fields
+          while True:
+            row = conn._stream_next()
+            if row is None:
+              break
+            if not self._put(queue, (index, row)):
+              return
+        except Exception as e:
+          self._put(queue, (index, _SplitError(e)))
+          return
+        if not self._put(queue, (index, _SPLIT_DONE)):
+          return
+    finally:
+      if conn is not None:
+        conn.close()
+
+  def _split_done(self, index):
+    self.done.add(index)
+    self._save()
+
+  def rows(self):
+    """Runs the export, yields the rows of all the remaining splits.
+
+    Raises:
+      The first error of a split. The export can then be resumed with
+      the same checkpoint.
+    """
+    if self.splits is None:
+      self._load_splits()
+    pending = [i for i in xrange(len(self.splits)) if i not in self.done]
+    if not pending:
+      return
+
+    tasks = Queue.Queue()
+    for index in pending:
+      tasks.put(index)
+    if self.ordered:
+      queues = dict((index, Queue.Queue(self.queue_size)) for index in pending)
+    else:
+      shared_queue = Queue.Queue(self.queue_size)
+      queues = dict((index, shared_queue) for index in pending)
+
+    self.stopped = False
+    threads = [threading.Thread(target=self._worker, args=(tasks, queues),
+                                name='split_query_export')
+               for _ in xrange(min(self.num_workers, len(pending)))]
+    for t in threads:
+      t.daemon = True
+      t.start()
+    try:
+      if self.ordered:
+        # The splits are streamed in order, so the worker of the first
+        # pending split is always running.
+        for index in pending:
+          for row in self._split_rows(queues[index]):
+            yield row
+      else:
+        remaining = len(pending)
+        while remaining:
+          index, item = shared_queue.get()
+          if item is _SPLIT_DONE:
+            self._split_done(index)
+            remaining -= 1
+          elif isinstance(item, _SplitError):
+            raise item.error
+          else:
+            yield item
+    finally:
+      self.stopped = True
+      for t in threads:
+        t.join()
+
+  def _split_rows(self, queue):
+    while True:
+      index, item = queue.get()
+      if item is _SPLIT_DONE:
+        self._split_done(index)
+        return
+      if isinstance(item, _SplitError):
+        raise item.error
+      yield item
+
+  def __iter__(self):
+    return self.rows()
+
+  def stats(self):
+    if self.splits is None:
+      return {'Splits': 0, 'Done': 0}
+    return {'Splits': len(self.splits), 'Done': len(self.done)}
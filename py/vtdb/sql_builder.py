@@ -5,6 +5,9 @@ Helper classes and fucntions for building queries.
 
 import itertools
 import pprint
+import time
+
+from vtdb import field_types
 
 #TODO: add unit-tests for the methods and classes.
 #TODO: integration with SQL Alchemy ?
@@ -80,6 +83,13 @@ def build_values_clause(columns, bind_values):
   return ', '.join(clause_parts), bind_list
 
 
+# IN clauses bind the whole list as one list bind variable, which
+# dbapi.prepare_query_bind_vars renders as ::name. The query text then
+# doesn't depend on the number of items, and vtgate/vttablet can reuse
+# their cached plans. Set to False to bind each item separately.
+USE_LIST_BIND_VARS = True
+
+
 def build_in(column, items, alt_name=None, counter=None):
   """Build SQL IN statement and bind hash for use with pyformat."""
 
@@ -87,6 +97,11 @@ def build_in(column, items, alt_name=None, counter=None):
     raise ValueError('Called with empty "items"')
 
   base = alt_name if alt_name else column
+  if USE_LIST_BIND_VARS:
+    bind_name = choose_bind_name(base, counter=counter)
+    return ('{0!s} IN %({1!s})s'.format(column, bind_name),
+            {bind_name: field_types.List(items)})
+
   bind_list = make_bind_list(base, items, counter=counter)
 
   return ('{0!s} IN ({1!s})'.format(column,
@@ -292,6 +307,89 @@ def insert_query(table_name, columns_list, **bind_variables):
   return query, bind_variables
 
 
+def insert_rows_query(table_name, columns_list, rows_bind_variables):
+  """Builds a multi-row insert query.
+
+  Args:
+    table_name: table to insert into.
+    columns_list: columns of the table.
+    rows_bind_variables: list of bind variable dicts, one per row. All
+      the rows must set the same columns.
+
+  Returns:
+    query, bind_variables. The value of column c for the i-th row is
+    bound as c_i.
+  """
+  if not rows_bind_variables:
+    raise ValueError('Called with empty "rows_bind_variables"')
+
+  now = int(time.time())
+  insert_columns = None
+  values_clauses = []
+  bind_variables = {}
+  for i, row in enumerate(rows_bind_variables):
+    row_columns = []
+    clause_parts = []
+    for column in columns_list:
+      if column in row:
+        value = row[column]
+      elif column in ('time_created', 'time_updated'):
+        value = now
+      else:
+        continue
+      bind_name = '{0!s}_{1:d}'.format(column, i)
+      row_columns.append(column)
+      clause_parts.append('%({0!s})s'.format(bind_name))
+      bind_variables[bind_name] = value
+    if insert_columns is None:
+      insert_columns = row_columns
+    elif row_columns != insert_columns:
+      raise ValueError('All rows must set the same columns')
+    values_clauses.append('({0!s})'.format(', '.join(clause_parts)))
+
+  query = 'INSERT INTO {0!s} ({1!s}) VALUES {2!s}'.format(
+      table_name, colstr(insert_columns, bind=insert_columns),
+      ', '.join(values_clauses))
+  return query, bind_variables
+
+
+def _estimate_row_size(row):
+  # bind variable values are inlined by vttablet, so the statement
+  # grows by roughly the size of the values plus the separators.
+  return sum(len(str(value)) + 4 for value in row.itervalues()) + 4
+
+
+def insert_rows_queries(table_name, columns_list, rows_bind_variables,
+                        max_query_size):
+  """Splits rows into multi-row insert queries of bounded size.
+
+  Args:
+    table_name: table to insert into.
+    columns_list: columns of the table.
+    rows_bind_variables: list of bind variable dicts, one per row.
+    max_query_size: approximate upper bound, in bytes, of each query
+      once its bind variables are substituted. A single row larger
+      than that gets its own query.
+
+  Returns:
+    List of (query, bind_variables) tuples.
+  """
+  queries = []
+  chunk = []
+  chunk_size = 0
+  for row in rows_bind_variables:
+    row_size = _estimate_row_size(row)
+    if chunk and chunk_size + row_size > max_query_size:
+      queries.append(insert_rows_query(table_name, columns_list, chunk))
+      chunk = []
+      chunk_size = 0
+    chunk.append(row)
+    chunk_size += row_size
+  if chunk:
+    queries.append(insert_rows_query(table_name, columns_list, chunk))
+  return queries
+
+
 def build_aggregate_query(table_name, id_column_name, sort_func='min'):
   query_clause = 'SELECT %(id_col)s FROM %(table_name)s ORDER BY %(id_col)s'
   if sort_func == 'max':
@@ -310,7 +408,7 @@ def build_count_query(table_name, column_value_pairs):
 def choose_bind_name(base, counter=None):
   if counter:
     base += '_{0:d}'.format(counter.next())
-    return base
+  return base
 
 def make_bind_list(column, values, counter=None):
   result = []
@@ -440,6 +538,10 @@ class InValuesOperatorBase(SQLOperator):
 
   def build_sql(self, column_name, counter=None):
     op = self.op
+    if USE_LIST_BIND_VARS and self.value:
+      bind_name = choose_bind_name(column_name, counter=counter)
+      clause = '{column_name!s} {op!s} %({bind_name!s})s'.format(**vars())
+      return clause, {bind_name: field_types.List(self.value)}
     bind_list = make_bind_list(column_name, self.value, counter=counter)
     in_clause = ', '.join(('%(' + key + ')s') for key, val in bind_list)
     clause = '{column_name!s} {op!s} ({in_clause!s})'.format(**vars())
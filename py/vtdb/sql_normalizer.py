@@ -0,0 +1,216 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Client-side normalization of SQL literals into bind variables.
+
+vtgate and vttablet cache query plans by SQL text, so each distinct
+inlined literal makes a new plan. SQLNormalizer rewrites the integer
+and string literals of select, insert, update, delete and replace
+statements into generated bind variables, so that queries that only
+differ by their literals share a plan.
+
+Literals that must stay inline are left alone: LIMIT and OFFSET
+values, ORDER BY and GROUP BY positions, type lengths such as
+CHAR(10), typed literals such as DATE '2015-01-01', charset introducers,
+ESCAPE strings, and decimal, float and hex numbers. Identifiers,
+comments and existing bind variables are never changed.
+
+The normalized form of each SQL text is kept in an LRU cache. A cursor
+uses a normalizer when its sql_normalizer attribute is set, see
+vtgate_cursor.VTGateCursor and cursorv3.Cursor.
+"""
+
+import collections
+import re
+import threading
+
+
+# Statements whose literals are normalized, the others are left as is.
+NORMALIZED_STATEMENTS = frozenset(['select', 'insert', 'update', 'delete',
+                                   'replace'])
+
+_TOKEN_RE = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>/\*.*?\*/|--[^\n]*|\#[^\n]*)
+  | (?P<pyformat>%\([^)]*\)s|%%)
+  | (?P<bindvar>::?[A-Za-z_][\w.]*)
+  | (?P<string>'(?:[^'\\]|\\.|'')*')
+  | (?P<dquoted>"(?:[^"\\]|\\.|"")*")
+  | (?P<backquoted>`(?:[^`]|``)*`)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+  | (?P<word>[A-Za-z_$][\w$]*)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+_IDENTIFIER_CHAR_RE = re.compile(r'[\w$]')
+
+# Typed literals, e.g. DATE '2015-01-01', and ESCAPE '!' need a literal.
+_LITERAL_PREFIX_WORDS = frozenset(['date', 'time', 'timestamp', 'escape'])
+
+# Numbers in parentheses after these words are type lengths, e.g.
+# CAST(x AS CHAR(10)).
+_TYPE_WORDS = frozenset(['char', 'varchar', 'binary', 'varbinary', 'decimal',
+                         'dec', 'numeric', 'datetime', 'time', 'timestamp'])
+
+# Words that end an ORDER BY or GROUP BY list.
+_BY_CLAUSE_END_WORDS = frozenset(['having', 'union', 'for', 'lock', 'into',
+                                  'procedure', 'limit'])
+
+_SQL_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t',
+                'Z': '\x1a'}
+
+
+def _sql_unescape(match):
+  if match.group(0) == "''":
+    return "'"
+  char = match.group(1)
+  if char in '%_':
+    # mysql keeps the backslash of \% and \_ for LIKE patterns.
+    return match.group(0)
+  return _SQL_ESCAPES.get(char, char)
+
+
+def _string_value(token, pyformat):
+  body = token[1:-1]
+  if pyformat:
+    body = body.replace('%%', '%')
+  return re.sub(r"\\(.)|''", _sql_unescape, body, flags=re.DOTALL)
+
+
+class SQLNormalizer(object):
+  """Extracts the literals of SQL statements into bind variables.
+
+  Attributes:
+    pyformat: True for the %(name)s bind variables of vtgatev2 and the
+      tablet connections, False for the :name bind variables of vtgatev3.
+    cache_size: maximum number of normalized statements kept.
+    hits, misses: cache counters.
+  """
+
+  def __init__(self, pyformat=True, cache_size=1000):
+    self.pyformat = pyformat
+    self.cache_size = cache_size
+    self.lock = threading.Lock()
+    # sql -> (normalized sql, literal bind variables), least recently
+    # used first.
+    self.templates = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def normalize(self, sql, bind_variables):
+    """Returns sql and bind_variables with the literals extracted.
+
+    bind_variables is not modified, a new dict is returned when literals
+    were extracted.
+    """
+    with self.lock:
+      template = self.templates.pop(sql, None)
+      if template is not None:
+        self.templates[sql] = template
+        self.hits += 1
+    if template is None:
+      template = self._normalize(sql)
+      with self.lock:
+        self.misses += 1
+        self.templates[sql] = template
+        while len(self.templates) > self.cache_size:
+          self.templates.popitem(last=False)
+
+    normalized_sql, literal_binds = template
+    if not literal_binds:
+      return sql, bind_variables
+    new_binds = dict(bind_variables or {})
+    new_binds.update(literal_binds)
+    return normalized_sql, new_binds
+
+  def _placeholder(self, name):
+    if self.pyformat:
+      return '%({0!s})s'.format(name)
+    return ':{0!s}'.format(name)
+
+  def _normalize(self, sql):
+    tokens = [(m.lastgroup, m.group(0)) for m in _TOKEN_RE.finditer(sql)]
+    first_word = next((text for kind, text in tokens if kind == 'word'), None)
+    if first_word is None or first_word.lower() not in NORMALIZED_STATEMENTS:
+      return sql, {}
+
+    # The generated names can't collide with bind variables of the query.
+    prefix = 'vtnorm'
+    while prefix in sql:
+      prefix += '_'
+
+    parts = []
+    literal_binds = {}
+    # None, 'limit' or 'by': numbers in LIMIT and BY lists stay inline.
+    inline_clause = None
+    by_depth = 0
+    # One entry per open parenthesis, True for type lengths.
+    parens = []
+    prev_word = None
+    prev_kind = None
+    for i, (kind, text) in enumerate(tokens):
+      if kind in ('space', 'comment'):
+        parts.append(text)
+        prev_kind = kind
+        continue
+
+      value = None
+      if kind == 'word':
+        word = text.lower()
+        if word in ('limit', 'offset'):
+          inline_clause = 'limit'
+        elif word == 'by' and prev_word in ('order', 'group'):
+          inline_clause = 'by'
+          by_depth = len(parens)
+        elif inline_clause == 'limit':
+          inline_clause = None
+        elif inline_clause == 'by' and word in _BY_CLAUSE_END_WORDS:
+          inline_clause = None
+        prev_word = word
+      elif kind == 'other':
+        if text == '(':
+          parens.append(prev_kind == 'word' and prev_word in _TYPE_WORDS)
+        elif text == ')':
+          if parens:
+            parens.pop()
+          if inline_clause == 'by' and len(parens) < by_depth:
+            inline_clause = None
+        elif text != ',' and inline_clause == 'limit':
+          inline_clause = None
+        prev_word = None
+      elif kind == 'number':
+        next_text = tokens[i + 1][1] if i + 1 < len(tokens) else ''
+        if (text.isdigit() and not inline_clause and
+            not (parens and parens[-1]) and
+            not _IDENTIFIER_CHAR_RE.match(next_text[:1])):
+          value = int(text)
+        prev_word = None
+      elif kind == 'string':
+        # A word right before the quote is a charset introducer, or
+        # X'..', B'..' and N'..'.
+        if (prev_kind != 'word' and
+            prev_word not in _LITERAL_PREFIX_WORDS and
+            not (self.pyformat and '%(' in text)):
+          value = _string_value(text, self.pyformat)
+          if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        prev_word = None
+      else:
+        prev_word = None
+
+      if value is None:
+        parts.append(text)
+      else:
+        name = '{0!s}{1:d}'.format(prefix, len(literal_binds) + 1)
+        literal_binds[name] = value
+        parts.append(self._placeholder(name))
+      prev_kind = kind
+
+    return ''.join(parts), literal_binds
+
+  def stats(self):
+    with self.lock:
+      return {'Size': len(self.templates),
+              'Hits': self.hits,
+              'Misses': self.misses}
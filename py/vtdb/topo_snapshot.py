@@ -0,0 +1,266 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Local snapshot of the serving topology of a cell.
+
+A snapshot is a json file with the SrvKeyspace and end points data of
+all the keyspaces of a cell:
+
+  {"Version": 1,            # format version, see SNAPSHOT_VERSION
+   "Generation": 12,        # incremented at each refresh
+   "Cell": "test_nj",
+   "Timestamp": 1420070400.0,  # when the data was read from the topo
+   "Data": {"/zk/test_nj/vt/ns/<keyspace>": <SrvKeyspace>,
+            "/zk/test_nj/vt/ns/<keyspace>/<shard>/<tablet type>":
+                <EndPoints>}}
+
+Data has the shape of the files of zkocc.FakeZkOccConnection.from_data_path,
+so a snapshot can be loaded by it too. The KeyRange bounds are hex encoded.
+
+The file is replaced atomically with a rename, so readers never see a
+partly written snapshot.
+
+SnapshotTopoClient serves the topology reads from the snapshot, so a
+process can route queries at startup even when the topo server is slow
+or down, and refreshes the snapshot from the topo server in the
+background.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from zk import zkocc
+
+
+SNAPSHOT_VERSION = 1
+
+
+def keyspace_path(cell, keyspace):
+  return '/zk/{0!s}/vt/ns/{1!s}'.format(cell, keyspace)
+
+
+def end_points_path(cell, keyspace, shard, tablet_type):
+  return '/zk/{0!s}/vt/ns/{1!s}/{2!s}/{3!s}'.format(cell, keyspace, shard,
+                                                    tablet_type)
+
+
+def write_snapshot(path, snapshot):
+  """Writes a snapshot dict to path, replacing it atomically.
+
+  Each writer has its own temporary file, so several processes can
+  refresh the same snapshot.
+  """
+  f = tempfile.NamedTemporaryFile(delete=False, prefix='.topo_snapshot',
+                                  dir=os.path.dirname(path) or '.')
+  try:
+    with f:
+      # The temporary file is only readable by its owner.
+      os.fchmod(f.fileno(), 0644)
+      json.dump(snapshot, f, sort_keys=True)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(f.name, path)
+  except:
+    os.remove(f.name)
+    raise
+
+
+def read_snapshot(path):
+  """Returns the snapshot dict of path, or None if there is no file.
+
+  Raises:
+    ValueError: the file is not a snapshot of a supported version.
+  """
+  try:
+    f = open(path, 'rb')
+  except IOError:
+    return None
+  with f:
+    if not os.fstat(f.fileno()).st_size:
+      raise ValueError('empty topology snapshot: {0!s}'.format(path))
+    snapshot = json.load(f)
+  if not isinstance(snapshot, dict) or 'Data' not in snapshot:
+    raise ValueError('invalid topology snapshot: {0!s}'.format(path))
+  if snapshot.get('Version') != SNAPSHOT_VERSION:
+    raise ValueError('unsupported topology snapshot version {0!s}: {1!s}'.format(
+        snapshot.get('Version'), path))
+  return snapshot
+
+
+class SnapshotTopoClient(object):
+  """Topology client serving reads from a local snapshot.
+
+  It has the get_srv_keyspace_names, get_srv_keyspace and get_end_points
+  methods of zkocc.ZkOccConnection, so it can be given to
+  topology.read_topology. Reads of a cell or a path that is not in the
+  snapshot go to the topo client.
+
+  Attributes:
+    snapshot: the current snapshot dict, None until loaded or refreshed.
+    refreshes, errors: counters of the background refreshes.
+  """
+
+  def __init__(self, topo_client, path, refresh_interval=60.0, max_age=600.0,
+               on_refresh=None):
+    """Creates the client, call start to load the snapshot.
+
+    Args:
+      topo_client: zkocc.ZkOccConnection the snapshot is refreshed from.
+      path: file of the snapshot.
+      refresh_interval: seconds between two refreshes.
+      max_age: the snapshot is reported stale after this many seconds.
+      on_refresh: optional function(client) called after each background
+        refresh, e.g. topology.read_keyspaces.
+    """
+    self.topo_client = topo_client
+    self.path = path
+    self.refresh_interval = refresh_interval
+    self.max_age = max_age
+    self.on_refresh = on_refresh
+    self.cell = getattr(topo_client, 'local_cell', 'local')
+    self.snapshot = None
+    self.refreshes = 0
+    self.errors = 0
+    self.stop_event = threading.Event()
+    self.thread = None
+
+  def load(self):
+    """Loads the snapshot file, returns True if there was a usable one."""
+    try:
+      snapshot = read_snapshot(self.path)
+    except (ValueError, EnvironmentError) as e:
+      logging.warning('ignoring topology snapshot %s: %s', self.path, e)
+      return False
+    if snapshot is None:
+      return False
+    if snapshot.get('Cell') != self.cell:
+      logging.warning('ignoring topology snapshot %s of cell %s',
+                      self.path, snapshot.get('Cell'))
+      return False
+    self.snapshot = snapshot
+    if self.is_stale():
+      logging.warning('topology snapshot %s is %.0f seconds old',
+                      self.path, self.age())
+    return True
+
+  def refresh(self):
+    """Reads the topology from the topo client, and saves the snapshot."""
+    data = {}
+    for keyspace in self.topo_client.get_srv_keyspace_names('local'):
+      srv_keyspace = self.topo_client.get_srv_keyspace('local', keyspace)
+      data[keyspace_path(self.cell, keyspace)] = zkocc.encode_srv_keyspace(
+          srv_keyspace)
+      for tablet_type, partition in (srv_keyspace.get('Partitions') or
+                                     {}).iteritems():
+        for shard_reference in partition.get('ShardReferences') or []:
+          shard = shard_reference['Name']
+          try:
+            end_points = self.topo_client.get_end_points(
+                'local', keyspace, shard, tablet_type)
+          except zkocc.ZkOccError as e:
+            logging.warning('topology snapshot: no end points for %s/%s/%s: %s',
+                            keyspace, shard, tablet_type, e)
+            continue
+          data[end_points_path(self.cell, keyspace, shard,
+                               tablet_type)] = end_points
+    generation = 1
+    if self.snapshot is not None:
+      generation = self.snapshot.get('Generation', 0) + 1
+    snapshot = {'Version': SNAPSHOT_VERSION,
+                'Generation': generation,
+                'Cell': self.cell,
+                'Timestamp': time.time(),
+                'Data': data}
+    write_snapshot(self.path, snapshot)
+    self.snapshot = snapshot
+
+  def start(self):
+    """Loads the snapshot, and refreshes it in the background.
+
+    Without a usable snapshot file, the first refresh is done before
+    returning, and its errors are raised.
+    """
+    refreshed = False
+    if not self.load():
+      self.refresh()
+      refreshed = True
+    self.stop_event.clear()
+    self.thread = threading.Thread(target=self._refresh_loop,
+                                   args=(refreshed,), name='topo_snapshot')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.stop_event.set()
+    if self.thread is not None and self.thread is not threading.current_thread():
+      self.thread.join()
+    self.thread = None
+
+  def _refresh_loop(self, refreshed):
+    # The first refresh is done right away, a loaded snapshot may be old,
+    # unless start has just refreshed it.
+    if refreshed:
+      self.stop_event.wait(self.refresh_interval)
+    while not self.stop_event.is_set():
+      try:
+        self.refresh()
+        self.refreshes += 1
+        if self.on_refresh is not None:
+          self.on_refresh(self)
+      except Exception as e:
+        self.errors += 1
+        logging.warning('topology snapshot refresh failed, using the one of '
+                        '%.0f seconds ago: %s', self.age(), e)
+      self.stop_event.wait(self.refresh_interval)
+
+  def age(self):
+    """Returns the age of the snapshot data in seconds, None if none."""
+    if self.snapshot is None:
+      return None
+    return max(0.0, time.time() - self.snapshot['Timestamp'])
+
+  def is_stale(self):
+    age = self.age()
+    return age is None or age > self.max_age
+
+  def _get(self, cell, path):
+    # Returns the data of a path, or None if it is not in the snapshot.
+    snapshot = self.snapshot
+    if snapshot is None or cell not in ('local', self.cell):
+      return None
+    return snapshot['Data'].get(path)
+
+  def get_srv_keyspace_names(self, cell):
+    snapshot = self.snapshot
+    if snapshot is None or cell not in ('local', self.cell):
+      return self.topo_client.get_srv_keyspace_names(cell)
+    prefix = keyspace_path(self.cell, '')
+    return sorted(path[len(prefix):] for path in snapshot['Data']
+                  if path.startswith(prefix) and '/' not in path[len(prefix):])
+
+  def get_srv_keyspace(self, cell, keyspace):
+    data = self._get(cell, keyspace_path(self.cell, keyspace))
+    if data is None:
+      return self.topo_client.get_srv_keyspace(cell, keyspace)
+    return zkocc.decode_srv_keyspace(data)
+
+  def get_end_points(self, cell, keyspace, shard, tablet_type):
+    data = self._get(cell, end_points_path(self.cell, keyspace, shard,
+                                           tablet_type))
+    if data is None:
+      return self.topo_client.get_end_points(cell, keyspace, shard,
+                                             tablet_type)
+    return data
+
+  def stats(self):
+    snapshot = self.snapshot
+    return {'Generation': snapshot['Generation'] if snapshot else 0,
+            'Age': self.age(),
+            'Stale': self.is_stale(),
+            'Refreshes': self.refreshes,
+            'Errors': self.errors}
@@ -21,6 +21,7 @@ from vtdb import dbexceptions
 from vtdb import keyrange
 from vtdb import keyrange_constants
 from vtdb import keyspace
+from vtdb import topo_snapshot
 from vtdb import vtdb_logger
 from zk import zkocc
 
@@ -92,6 +93,22 @@ def read_keyspaces(zkocc_client):
   read_topology(zkocc_client, read_fqdb_keys=False)
 
 
+# read all the keyspaces from a local snapshot of the topology, so that
+# queries can be routed even if the topo server is slow or down. The
+# snapshot and the keyspaces are then refreshed from zkocc_client every
+# refresh_interval secs in the background. Without a snapshot file, it is
+# created from zkocc_client first. Returns the SnapshotTopoClient, which
+# can be used as the topo client afterwards, and must be stopped.
+def read_keyspaces_from_snapshot(zkocc_client, snapshot_path,
+                                 refresh_interval=60.0):
+  client = topo_snapshot.SnapshotTopoClient(
+      zkocc_client, snapshot_path, refresh_interval=refresh_interval,
+      on_refresh=read_keyspaces)
+  client.start()
+  read_keyspaces(client)
+  return client
+
+
 # read_topology returns:
 # - a list of all the existing <keyspace>.<shard>.<db_type>
 # - optionally, a list of all existing endpoints:
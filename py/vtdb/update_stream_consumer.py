@@ -0,0 +1,298 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Consumer framework for the update stream of a tablet.
+
+UpdateStreamConsumer reads the events of an update stream in a thread,
+and applies them with a pool of worker threads. The DML events are
+partitioned by table, or by table and primary key, so that all the
+events of a table (or of a row) are applied in stream order by the same
+worker. With partitioning by primary key, a multi-row event is split in
+one event per worker, with the rows of that worker. Each worker applies
+its events in batches of at most batch_size events, waiting at most
+batch_timeout seconds to fill them.
+
+DDL events, and with partitioning by primary key the DML events that
+have no primary key values, are applied alone, once all the previous
+events have been applied.
+
+The POS events give the stream position at the end of each
+transaction. The last position whose events have all been applied is
+saved in the checkpoint every checkpoint_interval seconds, and the
+stream is started again from it. Events after that position may be
+applied twice after a restart or a reconnection, so apply_batch must
+be idempotent.
+"""
+
+import collections
+import logging
+import Queue
+import threading
+import time
+
+from vtdb import update_stream_service
+
+
+PARTITION_BY_TABLE = 'table'
+PARTITION_BY_PK = 'pk'
+
+
+class UpdateStreamConsumer(object):
+  """Applies the events of an update stream with a pool of workers.
+
+  Attributes:
+    position: position of the last POS event read.
+    applied_position: last position whose events are all applied.
+    applied_gtid: GTIDField of the POS event of applied_position.
+    lag: seconds between the last applied event and its application.
+    events, batches, reconnects: counters.
+  """
+
+  def __init__(self, connection_factory, position, apply_batch,
+               num_workers=4, partition_by=PARTITION_BY_TABLE,
+               batch_size=100, batch_timeout=0.1, checkpoint=None,
+               checkpoint_interval=1.0, position_append=None,
+               retry_delay=1.0, queue_size=1000):
+    """Creates the consumer, call start to run it.
+
+    Args:
+      connection_factory: returns a new UpdateStreamConnection, preferably
+        with compact events.
+      position: replication position to start from, when the checkpoint
+        has none.
+      apply_batch: function(events) applying a list of events, as
+        returned by stream_next. It is called from the worker threads,
+        and retried until it succeeds.
+      num_workers: number of worker threads.
+      partition_by: PARTITION_BY_TABLE or PARTITION_BY_PK.
+      batch_size: maximum number of events per apply_batch call.
+      batch_timeout: maximum number of seconds a worker waits for more
+        events before applying a batch.
+      checkpoint: optional object with load() and save(state) methods,
+        such as split_query_export.FileCheckpoint.
+      checkpoint_interval: minimum number of seconds between two saves
+        of the checkpoint.
+      position_append: function(position, gtid_field) that returns the
+        position after a POS event, mysql_flavor specific. Without it,
+        the position never moves past the initial one.
+      retry_delay: seconds to wait before reconnecting, or before
+        retrying a failed apply_batch.
+      queue_size: maximum number of events queued per worker.
+    """
+    if partition_by not in (PARTITION_BY_TABLE, PARTITION_BY_PK):
+      raise ValueError('invalid partition_by: {0!s}'.format(partition_by))
+    self.apply_batch = apply_batch
+    self.num_workers = num_workers
+    self.partition_by = partition_by
+    self.batch_size = batch_size
+    self.batch_timeout = batch_timeout
+    self.checkpoint = checkpoint
+    self.checkpoint_interval = checkpoint_interval
+    self.retry_delay = retry_delay
+    self.queues = [Queue.Queue(queue_size) for _ in xrange(num_workers)]
+
+    self.condition = threading.Condition()
+    # Every DML and DDL event gets a sequence number. A POS event is
+    # applied once all the events before it are.
+    self.seq = 0
+    self.dispatched_seq = 0
+    self.enqueued_seqs = [0] * num_workers
+    self.applied_seqs = [0] * num_workers
+    # (seq, position, gtid_field) of the POS events not checkpointed yet.
+    self.positions = collections.deque()
+    self.applied_position = position
+    self.applied_gtid = None
+    self.last_checkpoint = 0.0
+
+    self.lag = None
+    self.events = 0
+    self.batches = 0
+    self.stopped = False
+    # Set by stop, to interrupt the retry delays.
+    self.stop_event = threading.Event()
+    self.reader = update_stream_service.UpdateStreamReader(
+        connection_factory, position, self._dispatch,
+        position_append=position_append, retry_delay=retry_delay,
+        batch_size=batch_size)
+    self.threads = []
+
+  def start(self):
+    if self.checkpoint is not None:
+      state = self.checkpoint.load()
+      if state is not None:
+        self.reader.position = self.applied_position = state['position']
+        self.applied_gtid = state.get('gtid')
+        logging.info('resuming update stream at %s', self.position)
+    self.stopped = False
+    self.stop_event.clear()
+    for index in xrange(self.num_workers):
+      t = threading.Thread(target=self._worker, args=(index,),
+                           name='update_stream_worker')
+      t.daemon = True
+      self.threads.append(t)
+    for t in self.threads:
+      t.start()
+    self.reader.start()
+
+  def stop(self):
+    """Stops reading and applying, and saves the checkpoint.
+
+    The queued events that are not applied yet are dropped, they will
+    be read again from the checkpoint.
+    """
+    self.stopped = True
+    self.stop_event.set()
+    self.reader.stop()
+    for t in self.threads:
+      if t is not threading.current_thread():
+        t.join()
+    self.threads = []
+    self.save_checkpoint(force=True)
+
+  @property
+  def position(self):
+    return self.reader.position
+
+  @property
+  def reconnects(self):
+    return self.reader.reconnects
+
+  def _pk_worker(self, table_name, pk_row):
+    key = (table_name, tuple(value for _, value in pk_row))
+    return hash(key) % self.num_workers
+
+  def _partition(self, event):
+    """Returns the (worker index, event) list of a DML event, or None if
+    it must be applied alone.
+
+    There is at most one event per worker: the rows of a multi-row event
+    that go to the same worker stay together, so that the sequence
+    number of the event is applied at once by each worker.
+    """
+    if self.partition_by == PARTITION_BY_TABLE:
+      return [(hash(event['TableName']) % self.num_workers, event)]
+    if not event.get('PkRows'):
+      return None
+    if len(event['PkRows']) == 1:
+      return [(self._pk_worker(event['TableName'], event['PkRows'][0]), event)]
+    rows = collections.OrderedDict()
+    for pk_row in event['PkRows']:
+      index = self._pk_worker(event['TableName'], pk_row)
+      rows.setdefault(index, []).append(pk_row)
+    if len(rows) == 1:
+      return [(rows.keys()[0], event)]
+    return [(index, dict(event, PkRows=pk_rows))
+            for index, pk_rows in rows.iteritems()]
+
+  def _dispatch(self, event):
+    category = event['Category']
+    if category == 'POS':
+      # The reader has moved the position past it.
+      with self.condition:
+        self.positions.append((self.seq, self.position, event['GTIDField']))
+      return
+
+    self.seq += 1
+    parts = None
+    if category == 'DML':
+      parts = self._partition(event)
+    if parts is None:
+      self._apply_alone(event)
+      return
+    for index, part in parts:
+      if not self._put(self.queues[index], (self.seq, part)):
+        return
+      with self.condition:
+        self.enqueued_seqs[index] = self.seq
+    with self.condition:
+      self.dispatched_seq = self.seq
+
+  def _put(self, queue, item):
+    # Gives up when the consumer is stopped.
+    while not self.stopped:
+      try:
+        queue.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def _caught_up(self):
+    return self.enqueued_seqs == self.applied_seqs
+
+  def _apply_alone(self, event):
+    with self.condition:
+      while not self._caught_up() and not self.stopped:
+        self.condition.wait(0.1)
+    if not self._apply([event]):
+      return
+    with self.condition:
+      self.dispatched_seq = self.seq
+
+  def _apply(self, events):
+    """Applies events until it succeeds, returns False if stopped."""
+    while not self.stopped:
+      try:
+        self.apply_batch(events)
+      except Exception:
+        logging.exception('update stream consumer: apply_batch failed')
+        self.stop_event.wait(self.retry_delay)
+        continue
+      with self.condition:
+        self.events += len(events)
+        self.batches += 1
+        if events[-1].get('Timestamp'):
+          self.lag = max(0.0, time.time() - events[-1]['Timestamp'])
+      return True
+    return False
+
+  def _worker(self, index):
+    queue = self.queues[index]
+    while not self.stopped:
+      batch = []
+      deadline = time.time() + self.batch_timeout
+      while len(batch) < self.batch_size:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+          break
+        try:
+          batch.append(queue.get(timeout=timeout))
+        except Queue.Empty:
+          break
+      if batch:
+        if not self._apply([event for _, event in batch]):
+          return
+        with self.condition:
+          self.applied_seqs[index] = batch[-1][0]
+          self.condition.notify_all()
+      self.save_checkpoint()
+
+  def save_checkpoint(self, force=False):
+    """Saves the last position whose events are all applied."""
+    with self.condition:
+      now = time.time()
+      if not force and now - self.last_checkpoint < self.checkpoint_interval:
+        return
+      self.last_checkpoint = now
+      safe_seq = self.dispatched_seq
+      for enqueued, applied in zip(self.enqueued_seqs, self.applied_seqs):
+        if enqueued != applied:
+          safe_seq = min(safe_seq, applied)
+      updated = False
+      while self.positions and self.positions[0][0] <= safe_seq:
+        _, self.applied_position, self.applied_gtid = self.positions.popleft()
+        updated = True
+      if updated and self.checkpoint is not None:
+        self.checkpoint.save({'position': self.applied_position,
+                              'gtid': self.applied_gtid,
+                              'timestamp': now})
+
+  def stats(self):
+    with self.condition:
+      return {'Events': self.events,
+              'Batches': self.batches,
+              'Reconnects': self.reconnects,
+              'Queued': sum(q.qsize() for q in self.queues),
+              'Lag': self.lag,
+              'Position': self.applied_position}
@@ -0,0 +1,280 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Fan-out of one update stream to many subscribers in the process.
+
+UpdateStreamMultiplexer reads the update stream of a tablet once, in a
+thread, and offers each event to its subscriptions. A subscription has
+a bounded queue, and optionally a set of tables: the DML events of the
+other tables are not queued for it. DDL and POS events are queued for
+all the subscriptions.
+
+When the queue of a subscription is full, its policy decides:
+  POLICY_BLOCK: the multiplexer waits, which slows down all the
+    subscriptions.
+  POLICY_DROP: the queued events and the new one are dropped, and
+    replaced by a RESYNC event. The subscriber must then rebuild its
+    state, e.g. clear a cache.
+  POLICY_SPILL: the events are written to a temporary file until the
+    subscriber has read them all.
+
+The same event object is given to all the subscribers, they must not
+modify it. After a reconnection, the stream restarts from the last
+POS event, so subscribers may see some events twice.
+"""
+
+import collections
+import cPickle
+import tempfile
+import threading
+import time
+
+from vtdb import update_stream_service
+
+
+POLICY_BLOCK = 'block'
+POLICY_DROP = 'drop'
+POLICY_SPILL = 'spill'
+
+# Category of the event that replaces dropped events.
+RESYNC = 'RESYNC'
+
+
+def _resync_event():
+  return {'Category': RESYNC, 'TableName': None, 'PkRows': [], 'Sql': None,
+          'Timestamp': None, 'GTIDField': None}
+
+
+class _SpillFile(object):
+  """Temporary file of pickled events, read in order."""
+
+  def __init__(self, directory=None):
+    self.file = tempfile.TemporaryFile(dir=directory)
+    self.read_offset = 0
+    self.pending = 0
+
+  def write(self, event):
+    self.file.seek(0, 2)
+    cPickle.dump(dict(event), self.file, cPickle.HIGHEST_PROTOCOL)
+    self.pending += 1
+
+  def read(self):
+    if not self.pending:
+      return None
+    self.file.seek(self.read_offset)
+    event = cPickle.load(self.file)
+    self.read_offset = self.file.tell()
+    self.pending -= 1
+    return event
+
+  def close(self):
+    self.file.close()
+
+
+class Subscription(object):
+  """Queue of the events of an UpdateStreamMultiplexer for a subscriber.
+
+  Attributes:
+    name: name of the subscription in the stats.
+    tables: set of the tables of the DML events queued, None for all.
+    lag: seconds between the last event returned by get and its
+      timestamp.
+    delivered, dropped, resyncs, spilled: counters.
+  """
+
+  def __init__(self, name, tables=None, queue_size=1000, policy=POLICY_BLOCK,
+               spill_directory=None):
+    if policy not in (POLICY_BLOCK, POLICY_DROP, POLICY_SPILL):
+      raise ValueError('invalid policy: {0!s}'.format(policy))
+    self.name = name
+    self.tables = None if tables is None else set(tables)
+    self.queue_size = queue_size
+    self.policy = policy
+    self.spill_directory = spill_directory
+    self.condition = threading.Condition()
+    self.events = collections.deque()
+    self.spill = None
+    self.closed = False
+    self.lag = None
+    self.delivered = 0
+    self.dropped = 0
+    self.resyncs = 0
+    self.spilled = 0
+
+  def wants(self, event):
+    if self.tables is None or event['Category'] != 'DML':
+      return True
+    return event['TableName'] in self.tables
+
+  def offer(self, event):
+    """Queues an event, called by the multiplexer."""
+    with self.condition:
+      if self.spill is not None:
+        self.spill.write(event)
+        self.spilled += 1
+      else:
+        while len(self.events) >= self.queue_size and not self.closed:
+          if self.policy == POLICY_BLOCK:
+            self.condition.wait(0.1)
+          elif self.policy == POLICY_DROP:
+            self.dropped += 1 + sum(
+                1 for e in self.events if e['Category'] != RESYNC)
+            self.resyncs += 1
+            self.events.clear()
+            event = _resync_event()
+          else:
+            self.spill = _SpillFile(self.spill_directory)
+            self.spill.write(event)
+            self.spilled += 1
+            event = None
+            break
+        if self.closed:
+          return
+        if event is not None:
+          self.events.append(event)
+      self.condition.notify_all()
+
+  def get(self, timeout=None):
+    """Returns the next event.
+
+    Returns None if there is no event after timeout seconds, or when the
+    subscription is closed and all its events were returned.
+    """
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+    with self.condition:
+      while True:
+        if self.events:
+          event = self.events.popleft()
+          break
+        if self.spill is not None:
+          event = self.spill.read()
+          if event is not None:
+            break
+          # The subscriber caught up.
+          self.spill.close()
+          self.spill = None
+          continue
+        if self.closed:
+          return None
+        if deadline is None:
+          self.condition.wait(1.0)
+        else:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            return None
+          self.condition.wait(remaining)
+      self.delivered += 1
+      if event['Timestamp']:
+        self.lag = max(0.0, time.time() - event['Timestamp'])
+      self.condition.notify_all()
+      return event
+
+  def close(self):
+    with self.condition:
+      self.closed = True
+      self.condition.notify_all()
+
+  def _pending(self):
+    spilled = self.spill.pending if self.spill is not None else 0
+    return len(self.events) + spilled
+
+  def pending(self):
+    """Returns the number of events queued or spilled."""
+    with self.condition:
+      return self._pending()
+
+  def stats(self):
+    with self.condition:
+      return {'Pending': self._pending(),
+              'Delivered': self.delivered,
+              'Dropped': self.dropped,
+              'Resyncs': self.resyncs,
+              'Spilled': self.spilled,
+              'Lag': self.lag}
+
+
+class UpdateStreamMultiplexer(object):
+  """Reads one update stream and fans it out to subscriptions.
+
+  Attributes:
+    position: replication position the stream is (re)started from.
+    events, reconnects: counters.
+  """
+
+  def __init__(self, connection_factory, position, position_append=None,
+               retry_delay=1.0, batch_size=100):
+    """Creates the multiplexer, call start to run it.
+
+    Args:
+      connection_factory: returns a new UpdateStreamConnection, preferably
+        with compact events.
+      position: replication position to start from.
+      position_append: function(position, gtid_field) that returns the
+        position after a POS event, mysql_flavor specific. Without it,
+        reconnections restart from the initial position.
+      retry_delay: seconds to wait before reconnecting.
+      batch_size: maximum number of events read at once.
+    """
+    self.lock = threading.Lock()
+    self.subscriptions = []
+    self.events = 0
+    self.reader = update_stream_service.UpdateStreamReader(
+        connection_factory, position, self.dispatch,
+        position_append=position_append, retry_delay=retry_delay,
+        batch_size=batch_size, name='update_stream_mux')
+
+  def subscribe(self, name, tables=None, queue_size=1000, policy=POLICY_BLOCK,
+                spill_directory=None):
+    """Returns a new Subscription, see its attributes."""
+    subscription = Subscription(name, tables=tables, queue_size=queue_size,
+                                policy=policy, spill_directory=spill_directory)
+    with self.lock:
+      self.subscriptions.append(subscription)
+    return subscription
+
+  def unsubscribe(self, subscription):
+    with self.lock:
+      self.subscriptions.remove(subscription)
+    subscription.close()
+
+  def start(self):
+    self.reader.start()
+
+  def stop(self):
+    """Stops the stream, and closes the subscriptions.
+
+    The subscribers can still get the events already queued.
+    """
+    with self.lock:
+      subscriptions = list(self.subscriptions)
+    # Closed first, so a blocked dispatch returns.
+    for subscription in subscriptions:
+      subscription.close()
+    self.reader.stop()
+
+  @property
+  def position(self):
+    return self.reader.position
+
+  @property
+  def reconnects(self):
+    return self.reader.reconnects
+
+  def dispatch(self, event):
+    """Offers an event to the subscriptions."""
+    with self.lock:
+      subscriptions = list(self.subscriptions)
+    for subscription in subscriptions:
+      if subscription.wants(event):
+        subscription.offer(event)
+    self.events += 1
+
+  def stats(self):
+    with self.lock:
+      subscriptions = list(self.subscriptions)
+    return {'Events': self.events,
+            'Reconnects': self.reconnects,
+            'Subscriptions': dict((s.name, s.stats()) for s in subscriptions)}
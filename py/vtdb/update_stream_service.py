@@ -2,6 +2,7 @@
 
 from itertools import izip
 import logging
+import threading
 
 from net import gorpc
 from net import bsonrpc
@@ -40,9 +41,96 @@ class EventData(object):
       pk_row = [(col_name, col_value) for col_name, col_value in izip(raw_response['PKColNames'], pkList)]
       self.PkRows.append(pk_row)
 
+
+# The keys of the events returned by stream_next.
+EVENT_KEYS = ('Category', 'TableName', 'PkRows', 'Sql', 'Timestamp', 'GTIDField')
+
+
+class StreamEvent(object):
+  """A compact update stream event.
+
+  It has the same keys as the dicts returned by stream_next, and can be
+  read the same way, but it uses slots and its PkRows are only built
+  when they are first read. PKColNames is a tuple shared by the events
+  of the same connection and table.
+  """
+  __slots__ = ('Category', 'TableName', 'PKColNames', 'PKValues', 'Sql',
+               'Timestamp', 'GTIDField', '_pk_rows')
+
+  def __init__(self, raw_response, pk_col_names=None):
+    self.Category = raw_response.get('Category')
+    self.TableName = raw_response.get('TableName')
+    self.PKColNames = pk_col_names
+    self.PKValues = raw_response.get('PKValues')
+    self.Sql = raw_response.get('Sql')
+    self.Timestamp = raw_response.get('Timestamp')
+    self.GTIDField = raw_response.get('GTIDField')
+    self._pk_rows = None
+
+  @property
+  def PkRows(self):
+    if self._pk_rows is None:
+      self._pk_rows = []
+      if self.PKColNames:
+        for pkList in self.PKValues:
+          if pkList:
+            self._pk_rows.append(zip(self.PKColNames, pkList))
+    return self._pk_rows
+
+  def __getitem__(self, key):
+    if key not in EVENT_KEYS:
+      raise KeyError(key)
+    return getattr(self, key)
+
+  def get(self, key, default=None):
+    if key not in EVENT_KEYS:
+      return default
+    return getattr(self, key)
+
+  def __contains__(self, key):
+    return key in EVENT_KEYS
+
+  def keys(self):
+    return list(EVENT_KEYS)
+
+  def to_dict(self):
+    return dict((key, getattr(self, key)) for key in EVENT_KEYS)
+
+  def __eq__(self, other):
+    if isinstance(other, StreamEvent):
+      other = other.to_dict()
+    return self.to_dict() == other
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return 'StreamEvent({0!r})'.format(self.to_dict())
+
+
 class UpdateStreamConnection(object):
-  def __init__(self, addr, timeout, user=None, password=None, encrypted=False, keyfile=None, certfile=None):
+  """Connection to the update stream of a tablet.
+
+  stream_start and stream_next return the events as dicts, or as
+  StreamEvent objects if compact is True.
+  """
+
+  def __init__(self, addr, timeout, user=None, password=None, encrypted=False, keyfile=None, certfile=None, compact=False):
     self.client = bsonrpc.BsonRpcClient(addr, timeout, user, password, encrypted, keyfile, certfile)
+    self.compact = compact
+    # tuple of primary key column names -> the same tuple, shared by the
+    # compact events.
+    self._pk_col_names = {}
+    self._stream_done = False
+
+  def _event(self, raw_response):
+    if not self.compact:
+      return EventData(raw_response).__dict__
+    pk_col_names = raw_response.get('PKColNames')
+    if pk_col_names:
+      pk_col_names = tuple(pk_col_names)
+      pk_col_names = self._pk_col_names.setdefault(pk_col_names, pk_col_names)
+    return StreamEvent(raw_response, pk_col_names)
 
   def dial(self):
     self.client.dial()
@@ -52,11 +140,13 @@ class UpdateStreamConnection(object):
 
   def stream_start(self, replPos):
     try:
+      self._stream_done = False
       self.client.stream_call('UpdateStream.ServeUpdateStream', {"Position": replPos})
       response = self.client.stream_next()
       if response is None:
+        self._stream_done = True
         return None
-      return EventData(response.reply).__dict__
+      return self._event(response.reply)
     except gorpc.GoRpcError as e:
       raise dbexceptions.OperationalError(*e.args)
     except:
@@ -67,8 +157,9 @@ class UpdateStreamConnection(object):
     try:
       response = self.client.stream_next()
       if response is None:
+        self._stream_done = True
         return None
-      return EventData(response.reply).__dict__
+      return self._event(response.reply)
     except gorpc.AppError as e:
       raise dbexceptions.DatabaseError(*e.args)
     except gorpc.GoRpcError as e:
@@ -76,3 +167,134 @@ class UpdateStreamConnection(object):
     except:
       logging.exception('gorpc low-level error')
       raise
+
+  def stream_next_batch(self, count):
+    """Returns up to count events, or an empty list at the end.
+
+    It waits for the first event only, the next ones are returned if
+    they have started to arrive.
+    """
+    events = []
+    try:
+      while len(events) < count and not self._stream_done:
+        if events and not self.client.stream_buffered():
+          break
+        response = self.client.stream_next()
+        if response is None:
+          self._stream_done = True
+          break
+        events.append(self._event(response.reply))
+    except gorpc.AppError as e:
+      raise dbexceptions.DatabaseError(*e.args)
+    except gorpc.GoRpcError as e:
+      raise dbexceptions.OperationalError(*e.args)
+    except:
+      logging.exception('gorpc low-level error')
+      raise
+    return events
+
+
+class UpdateStreamReader(object):
+  """Reads an update stream in a thread, and reconnects after errors.
+
+  Each event is given to the event callback, in stream order. The
+  position is moved past each POS event before the callback is called
+  for it, and a reconnection restarts the stream from that position, so
+  the events after the last POS event may be given twice.
+
+  Attributes:
+    position: replication position the stream is (re)started from.
+    reconnects: counter.
+  """
+
+  def __init__(self, connection_factory, position, on_event,
+               position_append=None, retry_delay=1.0, batch_size=100,
+               on_connect=None, on_disconnect=None,
+               name='update_stream_reader'):
+    """Creates the reader, call start to run it.
+
+    Args:
+      connection_factory: returns a new UpdateStreamConnection.
+      position: replication position to start from.
+      on_event: function(event) called from the reader thread for each
+        event, as returned by stream_next.
+      position_append: function(position, gtid_field) that returns the
+        position after a POS event, mysql_flavor specific. Without it,
+        reconnections restart from the initial position.
+      retry_delay: seconds to wait before reconnecting.
+      batch_size: maximum number of events read at once.
+      on_connect: optional function() called once the stream is started.
+      on_disconnect: optional function() called each time the stream
+        ends or fails, including when the reader is stopped.
+      name: name of the thread, and of the reader in the logs.
+    """
+    self.connection_factory = connection_factory
+    self.position = position
+    self.on_event = on_event
+    self.position_append = position_append
+    self.retry_delay = retry_delay
+    self.batch_size = batch_size
+    self.on_connect = on_connect
+    self.on_disconnect = on_disconnect
+    self.name = name
+    self.reconnects = 0
+    self.stopped = False
+    # Set by stop, to interrupt the retry delay.
+    self.stop_event = threading.Event()
+    self.conn = None
+    self.thread = None
+
+  def start(self):
+    self.stopped = False
+    self.stop_event.clear()
+    self.thread = threading.Thread(target=self.run, name=self.name)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    """Stops reading, and waits for the reader thread.
+
+    on_event must return soon once stop is called, for the thread to
+    exit.
+    """
+    self.stopped = True
+    self.stop_event.set()
+    conn = self.conn
+    if conn is not None:
+      conn.close()
+    if self.thread is not None and self.thread is not threading.current_thread():
+      self.thread.join()
+    self.thread = None
+
+  def run(self):
+    while not self.stopped:
+      try:
+        self._stream()
+      except Exception as e:
+        if not self.stopped:
+          logging.warning('%s: %s', self.name, e)
+      if self.on_disconnect is not None:
+        self.on_disconnect()
+      if self.stopped:
+        break
+      self.reconnects += 1
+      self.stop_event.wait(self.retry_delay)
+
+  def _stream(self):
+    self.conn = self.connection_factory()
+    self.conn.dial()
+    try:
+      event = self.conn.stream_start(self.position)
+      if self.on_connect is not None:
+        self.on_connect()
+      events = [] if event is None else [event]
+      while events and not self.stopped:
+        for event in events:
+          if event['Category'] == 'POS' and self.position_append is not None:
+            self.position = self.position_append(self.position,
+                                                 event['GTIDField'])
+          self.on_event(event)
+        events = self.conn.stream_next_batch(self.batch_size)
+    finally:
+      self.conn.close()
+      self.conn = None
@@ -2,8 +2,10 @@
 # Use of this source code is governed by a BSD-style license that can
 # be found in the LICENSE file.
 
+import functools
 import itertools
 import re
+import threading
 
 from vtdb import cursor
 from vtdb import dbexceptions
@@ -13,6 +15,76 @@ from vtdb import keyrange_constants
 write_sql_pattern = re.compile('\s*(insert|update|delete)', re.IGNORECASE)
 
 
+def _bind_vars_size(bind_variables):
+  """Rough estimate of the encoded size of a bind variable dict."""
+  if not bind_variables:
+    return 0
+  size = 0
+  for key, value in bind_variables.iteritems():
+    if isinstance(value, (list, tuple, set)):
+      size += len(key) + sum(len(str(v)) for v in value)
+    else:
+      size += len(key) + len(str(value))
+  return size
+
+
+def _freeze(value):
+  if isinstance(value, (list, tuple)):
+    return tuple(_freeze(v) for v in value)
+  if isinstance(value, (set, frozenset)):
+    return frozenset(_freeze(v) for v in value)
+  if isinstance(value, dict):
+    return tuple(sorted((k, _freeze(v)) for k, v in value.iteritems()))
+  return value
+
+
+class _InFlightRead(object):
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+class ReadCoalescer(object):
+  """Shares one in-flight rpc among identical concurrent reads.
+
+  The first caller for a key runs the read, the callers that come in
+  while it runs wait for it and get the same result, or exception.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.in_flight = {}
+    self.coalesced = 0
+
+  def do(self, key, func):
+    with self.lock:
+      read = self.in_flight.get(key)
+      leader = read is None
+      if leader:
+        read = _InFlightRead()
+        self.in_flight[key] = read
+      else:
+        self.coalesced += 1
+    if not leader:
+      read.done.wait()
+      if read.error is not None:
+        raise read.error
+      return read.result
+
+    try:
+      read.result = func()
+      return read.result
+    except Exception as e:
+      read.error = e
+      raise
+    finally:
+      with self.lock:
+        del self.in_flight[key]
+      read.done.set()
+
+
 class VTGateCursor(object):
   arraysize = 1
   lastrowid = None
@@ -25,15 +97,29 @@ class VTGateCursor(object):
   tablet_type = None
   keyspace_ids = None
   keyranges = None
+  shards = None
   _writable = None
   routing = None
-
-  def __init__(self, connection, keyspace, tablet_type, keyspace_ids=None, keyranges=None, writable=False):
+  # executemany sends its parameter sets in batches of at most
+  # executemany_max_rows queries and roughly executemany_max_bytes of
+  # sql and bind variables.
+  executemany_max_rows = 1000
+  executemany_max_bytes = 1024 * 1024
+  # Optional ReadCoalescer, shared by all the cursors, for the reads
+  # done outside of transactions.
+  read_coalescer = None
+  # Optional sql_normalizer.SQLNormalizer, shared by all the cursors,
+  # to turn the literals of execute into bind variables.
+  sql_normalizer = None
+
+  def __init__(self, connection, keyspace, tablet_type, keyspace_ids=None, keyranges=None, writable=False, shards=None):
     self._conn = connection
     self.keyspace = keyspace
     self.tablet_type = tablet_type
     self.keyspace_ids = keyspace_ids
     self.keyranges = keyranges
+    # Shard names, for custom sharded keyspaces.
+    self.shards = shards
     self._writable = writable
 
   def connection_list(self):
@@ -79,17 +165,43 @@ class VTGateCursor(object):
       if not self.is_writable():
         raise dbexceptions.DatabaseError('DML on a non-writable cursor', sql)
 
-    self.results, self.rowcount, self.lastrowid, self.description = self._conn._execute(
+    if self.sql_normalizer is not None:
+      sql, bind_variables = self.sql_normalizer.normalize(sql, bind_variables)
+
+    execute = functools.partial(
+        self._conn._execute,
         sql,
         bind_variables,
         self.keyspace,
         self.tablet_type,
         keyspace_ids=self.keyspace_ids,
         keyranges=self.keyranges,
-        not_in_transaction=(not self.is_writable()))
+        not_in_transaction=(not self.is_writable()),
+        shards=self.shards)
+    coalesce_key = None
+    if (self.read_coalescer is not None and not write_query and
+        not self.is_writable() and not self._conn.session):
+      coalesce_key = self._query_key(sql, bind_variables)
+    if coalesce_key is not None:
+      result = self.read_coalescer.do(coalesce_key, execute)
+    else:
+      result = execute()
+    self.results, self.rowcount, self.lastrowid, self.description = result
     self.index = 0
     return self.rowcount
 
+  def _query_key(self, sql, bind_variables):
+    keyranges = None
+    if self.keyranges is not None:
+      keyranges = tuple(str(kr) for kr in self.keyranges)
+    key = (sql, _freeze(bind_variables), self.keyspace, self.tablet_type,
+           _freeze(self.keyspace_ids), keyranges, _freeze(self.shards))
+    try:
+      hash(key)
+    except TypeError:
+      return None
+    return key
+
   def execute_entity_ids(self, sql, bind_variables, entity_keyspace_id_map, entity_column_name):
     self.rowcount = 0
     self.results = None
@@ -164,8 +276,67 @@ class VTGateCursor(object):
   def callproc(self):
     raise dbexceptions.NotSupportedError
 
-  def executemany(self, *pargs):
-    raise dbexceptions.NotSupportedError
+  def executemany(self, sql, seq_of_bind_variables):
+    """Executes sql once per bind variable dict, using batch rpcs.
+
+    The parameter sets are grouped into ExecuteBatchKeyspaceIds (or
+    ExecuteBatchShard) calls,
+    bounded by executemany_max_rows and executemany_max_bytes. Within a
+    transaction, all the batches are part of it. Outside of one, each
+    batch is committed on its own.
+
+    Args:
+      sql: the sql statement, with %(name)s bind variables.
+      seq_of_bind_variables: iterable of bind variable dicts.
+
+    Returns:
+      The total rowcount of all the executions.
+    """
+    self.rowcount = 0
+    self.results = None
+    self.description = None
+    self.lastrowid = None
+
+    if self.keyspace_ids is None and self.shards is None:
+      raise dbexceptions.NotSupportedError(
+          'executemany is only supported for keyspace_ids or shards routing')
+
+    write_query = bool(write_sql_pattern.match(sql))
+    if write_query:
+      if not self.is_writable():
+        raise dbexceptions.DatabaseError('DML on a non-writable cursor', sql)
+
+    batch_cursor = BatchVTGateCursor(self._conn, self.keyspace,
+                                     self.tablet_type,
+                                     keyspace_ids=self.keyspace_ids,
+                                     writable=self.is_writable(),
+                                     shards=self.shards)
+    rowcount = 0
+    chunk_rows = 0
+    chunk_bytes = 0
+    for bind_variables in seq_of_bind_variables:
+      batch_cursor.execute(sql, bind_variables)
+      chunk_rows += 1
+      chunk_bytes += len(sql) + _bind_vars_size(bind_variables)
+      if (chunk_rows >= self.executemany_max_rows or
+          chunk_bytes >= self.executemany_max_bytes):
+        rowcount += self._flush_executemany(batch_cursor)
+        chunk_rows = 0
+        chunk_bytes = 0
+    if chunk_rows:
+      rowcount += self._flush_executemany(batch_cursor)
+    self.rowcount = rowcount
+    return self.rowcount
+
+  def _flush_executemany(self, batch_cursor):
+    batch_cursor.flush()
+    rowcount = 0
+    # rowset is (results, rowcount, lastrowid, fields)
+    for rowset in batch_cursor.rowsets:
+      rowcount += rowset[1]
+      if rowset[2]:
+        self.lastrowid = rowset[2]
+    return rowcount
 
   def nextset(self):
     raise dbexceptions.NotSupportedError
@@ -194,19 +365,20 @@ class BatchVTGateCursor(VTGateCursor):
   """Batch Cursor for VTGate.
 
   This cursor allows 'n' queries to be executed against
-  'm' keyspace_ids. For writes though, it maybe prefereable
+  'm' keyspace_ids, or 'm' shards. For writes though, it maybe prefereable
   to only execute against one keyspace_id.
-  This only supports keyspace_ids right now since that is what
+  This only supports keyspace_ids and shards right now since that is what
   the underlying vtgate server supports.
   """
   def __init__(self, connection, keyspace, tablet_type, keyspace_ids=None,
-               writable=False):
+               writable=False, shards=None):
     # rowset is [(results, rowcount, lastrowid, fields),]
     self.rowsets = None
     self.query_list = []
     self.bind_vars_list = []
     VTGateCursor.__init__(self, connection, keyspace, tablet_type,
-                          keyspace_ids=keyspace_ids, writable=writable)
+                          keyspace_ids=keyspace_ids, writable=writable,
+                          shards=shards)
 
   def execute(self, sql, bind_variables=None):
     self.query_list.append(sql)
@@ -218,11 +390,54 @@ class BatchVTGateCursor(VTGateCursor):
                                               self.keyspace,
                                               self.tablet_type,
                                               self.keyspace_ids,
-                                              not_in_transaction=(not self.is_writable()))
+                                              not_in_transaction=(not self.is_writable()),
+                                              shards=self.shards)
     self.query_list = []
     self.bind_vars_list = []
 
 
+class MultiBatchVTGateCursor(object):
+  """Batch cursor where each query has its own keyspace and routing.
+
+  The queries are sent with as few batch calls as possible, one per
+  distinct keyspace and routing (see
+  VTGateConnection._execute_batch_multi), and rowsets are in the order
+  of the queries.
+  """
+
+  def __init__(self, connection, tablet_type, writable=False):
+    # rowset is [(results, rowcount, lastrowid, fields),]
+    self.rowsets = None
+    self.queries = []
+    self._conn = connection
+    self.tablet_type = tablet_type
+    self._writable = writable
+
+  def is_writable(self):
+    return self._writable
+
+  def execute(self, sql, bind_variables, keyspace, keyspace_ids=None,
+              shards=None):
+    if keyspace_ids is None and shards is None:
+      raise dbexceptions.ProgrammingError(
+          'keyspace_ids or shards are required for a batch query', sql)
+    if write_sql_pattern.match(sql) and not self.is_writable():
+      raise dbexceptions.DatabaseError('DML on a non-writable cursor', sql)
+    query = {'Sql': sql, 'BindVariables': bind_variables,
+             'Keyspace': keyspace}
+    if keyspace_ids is not None:
+      query['KeyspaceIds'] = keyspace_ids
+    else:
+      query['Shards'] = shards
+    self.queries.append(query)
+
+  def flush(self):
+    self.rowsets = self._conn._execute_batch_multi(
+        self.queries, self.tablet_type,
+        not_in_transaction=(not self.is_writable()))
+    self.queries = []
+
+
 class StreamVTGateCursor(VTGateCursor):
   arraysize = 1
   conversions = None
@@ -231,8 +446,8 @@ class StreamVTGateCursor(VTGateCursor):
   index = None
   fetchmany_done = False
 
-  def __init__(self, connection, keyspace, tablet_type, keyspace_ids=None, keyranges=None, writable=False):
-    VTGateCursor.__init__(self, connection, keyspace, tablet_type, keyspace_ids=keyspace_ids, keyranges=keyranges)
+  def __init__(self, connection, keyspace, tablet_type, keyspace_ids=None, keyranges=None, writable=False, shards=None):
+    VTGateCursor.__init__(self, connection, keyspace, tablet_type, keyspace_ids=keyspace_ids, keyranges=keyranges, shards=shards)
 
   # pass kargs here in case higher level APIs need to push more data through
   # for instance, a key value for shard mapping
@@ -248,7 +463,8 @@ class StreamVTGateCursor(VTGateCursor):
         self.tablet_type,
         keyspace_ids=self.keyspace_ids,
         keyranges=self.keyranges,
-        not_in_transaction=(not self.is_writable()))
+        not_in_transaction=(not self.is_writable()),
+        shards=self.shards)
     self.index = 0
     return 0
 
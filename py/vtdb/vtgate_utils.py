@@ -30,6 +30,15 @@ def log_exception(exc, keyspace=None, tablet_type=None):
                                      exc)
 
 
+def is_empty_transaction(session):
+  """Returns True if the session is of a transaction without statements.
+
+  Such a transaction has no shard session, there is nothing to commit or
+  rollback on the server side.
+  """
+  return session is not None and not session.get('ShardSessions')
+
+
 def exponential_backoff_retry(
     retry_exceptions,
     initial_delay_ms=INITIAL_DELAY_MS,
@@ -2,6 +2,7 @@
 # Use of this source code is governed by a BSD-style license that can
 # be found in the LICENSE file.
 
+import collections
 from itertools import izip
 import logging
 import random
@@ -103,6 +104,21 @@ def _create_req_with_keyranges(sql, new_binds, keyspace, tablet_type, keyranges,
   return req
 
 
+def _create_req_with_shards(sql, new_binds, keyspace, tablet_type, shards, not_in_transaction):
+  # shards are shard names, for custom sharded keyspaces.
+  sql, new_binds = dbapi.prepare_query_bind_vars(sql, new_binds)
+  new_binds = field_types.convert_bind_vars(new_binds)
+  req = {
+        'Sql': sql,
+        'BindVariables': new_binds,
+        'Keyspace': keyspace,
+        'TabletType': tablet_type,
+        'Shards': shards,
+        'NotInTransaction': not_in_transaction,
+        }
+  return req
+
+
 # A simple, direct connection to the vttablet query server.
 # This is shard-unaware and only handles the most basic communication.
 # If something goes wrong, this object should be thrown away and a new one instantiated.
@@ -113,9 +129,10 @@ class VTGateConnection(object):
   _stream_result = None
   _stream_result_index = None
 
-  def __init__(self, addr, timeout, user=None, password=None, encrypted=False, keyfile=None, certfile=None):
+  def __init__(self, addr, timeout, user=None, password=None, encrypted=False, keyfile=None, certfile=None, lazy_begin=False):
     self.addr = addr
     self.timeout = timeout
+    self.lazy_begin = lazy_begin
     self.client = bsonrpc.BsonRpcClient(addr, timeout, user, password, encrypted=encrypted, keyfile=keyfile, certfile=certfile)
     self.logger_object = vtdb_logger.get_logger()
 
@@ -149,6 +166,12 @@ class VTGateConnection(object):
     return cursorclass(self, *pargs, **kwargs)
 
   def begin(self):
+    # VTGate.Begin only marks the session as in transaction, the shard
+    # transactions are started by the statements. With lazy_begin, the
+    # session is created here instead, saving the rpc.
+    if self.lazy_begin:
+      self.session = {'InTransaction': True, 'ShardSessions': []}
+      return
     try:
       response = self.client.call('VTGate.Begin', None)
       self.session = response.reply
@@ -158,6 +181,8 @@ class VTGateConnection(object):
   def commit(self):
     try:
       session = self.session
+      if self.lazy_begin and vtgate_utils.is_empty_transaction(session):
+        return
       self.client.call('VTGate.Commit', session)
     except gorpc.GoRpcError as e:
       raise convert_exception(e, str(self))
@@ -167,6 +192,8 @@ class VTGateConnection(object):
   def rollback(self):
     try:
       session = self.session
+      if self.lazy_begin and vtgate_utils.is_empty_transaction(session):
+        return
       self.client.call('VTGate.Rollback', session)
     except gorpc.GoRpcError as e:
       raise convert_exception(e, str(self))
@@ -182,7 +209,7 @@ class VTGateConnection(object):
       self.session = response.reply['Session']
 
   @vtgate_utils.exponential_backoff_retry((dbexceptions.RequestBacklog))
-  def _execute(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids=None, keyranges=None, not_in_transaction=False):
+  def _execute(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids=None, keyranges=None, not_in_transaction=False, shards=None):
     exec_method = None
     req = None
     if keyspace_ids is not None:
@@ -191,8 +218,11 @@ class VTGateConnection(object):
     elif keyranges is not None:
       req = _create_req_with_keyranges(sql, bind_variables, keyspace, tablet_type, keyranges, not_in_transaction)
       exec_method = 'VTGate.ExecuteKeyRanges'
+    elif shards is not None:
+      req = _create_req_with_shards(sql, bind_variables, keyspace, tablet_type, shards, not_in_transaction)
+      exec_method = 'VTGate.ExecuteShard'
     else:
-      raise dbexceptions.ProgrammingError('_execute called without specifying keyspace_ids or keyranges')
+      raise dbexceptions.ProgrammingError('_execute called without specifying keyspace_ids, keyranges or shards')
 
     self._add_session(req)
 
@@ -222,7 +252,8 @@ class VTGateConnection(object):
     except gorpc.GoRpcError as e:
       self.logger_object.log_private_data(bind_variables)
       raise convert_exception(e, str(self), sql, keyspace_ids, keyranges,
-                              keyspace=keyspace, tablet_type=tablet_type)
+                              shards, keyspace=keyspace,
+                              tablet_type=tablet_type)
     except:
       logging.exception('gorpc low-level error')
       raise
@@ -278,7 +309,7 @@ class VTGateConnection(object):
 
 
   @vtgate_utils.exponential_backoff_retry((dbexceptions.RequestBacklog))
-  def _execute_batch(self, sql_list, bind_variables_list, keyspace, tablet_type, keyspace_ids, not_in_transaction=False):
+  def _execute_batch(self, sql_list, bind_variables_list, keyspace, tablet_type, keyspace_ids, not_in_transaction=False, shards=None):
     query_list = []
     for sql, bind_vars in zip(sql_list, bind_variables_list):
       sql, bind_vars = dbapi.prepare_query_bind_vars(sql, bind_vars)
@@ -294,14 +325,21 @@ class VTGateConnection(object):
           'Queries': query_list,
           'Keyspace': keyspace,
           'TabletType': tablet_type,
-          'KeyspaceIds': keyspace_ids,
           'NotInTransaction': not_in_transaction,
       }
+      if keyspace_ids is not None:
+        req['KeyspaceIds'] = keyspace_ids
+        exec_method = 'VTGate.ExecuteBatchKeyspaceIds'
+      elif shards is not None:
+        req['Shards'] = shards
+        exec_method = 'VTGate.ExecuteBatchShard'
+      else:
+        raise dbexceptions.ProgrammingError('_execute_batch called without specifying keyspace_ids or shards')
       self._add_session(req)
-      response = self.client.call('VTGate.ExecuteBatchKeyspaceIds', req)
+      response = self.client.call(exec_method, req)
       self._update_session(response)
       if 'Error' in response.reply and response.reply['Error']:
-        raise gorpc.AppError(response.reply['Error'], 'VTGate.ExecuteBatchKeyspaceIds')
+        raise gorpc.AppError(response.reply['Error'], exec_method)
       for reply in response.reply['List']:
         fields = []
         conversions = []
@@ -320,18 +358,99 @@ class VTGateConnection(object):
         rowsets.append((results, rowcount, lastrowid, fields))
     except gorpc.GoRpcError as e:
       self.logger_object.log_private_data(bind_variables_list)
-      raise convert_exception(e, str(self), sql_list, keyspace_ids,
+      raise convert_exception(e, str(self), sql_list, keyspace_ids, shards,
                               keyspace=keyspace, tablet_type=tablet_type)
     except:
       logging.exception('gorpc low-level error')
       raise
     return rowsets
 
+  def _execute_batch_multi(self, queries, tablet_type, not_in_transaction=False):
+    """Executes a batch of queries with their own keyspace and routing.
+
+    vtgate batch calls only take one keyspace and one set of keyspace
+    ids or shards, so the queries are grouped by routing, and each group
+    is sent as one batch call.
+
+    Args:
+      queries: list of dicts with the 'Sql', 'BindVariables' and
+        'Keyspace' of each query, and its 'KeyspaceIds' or 'Shards'.
+      tablet_type: tablet type of all the queries.
+      not_in_transaction: as in _execute_batch.
+
+    Returns:
+      The rowsets of the queries, in order, as in _execute_batch.
+    """
+    # routing -> indexes of the queries, in the order of first use.
+    groups = collections.OrderedDict()
+    for i, query in enumerate(queries):
+      keyspace_ids = query.get('KeyspaceIds')
+      shards = query.get('Shards')
+      if keyspace_ids is None and shards is None:
+        raise dbexceptions.ProgrammingError(
+            'query without KeyspaceIds or Shards in batch', query['Sql'])
+      routing = (query['Keyspace'],
+                 None if keyspace_ids is None else tuple(keyspace_ids),
+                 None if shards is None else tuple(shards))
+      groups.setdefault(routing, []).append(i)
+
+    rowsets = [None] * len(queries)
+    for (keyspace, keyspace_ids, shards), indexes in groups.iteritems():
+      group_rowsets = self._execute_batch(
+          [queries[i]['Sql'] for i in indexes],
+          [queries[i].get('BindVariables') for i in indexes],
+          keyspace, tablet_type,
+          None if keyspace_ids is None else list(keyspace_ids),
+          not_in_transaction=not_in_transaction,
+          shards=None if shards is None else list(shards))
+      for i, rowset in zip(indexes, group_rowsets):
+        rowsets[i] = rowset
+    return rowsets
+
+  def split_query(self, sql, bind_variables, keyspace, split_count):
+    """Splits a query into sub queries over non-overlapping row ranges.
+
+    vtgate computes the sub queries on the rdonly tablets, from the
+    primary key ranges of the table. Their rows add up to the rows of
+    the original query.
+
+    Args:
+      sql: select query on one table.
+      bind_variables: bind variables of sql.
+      keyspace: keyspace of the table.
+      split_count: desired number of sub queries. vtgate returns a
+        multiple of the number of shards.
+
+    Returns:
+      A list of splits, for _stream_execute_split. Each is a dict with
+      the 'Sql' and 'BindVariables' of the sub query (in the vtgate
+      :name syntax), its 'Keyspace', its estimated 'Size' in rows, and
+      either 'KeyRanges' (for range-sharded keyspaces) or 'Shards'.
+    """
+    sql, new_binds = dbapi.prepare_query_bind_vars(sql, bind_variables)
+    req = {
+        'Keyspace': keyspace,
+        'Query': {
+            'Sql': sql,
+            'BindVariables': field_types.convert_bind_vars(new_binds),
+            },
+        'SplitCount': split_count,
+        }
+    try:
+      response = self.client.call('VTGate.SplitQuery', req)
+    except gorpc.GoRpcError as e:
+      self.logger_object.log_private_data(bind_variables)
+      raise convert_exception(e, str(self), sql, keyspace=keyspace)
+    except:
+      logging.exception('gorpc low-level error')
+      raise
+    return [_make_split(part) for part in response.reply['Splits']]
+
   # we return the fields for the response, and the column conversions
   # the conversions will need to be passed back to _stream_next
   # (that way we avoid using a member variable here for such a corner case)
   @vtgate_utils.exponential_backoff_retry((dbexceptions.RequestBacklog))
-  def _stream_execute(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids=None, keyranges=None, not_in_transaction=False):
+  def _stream_execute(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids=None, keyranges=None, not_in_transaction=False, shards=None):
     exec_method = None
     req = None
     if keyspace_ids is not None:
@@ -340,11 +459,38 @@ class VTGateConnection(object):
     elif keyranges is not None:
       req = _create_req_with_keyranges(sql, bind_variables, keyspace, tablet_type, keyranges, not_in_transaction)
       exec_method = 'VTGate.StreamExecuteKeyRanges'
+    elif shards is not None:
+      req = _create_req_with_shards(sql, bind_variables, keyspace, tablet_type, shards, not_in_transaction)
+      exec_method = 'VTGate.StreamExecuteShard'
     else:
-      raise dbexceptions.ProgrammingError('_stream_execute called without specifying keyspace_ids or keyranges')
+      raise dbexceptions.ProgrammingError('_stream_execute called without specifying keyspace_ids, keyranges or shards')
 
     self._add_session(req)
+    return self._start_stream(exec_method, req, bind_variables, sql,
+                              keyspace_ids, keyranges, shards)
+
+  @vtgate_utils.exponential_backoff_retry((dbexceptions.RequestBacklog))
+  def _stream_execute_split(self, split, tablet_type):
+    """Starts streaming the rows of a split returned by split_query."""
+    # The split is already in the vtgate bind variable syntax.
+    req = {
+        'Sql': split['Sql'],
+        'BindVariables': field_types.convert_bind_vars(split['BindVariables']),
+        'Keyspace': split['Keyspace'],
+        'TabletType': tablet_type,
+        'NotInTransaction': True,
+        }
+    if split.get('KeyRanges') is not None:
+      req['KeyRanges'] = split['KeyRanges']
+      exec_method = 'VTGate.StreamExecuteKeyRanges'
+    else:
+      req['Shards'] = split['Shards']
+      exec_method = 'VTGate.StreamExecuteShard'
+    return self._start_stream(exec_method, req, split['BindVariables'],
+                              split['Sql'], split.get('KeyRanges'),
+                              split.get('Shards'))
 
+  def _start_stream(self, exec_method, req, bind_variables, *error_args):
     self._stream_fields = []
     self._stream_conversions = []
     self._stream_result = None
@@ -359,8 +505,9 @@ class VTGateConnection(object):
         self._stream_conversions.append(field_types.conversions.get(field['Type']))
     except gorpc.GoRpcError as e:
       self.logger_object.log_private_data(bind_variables)
-      raise convert_exception(e, str(self), sql, keyspace_ids, keyranges,
-                              keyspace=keyspace, tablet_type=tablet_type)
+      raise convert_exception(e, str(self), *error_args,
+                              keyspace=req['Keyspace'],
+                              tablet_type=req['TabletType'])
     except:
       logging.exception('gorpc low-level error')
       raise
@@ -400,6 +547,22 @@ class VTGateConnection(object):
     return row
 
 
+def _make_split(part):
+  if part.get('Query'):
+    query = part['Query']
+    split = {'KeyRanges': [
+        keyrange.KeyRange((kr['Start'].encode('hex'), kr['End'].encode('hex')))
+        for kr in query['KeyRanges']]}
+  else:
+    query = part['QueryShard']
+    split = {'Shards': query['Shards']}
+  split['Sql'] = query['Sql']
+  split['BindVariables'] = query['BindVariables'] or {}
+  split['Keyspace'] = query['Keyspace']
+  split['Size'] = part.get('Size', 0)
+  return split
+
+
 def _make_row(row, conversions):
   converted_row = []
   for conversion_func, field_data in izip(conversions, row):
@@ -441,7 +604,7 @@ def get_params_for_vtgate_conn(vtgate_addrs, timeout, encrypted=False, user=None
   return db_params_list
 
 
-def connect(vtgate_addrs, timeout, encrypted=False, user=None, password=None):
+def connect(vtgate_addrs, timeout, encrypted=False, user=None, password=None, lazy_begin=False):
   db_params_list = get_params_for_vtgate_conn(vtgate_addrs, timeout,
                                               encrypted=encrypted, user=user,
                                               password=password)
@@ -455,7 +618,7 @@ def connect(vtgate_addrs, timeout, encrypted=False, user=None, password=None):
     try:
       db_params = params.copy()
       host_addr = db_params['addr']
-      conn = VTGateConnection(**db_params)
+      conn = VTGateConnection(lazy_begin=lazy_begin, **db_params)
       conn.dial()
       return conn
     except Exception as e:
@@ -12,6 +12,7 @@ from net import gorpc
 from vtdb import dbexceptions
 from vtdb import field_types
 from vtdb import vtdb_logger
+from vtdb import vtgate_utils
 from vtdb import cursorv3
 
 
@@ -95,9 +96,10 @@ class VTGateConnection(object):
   _stream_result = None
   _stream_result_index = None
 
-  def __init__(self, addr, timeout, user=None, password=None, encrypted=False, keyfile=None, certfile=None):
+  def __init__(self, addr, timeout, user=None, password=None, encrypted=False, keyfile=None, certfile=None, lazy_begin=False):
     self.addr = addr
     self.timeout = timeout
+    self.lazy_begin = lazy_begin
     self.client = bsonrpc.BsonRpcClient(addr, timeout, user, password, encrypted=encrypted, keyfile=keyfile, certfile=certfile)
     self.logger_object = vtdb_logger.get_logger()
 
@@ -131,6 +133,12 @@ class VTGateConnection(object):
     return cursorclass(self, *pargs, **kwargs)
 
   def begin(self):
+    # VTGate.Begin only marks the session as in transaction, the shard
+    # transactions are started by the statements. With lazy_begin, the
+    # session is created here instead, saving the rpc.
+    if self.lazy_begin:
+      self.session = {'InTransaction': True, 'ShardSessions': []}
+      return
     try:
       response = self.client.call('VTGate.Begin', None)
       self.session = response.reply
@@ -141,6 +149,8 @@ class VTGateConnection(object):
     try:
       session = self.session
       self.session = None
+      if self.lazy_begin and vtgate_utils.is_empty_transaction(session):
+        return
       self.client.call('VTGate.Commit', session)
     except gorpc.GoRpcError as e:
       raise convert_exception(e, str(self))
@@ -149,6 +159,8 @@ class VTGateConnection(object):
     try:
       session = self.session
       self.session = None
+      if self.lazy_begin and vtgate_utils.is_empty_transaction(session):
+        return
       self.client.call('VTGate.Rollback', session)
     except gorpc.GoRpcError as e:
       raise convert_exception(e, str(self))
@@ -3,6 +3,7 @@ import logging
 import os
 import random
 import threading
+import time
 
 from net import bsonrpc
 from net import gorpc
@@ -190,6 +191,213 @@ class ZkOccConnection(object):
   def children(self, path):
     return self._call('children', self._resolve_path(path))
 
+class _ZkOccServer(object):
+  """Idle connections and health of one server of a PooledZkOccConnection."""
+
+  def __init__(self, addr):
+    self.addr = addr
+    self.idle = []
+    self.in_use = 0
+    # consecutive failures, and time until which the server is avoided
+    self.failures = 0
+    self.down_until = 0.0
+    self.calls = 0
+    self.errors = 0
+
+
+def _is_app_error(e):
+  # SimpleZkOccConnection wraps the rpc error as the second argument.
+  return (isinstance(e, ZkOccError) and len(e.args) > 1 and
+          isinstance(e.args[1], gorpc.AppError))
+
+
+# A ZkOccConnection that serves concurrent calls, with a pool of
+# SimpleZkOccConnection per server. Calls go to the healthy server with
+# the fewest calls in flight. A server that fails is avoided for
+# down_delay seconds, doubled at each consecutive failure up to
+# max_down_delay. A call that fails to reach a server is retried on
+# another one, up to max_attempts servers, each tried at most once, and
+# within timeout seconds. Application errors (e.g. unknown keyspace) are
+# raised right away, and don't count against the health of the server.
+class PooledZkOccConnection(ZkOccConnection):
+  max_attempts = 3
+  max_idle_per_server = 4
+  down_delay = 1.0
+  max_down_delay = 30.0
+
+  def __init__(self, addrs, local_cell, timeout, user=None, password=None):
+    super(PooledZkOccConnection, self).__init__(addrs, local_cell, timeout,
+                                                user=user, password=password)
+    self.servers = dict((addr, _ZkOccServer(addr)) for addr in self.addrs)
+
+  def refresh_addrs(self, addrs):
+    self.addrs = addrs.split(',')
+    with self.lock:
+      removed = [server for addr, server in self.servers.iteritems()
+                 if addr not in self.addrs]
+      for server in removed:
+        del self.servers[server.addr]
+      for addr in self.addrs:
+        if addr not in self.servers:
+          self.servers[addr] = _ZkOccServer(addr)
+    for server in removed:
+      self._close_idle(server)
+
+  def dial(self):
+    # Checks that a server can be reached, and keeps its connection.
+    tried = []
+    for _ in xrange(min(self.max_dial_attempts, len(self.addrs))):
+      server = self._pick(tried)
+      if server is None:
+        break
+      tried.append(server.addr)
+      try:
+        conn = self._get_conn(server)
+      except Exception:
+        self._release(server, None)
+        self._mark_down(server)
+        continue
+      self._release(server, conn)
+      self._mark_up(server)
+      return
+    raise ZkOccError("Cannot dial to any server, tried: {0!s}".format(tried))
+
+  def close(self):
+    with self.lock:
+      servers = self.servers.values()
+    for server in servers:
+      self._close_idle(server)
+
+  def _close_idle(self, server):
+    with self.lock:
+      idle, server.idle = server.idle, []
+    for conn in idle:
+      conn.close()
+
+  def _pick(self, tried):
+    # Returns the least busy healthy server not tried yet, or the one
+    # coming back up first if they are all down.
+    with self.lock:
+      candidates = [s for s in self.servers.itervalues()
+                    if s.addr not in tried]
+      if not candidates:
+        return None
+      now = time.time()
+      up = [s for s in candidates if s.down_until <= now]
+      if up:
+        least = min(s.in_use for s in up)
+        server = random.choice([s for s in up if s.in_use == least])
+      else:
+        server = min(candidates, key=lambda s: s.down_until)
+      server.in_use += 1
+      server.calls += 1
+      return server
+
+  def _get_conn(self, server):
+    with self.lock:
+      if server.idle:
+        return server.idle.pop()
+    conn = SimpleZkOccConnection(server.addr, self.timeout, self.user,
+                                 self.password)
+    conn.dial()
+    return conn
+
+  def _release(self, server, conn):
+    with self.lock:
+      server.in_use -= 1
+      if conn is None:
+        return
+      if (self.servers.get(server.addr) is server and
+          len(server.idle) < self.max_idle_per_server):
+        server.idle.append(conn)
+        return
+    conn.close()
+
+  def _mark_up(self, server):
+    with self.lock:
+      server.failures = 0
+      server.down_until = 0.0
+
+  def _mark_down(self, server):
+    with self.lock:
+      server.errors += 1
+      server.failures += 1
+      delay = min(self.max_down_delay,
+                  self.down_delay * 2 ** (server.failures - 1))
+      server.down_until = time.time() + delay
+    self._close_idle(server)
+
+  def _call(self, client_method, *args, **kwargs):
+    deadline = time.time() + self.timeout
+    tried = []
+    error = None
+    while True:
+      server = self._pick(tried)
+      if server is None:
+        break
+      tried.append(server.addr)
+      conn = None
+      try:
+        conn = self._get_conn(server)
+        result = getattr(conn, client_method)(*args, **kwargs)
+      except Exception as e:
+        if _is_app_error(e):
+          self._release(server, conn)
+          raise
+        error = e
+        if conn is not None:
+          conn.close()
+        self._release(server, None)
+        self._mark_down(server)
+        logging.warning('zkocc: %s command failed %u times on %s: %s',
+                        client_method, len(tried), server.addr, e)
+        if len(tried) >= self.max_attempts or time.time() >= deadline:
+          break
+        continue
+      self._release(server, conn)
+      self._mark_up(server)
+      return result
+    raise ZkOccError('zkocc {0!s} command failed on {1!s}: {2!s}'.format(
+        client_method, tried, error))
+
+  def stats(self):
+    now = time.time()
+    with self.lock:
+      return dict((addr, {'Calls': server.calls,
+                          'Errors': server.errors,
+                          'InUse': server.in_use,
+                          'Idle': len(server.idle),
+                          'Down': server.down_until > now})
+                  for addr, server in self.servers.iteritems())
+
+def _map_key_ranges(srv_keyspace, convert):
+  # Returns a copy of a SrvKeyspace, with convert applied to the KeyRange
+  # bounds of all its shard references.
+  def shard_references(references):
+    return [dict(ref, KeyRange={'Start': convert(ref['KeyRange']['Start']),
+                                'End': convert(ref['KeyRange']['End'])})
+            for ref in references]
+  result = dict(srv_keyspace)
+  if result.get('ShardReferences'):
+    result['ShardReferences'] = shard_references(result['ShardReferences'])
+  if result.get('Partitions'):
+    result['Partitions'] = dict(
+        (db_type, dict(partition, ShardReferences=shard_references(
+            partition.get('ShardReferences') or [])))
+        for db_type, partition in result['Partitions'].iteritems())
+  return result
+
+
+# Returns a copy of a SrvKeyspace that can be stored as json: the binary
+# KeyRange bounds are hex encoded.
+def encode_srv_keyspace(srv_keyspace):
+  return _map_key_ranges(srv_keyspace, lambda b: b.encode('hex'))
+
+
+# Reverses encode_srv_keyspace.
+def decode_srv_keyspace(srv_keyspace):
+  return _map_key_ranges(srv_keyspace, lambda b: str(b).decode('hex'))
+
 # use this class for faking out a zkocc client. The startup config values
 # can be loaded from a json file. After that, they can be mass-altered
 # to replace default values with test-specific values, for instance.
@@ -200,11 +408,15 @@ class FakeZkOccConnection(object):
 
   @classmethod
   def from_data_path(cls, local_cell, data_path):
-    # Returns client with data at given data_path loaded.
+    # Returns client with data at given data_path loaded. The file is
+    # either a map of zk path to value, or a topology snapshot (see
+    # vtdb/topo_snapshot.py) with such a map as 'Data'.
     client = cls(local_cell)
     with open(data_path) as f:
-      data = f.read()
-    for key, value in json.loads(data).iteritems():
+      data = json.loads(f.read())
+    if 'Version' in data and 'Data' in data:
+      data = data['Data']
+    for key, value in data.iteritems():
       client.data[key] = json.dumps(value)
     return client
 
@@ -272,14 +484,9 @@ class FakeZkOccConnection(object):
       data = self.get(keyspace_path)['Data']
       if not data:
         raise ZkOccError("FakeZkOccConnection: empty keyspace: " + keyspace)
-      result = json.loads(data)
       # for convenience, we store the KeyRange as hex, but we need to
       # decode it here, as BSON RPC sends it as binary.
-      if 'ShardReferences' in result:
-        for shard in result['ShardReferences']:
-          shard['KeyRange']['Start'] = shard['KeyRange']['Start'].decode('hex')
-          shard['KeyRange']['End'] = shard['KeyRange']['End'].decode('hex')
-      return result
+      return decode_srv_keyspace(json.loads(data))
     except Exception as e:
       raise ZkOccError('FakeZkOccConnection: invalid keyspace', keyspace, e)
 
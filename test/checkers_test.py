@@ -51,6 +51,19 @@ class MockChecker(checker.Checker):
   def handle_mismatch(self, mismatch):
     self.mismatches.append(mismatch)
 
+
+class MockParallelChecker(checker.ParallelChecker):
+  checker_class = MockChecker
+
+  @property
+  def mismatches(self):
+    return sum((c.mismatches for c in self.checkers), [])
+
+
+class MockTableScheduler(checker.TableScheduler):
+  checker_class = MockChecker
+
+
 class TestCheckersBase(unittest.TestCase):
   keyrange = {"end": 900}
 
@@ -65,6 +78,17 @@ class TestCheckersBase(unittest.TestCase):
     destination_socket = destination_tablet.mysql_connection_parameters('test_checkers')['unix_socket']
     return MockChecker('vt_dba@localhost/test_checkers?unix_socket={0!s}'.format(destination_socket), source_addresses, destination_table_name, **default)
 
+  def make_parallel_checker(self, partitions, destination_table_name="test", **kwargs):
+    default = {'keyrange': TestCheckersBase.keyrange,
+               'batch_count': 20,
+               'logging_level': logging.WARNING,
+               'directory': tempfile.mkdtemp()}
+    default.update(kwargs)
+    source_addresses = ['vt_dba@localhost:{0!s}/test_checkers{1!s}?unix_socket={2!s}'.format(s.mysql_port, i, s.mysql_connection_parameters('test_checkers')['unix_socket'])
+                        for i, s in enumerate(source_tablets)]
+    destination_socket = destination_tablet.mysql_connection_parameters('test_checkers')['unix_socket']
+    return MockParallelChecker('vt_dba@localhost/test_checkers?unix_socket={0!s}'.format(destination_socket), source_addresses, destination_table_name, partitions, **default)
+
 
 class TestSortedRowListDifference(unittest.TestCase):
   def test_sorted_row_list_difference(self):
@@ -76,6 +100,67 @@ class TestSortedRowListDifference(unittest.TestCase):
     self.assertEqual(unexpected, [(10, 0)])
     self.assertEqual(different, [((6, 1), (6, 0))])
 
+  def test_one_list_ends_first(self):
+    rows = [(1, 0), (2, 0), (3, 0)]
+    self.assertEqual(checker.sorted_row_list_difference(rows, rows[:1], 1),
+                     (rows[1:], [], []))
+    self.assertEqual(checker.sorted_row_list_difference(rows[:1], rows, 1),
+                     ([], rows[1:], []))
+    self.assertEqual(checker.sorted_row_list_difference([], rows, 1),
+                     ([], rows, []))
+
+  def test_compare_serialized_batch(self):
+    destination = [(1, 0), (3, 0), (4, 0), (5, 0), (6, 1), (10, 0)]
+    sources = [[(1, 0), (3, 0), (5, 0)], [(2, 0), (4, 0), (6, 0)]]
+    payload = checker.pickle.dumps((destination, sources), checker.pickle.HIGHEST_PROTOCOL)
+    result = checker.pickle.loads(checker.compare_serialized_batch(payload, 1))
+    self.assertEqual(result, ([(2, 0)], [(10, 0)], [((6, 1), (6, 0))]))
+    payload = checker.pickle.dumps((destination[:2], [destination[:2]]), checker.pickle.HIGHEST_PROTOCOL)
+    self.assertEqual(checker.compare_serialized_batch(payload, 1), None)
+
+
+class TestSplitRange(unittest.TestCase):
+  def test_split_range(self):
+    self.assertEqual(checker.split_range(0, 100, 4), [25, 50, 75])
+    self.assertEqual(checker.split_range(1, 5, 2), [3])
+    self.assertEqual(checker.split_range(0, 2, 4), [1])
+    self.assertEqual(checker.split_range(0, 100, 1), [])
+
+class TestBatchSizer(unittest.TestCase):
+  def test_latency(self):
+    sizer = checker.BatchSizer(100, target_latency=1.0, min_batch_size=10, max_batch_size=1000)
+    # 4 times too slow: shrink at once.
+    self.assertEqual(sizer.update('destination', 100, 4.0), 25)
+    self.assertEqual(sizer.last_good_size, 100)
+    # 10 times too fast: grow by at most 2.
+    self.assertEqual(sizer.update('destination', 25, 0.1), 50)
+    self.assertEqual(sizer.last_good_size, 25)
+    self.assertEqual(sizer.update('destination', 50, 0.2), 100)
+    self.assertEqual(sizer.update('destination', 100, 0.4), 200)
+    self.assertEqual(sizer.update('destination', 200, 0.8), 250)
+
+  def test_last_good_size_is_the_query_limit(self):
+    sizer = checker.BatchSizer(100, target_latency=1.0, max_batch_size=1000)
+    sizer.update('destination', 100, 0.1)
+    self.assertEqual(sizer.batch_size, 200)
+    # A query sent with the previous batch size was within the target.
+    sizer.update('sources', 100, 0.5, limit=100)
+    self.assertEqual(sizer.last_good_size, 100)
+
+  def test_slowest_query_wins(self):
+    sizer = checker.BatchSizer(100, target_latency=1.0)
+    sizer.update('destination', 100, 0.1)
+    self.assertEqual(sizer.update('sources', 100, 2.0), 50)
+
+  def test_bytes_and_bounds(self):
+    sizer = checker.BatchSizer(100, target_bytes=1000, min_batch_size=20, max_batch_size=150)
+    self.assertEqual(sizer.update('destination', 100, 0.1, 100000), 20)
+    self.assertEqual(sizer.update('destination', 20, 0.1, 10), 40)
+    # Small results are ignored.
+    self.assertEqual(sizer.update('destination', 5, 10.0, 10), 40)
+    self.assertEqual(sizer.reset(1000), 150)
+
+
 class TestCheckers(TestCheckersBase):
 
   @classmethod
@@ -135,6 +220,133 @@ class TestCheckers(TestCheckersBase):
     self.c._run()
     self.assertEqual(len(self.c.mismatches), 2)
 
+  def test_parallel_ok(self):
+    c = self.make_parallel_checker(3)
+    self.assertEqual([(p['start'], p['end']) for p in c.partitions],
+                     [(None, 2), (2, 3), (3, None)])
+    c._run()
+    self.assertFalse(c.mismatches)
+    self.assertEqual(c.stats.items, 399)
+
+  def test_parallel_mismatches(self):
+    destination_tablet.mquery("test_checkers", "update test set msg='something else' where pk2 = 29 and pk3 = 280 and pk1 = 3", write=True)
+    destination_tablet.mquery("test_checkers", "insert into test (pk1, pk2, pk3) values (1, 1, 900)", write=True)
+    c = self.make_parallel_checker(3)
+    c._run()
+    self.assertEqual(len(c.mismatches), 2)
+    self.assertTrue(all(p.done for p in c.checkers))
+
+  def test_parallel_resume(self):
+    directory = tempfile.mkdtemp()
+    c = self.make_parallel_checker(3, directory=directory)
+    c._run()
+    destination_tablet.mquery("test_checkers", "update test set msg='something else' where pk2 = 29 and pk3 = 280 and pk1 = 3", write=True)
+    # The ranges and their progress are restored, finished ranges
+    # are not checked again.
+    c = self.make_parallel_checker(5, directory=directory)
+    self.assertEqual(len(c.partitions), 3)
+    c._run()
+    self.assertFalse(c.mismatches)
+
+  def test_checksum_ok(self):
+    c = self.make_checker(checksum=True)
+    c._run()
+    self.assertFalse(c.mismatches)
+    self.assertEqual(c.stats.items, 399)
+
+  def test_checksum_mismatches(self):
+    destination_tablet.mquery("test_checkers", "insert into test (pk1, pk2, pk3) values (1, 1, 900)", write=True)
+    destination_tablet.mquery("test_checkers", "insert into test (pk1, pk2, pk3) values (1000, 1000, 1000)", write=True)
+    c = self.make_checker(checksum=True)
+    c._run()
+    self.assertEqual(len(c.mismatches), 2)
+
+  def test_checksum_swapped_values(self):
+    # A linear row hash would miss values swapped between rows.
+    destination_tablet.mquery("test_checkers", "update test set msg='message 20' where pk3 = 10", write=True)
+    destination_tablet.mquery("test_checkers", "update test set msg='message 10' where pk3 = 20", write=True)
+    c = self.make_checker(checksum=True)
+    c._run()
+    self.assertEqual(len(c.mismatches), 1)
+    self.assertEqual(len(c.mismatches[0].different), 2)
+
+  def test_checksum_bisect(self):
+    destination_tablet.mquery("test_checkers", "update test set msg='something else' where pk2 = 29 and pk3 = 280 and pk1 = 3", write=True)
+    c = self.make_checker(checksum=True, batch_count=1000, checksum_leaf_size=8)
+    c._run()
+    self.assertEqual(len(c.mismatches), 1)
+    mismatch = c.mismatches[0]
+    self.assertFalse(mismatch.missing)
+    self.assertFalse(mismatch.unexpected)
+    self.assertEqual([d[0][:3] for d in mismatch.different], [(3, 29, 280)])
+
+  def test_checksum_missing_rows(self):
+    destination_tablet.mquery("test_checkers", "delete from test where pk3 > 5", write=True)
+    c = self.make_checker(checksum=True, batch_count=1000, checksum_leaf_size=8)
+    c._run()
+    # The source rows are compared in pages of at most 8 rows per source.
+    self.assertEqual(sum(len(m.missing) for m in c.mismatches), 394)
+    self.assertTrue(all(len(m.missing) <= 16 for m in c.mismatches))
+
+  def test_adaptive_batch_size(self):
+    destination_tablet.mquery("test_checkers", "update test set msg='something else' where pk2 = 29 and pk3 = 280 and pk1 = 3", write=True)
+    c = self.make_checker(batch_count=10, target_bytes=1000, min_batch_size=10, max_batch_size=50)
+    c._run()
+    self.assertEqual(len(c.mismatches), 1)
+    self.assertTrue(10 <= c.batch_size <= 50)
+    with open(c.checkpoint_file) as fi:
+      batch_size = checker.pickle.load(fi)['batch_size']
+    self.assertTrue(10 <= batch_size <= 50)
+
+  def test_comparer_processes(self):
+    destination_tablet.mquery("test_checkers", "update test set msg='something else' where pk2 = 29 and pk3 = 280 and pk1 = 3", write=True)
+    destination_tablet.mquery("test_checkers", "insert into test (pk1, pk2, pk3) values (1, 1, 900)", write=True)
+    self.c._run()
+    c = self.make_checker(comparer_processes=2)
+    c._run()
+    self.assertEqual([str(m) for m in c.mismatches],
+                     [str(m) for m in self.c.mismatches])
+    self.assertEqual(len(c.mismatches), 2)
+
+    # The ranges of a parallel checker share one pool.
+    c = self.make_parallel_checker(3, comparer_processes=2)
+    self.assertEqual(len(set(id(r.comparer_pool) for r in c.checkers)), 1)
+    self.assertFalse(any(r.owns_comparer_pool for r in c.checkers))
+    c._run()
+    self.assertEqual(len(c.mismatches), 2)
+
+  def test_scheduler(self):
+    destination_tablet.mquery("test_checkers", "update test set msg='something else' where pk2 = 29 and pk3 = 280 and pk1 = 3", write=True)
+    directory = tempfile.mkdtemp()
+    source_addresses = ['vt_dba@localhost:{0!s}/test_checkers{1!s}?unix_socket={2!s}'.format(s.mysql_port, i, s.mysql_connection_parameters('test_checkers')['unix_socket'])
+                        for i, s in enumerate(source_tablets)]
+    destination_socket = destination_tablet.mysql_connection_parameters('test_checkers')['unix_socket']
+    destination_address = 'vt_dba@localhost/test_checkers?unix_socket={0!s}'.format(destination_socket)
+    scheduler = MockTableScheduler(destination_address, source_addresses,
+                                   directory=directory, keyrange=TestCheckersBase.keyrange,
+                                   batch_count=20, logging_level=logging.WARNING)
+    self.assertEqual(scheduler.tables, ['test'])
+    scheduler._run()
+    self.assertEqual(len(scheduler.checkers['test'].mismatches), 1)
+    self.assertEqual(scheduler.done, set(['test']))
+
+    # Tables already checked are skipped.
+    scheduler = MockTableScheduler(destination_address, source_addresses, ['test'],
+                                   directory=directory, keyrange=TestCheckersBase.keyrange,
+                                   batch_count=20, logging_level=logging.WARNING)
+    scheduler._run()
+    self.assertFalse(scheduler.checkers)
+
+    # Tables selected after the checkpoint was saved are added to it.
+    with open(scheduler.checkpoint_file, 'w') as fi:
+      checker.pickle.dump({'tables': ['other'], 'done': ['other']}, fi)
+    scheduler = MockTableScheduler(destination_address, source_addresses, ['test'],
+                                   directory=directory, keyrange=TestCheckersBase.keyrange,
+                                   batch_count=20, logging_level=logging.WARNING)
+    self.assertEqual(scheduler.tables, ['test'])
+    scheduler._run()
+    self.assertEqual(scheduler.done, set(['other', 'test']))
+
   def test_batch_size(self):
     c = self.make_checker(batch_count=0)
     c.table_data['avg_row_length'] = 1024
@@ -0,0 +1,1132 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests the python clients against the in-process fake vtgate."""
+
+import datetime
+import functools
+import optparse
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+import utils
+
+from vtdb import database_context
+from vtdb import db_object
+from vtdb import db_object_custom_sharded
+from vtdb import db_object_lookup
+from vtdb import db_object_range_sharded
+from vtdb import db_object_unsharded
+from vtdb import dbapi
+from vtdb import dbexceptions
+from vtdb import fake_vtgate
+from vtdb import field_types
+from vtdb import hedged_vtgate
+from vtdb import load_driver
+from vtdb import result_cache
+from vtdb import lookup_cache
+from vtdb import split_query_export
+from vtdb import sql_builder
+from vtdb import tablet
+from vtdb import topo_snapshot
+from vtdb import update_stream_consumer
+from vtdb import update_stream_mux
+from vtdb import update_stream_service
+from vtdb import topology
+from vtdb import vtgate_cursor
+from vtdb import vtgatev2
+from vtdb import vtgatev3
+from zk import zkocc
+
+pack_kid = struct.Struct('!Q').pack
+
+KEYSPACE = fake_vtgate.DEFAULT_KEYSPACE
+
+
+class TestFakeVTGate(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.fake = fake_vtgate.start_server(row_count=25,
+                                                      stream_batch_size=10)
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_vtgatev2_execute(self):
+    conn = vtgatev2.connect([self.server.addr], 5.0)
+    cursor = conn.cursor(KEYSPACE, 'replica', keyspace_ids=[pack_kid(1)])
+    cursor.execute('select id, msg from t where id = %(id)s', {'id': 1})
+    rows = cursor.fetchall()
+    self.assertEqual(len(rows), 25)
+    self.assertEqual(rows[3][0], 3)
+    self.assertEqual([d[0] for d in cursor.description], ['id', 'msg'])
+    conn.close()
+
+  def test_vtgatev2_stream_execute(self):
+    conn = vtgatev2.connect([self.server.addr], 5.0)
+    cursor = conn.cursor(KEYSPACE, 'replica', keyspace_ids=[pack_kid(1)],
+                         cursorclass=vtgate_cursor.StreamVTGateCursor)
+    cursor.execute('select id, msg from t', {})
+    self.assertEqual([row[0] for row in cursor.fetchall()], range(25))
+    conn.close()
+
+  def test_vtgatev2_transaction(self):
+    conn = vtgatev2.connect([self.server.addr], 5.0)
+    cursor = conn.cursor(KEYSPACE, 'master', keyspace_ids=[pack_kid(1)],
+                         writable=True)
+    cursor.begin()
+    self.assertTrue(conn.session)
+    self.assertEqual(cursor.execute('insert into t values (1)', {}), 1)
+    cursor.commit()
+    self.assertFalse(conn.session)
+    conn.close()
+
+  def test_vtgatev2_lazy_begin(self):
+    conn = vtgatev2.connect([self.server.addr], 5.0, lazy_begin=True)
+    cursor = conn.cursor(KEYSPACE, 'master', keyspace_ids=[pack_kid(1)],
+                         writable=True)
+    calls = self.fake.call_count
+    # an empty transaction doesn't make any rpc.
+    cursor.begin()
+    cursor.commit()
+    self.assertEqual(self.fake.call_count, calls)
+    self.assertFalse(conn.session)
+
+    cursor.begin()
+    self.assertEqual(cursor.execute('insert into t values (1)', {}), 1)
+    self.assertEqual(len(conn.session['ShardSessions']), 1)
+    cursor.rollback()
+    self.assertEqual(self.fake.call_count - calls, 2)
+    self.assertFalse(conn.session)
+    conn.close()
+
+  def test_vtgatev2_executemany(self):
+    conn = vtgatev2.connect([self.server.addr], 5.0)
+    cursor = conn.cursor(KEYSPACE, 'master', keyspace_ids=[pack_kid(1)],
+                         writable=True)
+    cursor.executemany_max_rows = 10
+    cursor.begin()
+    calls = self.fake.call_count
+    rowcount = cursor.executemany(
+        'insert into t values (%(id)s)', [{'id': i} for i in xrange(25)])
+    self.assertEqual(rowcount, 25)
+    self.assertEqual(cursor.rowcount, 25)
+    # 25 rows in batches of 10 is 3 rpcs
+    self.assertEqual(self.fake.call_count - calls, 3)
+    cursor.commit()
+
+    cursor = conn.cursor(KEYSPACE, 'replica', keyspace_ids=[pack_kid(1)])
+    with self.assertRaises(dbexceptions.DatabaseError):
+      cursor.executemany('insert into t values (%(id)s)', [{'id': 1}])
+    conn.close()
+
+  def test_vtgatev2_shards(self):
+    conn = vtgatev2.connect([self.server.addr], 5.0)
+    cursor = conn.cursor(KEYSPACE, 'replica', shards=['-80'])
+    cursor.execute('select id, msg from t', {})
+    self.assertEqual(len(cursor.fetchall()), 25)
+    stream_cursor = conn.cursor(KEYSPACE, 'replica', shards=['-80', '80-'],
+                                cursorclass=vtgate_cursor.StreamVTGateCursor)
+    stream_cursor.execute('select id, msg from t', {})
+    self.assertEqual(len(stream_cursor.fetchall()), 25)
+
+    # queries of different keyspaces and routings, in 2 rpcs.
+    calls = self.fake.call_count
+    batch_cursor = vtgate_cursor.MultiBatchVTGateCursor(conn, 'replica')
+    batch_cursor.execute('select id from t', {}, KEYSPACE, shards=['-80'])
+    batch_cursor.execute('select id from u', {}, 'other_keyspace',
+                         keyspace_ids=[pack_kid(1)])
+    batch_cursor.execute('select id from v', {}, KEYSPACE, shards=['-80'])
+    with self.assertRaises(dbexceptions.DatabaseError):
+      batch_cursor.execute('delete from t', {}, KEYSPACE, shards=['-80'])
+    batch_cursor.flush()
+    self.assertEqual(self.fake.call_count - calls, 2)
+    self.assertEqual([len(rowset[0]) for rowset in batch_cursor.rowsets],
+                     [25, 25, 25])
+    conn.close()
+
+  def test_vtgatev2_injected_error(self):
+    self.fake.error_rate = 1.0
+    conn = vtgatev2.connect([self.server.addr], 5.0)
+    cursor = conn.cursor(KEYSPACE, 'replica', keyspace_ids=[pack_kid(1)])
+    with self.assertRaises(dbexceptions.DatabaseError):
+      cursor.execute('select id from t', {})
+    conn.close()
+
+  def test_vtgatev3_execute(self):
+    conn = vtgatev3.connect(self.server.addr, 5.0)
+    cursor = conn.cursor('replica')
+    self.assertEqual(cursor.execute('select id from t', {}), 25)
+    conn.close()
+
+  def test_vtgatev3_lazy_begin(self):
+    conn = vtgatev3.connect(self.server.addr, 5.0, lazy_begin=True)
+    cursor = conn.cursor('master')
+    calls = self.fake.call_count
+    cursor.begin()
+    cursor.rollback()
+    self.assertEqual(self.fake.call_count, calls)
+    cursor.begin()
+    cursor.execute('insert into t values (:id)', {'id': 1})
+    cursor.commit()
+    self.assertEqual(self.fake.call_count - calls, 2)
+    conn.close()
+
+  def test_tablet_execute(self):
+    conn = tablet.connect(self.server.addr, 'replica', KEYSPACE, '0', 5.0)
+    results, rowcount, lastrowid, fields = conn._execute('select id from t', {})
+    self.assertEqual(rowcount, 25)
+    conn.close()
+
+  def test_zkocc(self):
+    conn = zkocc.ZkOccConnection(self.server.addr, 'test_nj', 5.0)
+    self.assertEqual(conn.get_srv_keyspace_names('local'), [KEYSPACE])
+    srv_keyspace = conn.get_srv_keyspace('local', KEYSPACE)
+    self.assertEqual(len(srv_keyspace['Partitions']['master']['ShardReferences']), 2)
+    conn.close()
+
+
+class TestPooledZkOcc(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.fake = fake_vtgate.start_server(latency=0.1)
+    # Nothing listens on port 1.
+    self.conn = zkocc.PooledZkOccConnection(
+        'localhost:1,' + self.server.addr, 'test_nj', 5.0)
+
+  def tearDown(self):
+    self.conn.close()
+    self.server.stop()
+
+  def test_concurrent_calls(self):
+    results = []
+    def read():
+      results.append(self.conn.get_srv_keyspace_names('local'))
+    start = time.time()
+    threads = [threading.Thread(target=read) for _ in xrange(8)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    # The calls were not serialized.
+    self.assertLess(time.time() - start, 0.6)
+    self.assertEqual(results, [[KEYSPACE]] * 8)
+    stats = self.conn.stats()
+    self.assertTrue(stats['localhost:1']['Down'])
+    self.assertGreater(stats[self.server.addr]['Idle'], 1)
+    self.assertEqual(stats[self.server.addr]['Errors'], 0)
+    self.assertEqual(stats[self.server.addr]['InUse'], 0)
+
+  def test_retries(self):
+    self.conn.max_attempts = 1
+    self.conn.down_delay = 10.0
+    with self.assertRaises(zkocc.ZkOccError):
+      for _ in xrange(50):
+        self.conn.get_srv_keyspace_names('local')
+    # The failed server is avoided.
+    self.conn.max_attempts = 3
+    for _ in xrange(10):
+      self.conn.get_srv_keyspace_names('local')
+    self.assertEqual(self.conn.stats()['localhost:1']['Calls'], 1)
+
+    self.conn.refresh_addrs(self.server.addr)
+    self.assertEqual(self.conn.stats().keys(), [self.server.addr])
+
+  def test_errors(self):
+    # An application error is raised right away, the server stays up.
+    with self.assertRaises(zkocc.ZkOccError):
+      self.conn.get_srv_keyspace('local', 'unknown_keyspace')
+    stats = self.conn.stats()[self.server.addr]
+    self.assertEqual(stats['Calls'], 1)
+    self.assertFalse(stats['Down'])
+
+    # Without any reachable server, the call fails once all were tried.
+    conn = zkocc.PooledZkOccConnection('localhost:1', 'test_nj', 5.0)
+    with self.assertRaises(zkocc.ZkOccError):
+      conn.get_srv_keyspace_names('local')
+    self.assertEqual(conn.stats()['localhost:1']['Calls'], 1)
+    conn.close()
+
+
+class TestTopoSnapshot(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.fake = fake_vtgate.start_server()
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'topo.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+    self.server.stop()
+
+  def test_snapshot(self):
+    zkocc_client = zkocc.ZkOccConnection(self.server.addr, 'test_nj', 5.0)
+    client = topology.read_keyspaces_from_snapshot(zkocc_client, self.path,
+                                                   refresh_interval=10)
+    client.stop()
+    self.assertEqual(topology.get_keyspace(KEYSPACE).get_shard_count('master'), 2)
+    # The cold start refreshed once, the background thread didn't again.
+    self.assertEqual(client.refreshes, 0)
+    snapshot = topo_snapshot.read_snapshot(self.path)
+    self.assertEqual(snapshot['Version'], topo_snapshot.SNAPSHOT_VERSION)
+    self.assertEqual(snapshot['Cell'], 'test_nj')
+    self.assertEqual(snapshot['Generation'], 1)
+    srv_keyspace = zkocc_client.get_srv_keyspace('local', KEYSPACE)
+    end_points = zkocc_client.get_end_points('local', KEYSPACE, '-80', 'master')
+
+    # Without the topo server, the keyspaces are read from the snapshot.
+    self.server.stop()
+    client = topology.read_keyspaces_from_snapshot(
+        zkocc.ZkOccConnection('localhost:1', 'test_nj', 5.0), self.path,
+        refresh_interval=10)
+    deadline = time.time() + 5
+    while not client.errors and time.time() < deadline:
+      time.sleep(0.01)
+    client.stop()
+    self.assertEqual(client.stats()['Errors'], 1)
+    self.assertFalse(client.is_stale())
+    self.assertEqual(client.get_srv_keyspace_names('local'), [KEYSPACE])
+    self.assertEqual(client.get_srv_keyspace('test_nj', KEYSPACE), srv_keyspace)
+    self.assertEqual(client.get_end_points('local', KEYSPACE, '-80', 'master'),
+                     end_points)
+    self.assertEqual(topology.get_keyspace(KEYSPACE).get_shard_count('master'), 2)
+
+    # The fake zkocc client reads snapshots.
+    fake_client = zkocc.FakeZkOccConnection.from_data_path('test_nj', self.path)
+    self.assertEqual(fake_client.get_srv_keyspace('test_nj', KEYSPACE),
+                     srv_keyspace)
+
+  def test_invalid_snapshot(self):
+    with open(self.path, 'w') as f:
+      f.write('{"Version": 99, "Data": {}}')
+    with self.assertRaises(ValueError):
+      topo_snapshot.read_snapshot(self.path)
+    client = topo_snapshot.SnapshotTopoClient(
+        zkocc.ZkOccConnection(self.server.addr, 'test_nj', 5.0), self.path)
+    self.assertFalse(client.load())
+    client.refresh()
+    self.assertTrue(client.load())
+
+  def test_concurrent_writers(self):
+    def write(generation):
+      for _ in xrange(20):
+        topo_snapshot.write_snapshot(self.path, {
+            'Version': topo_snapshot.SNAPSHOT_VERSION,
+            'Generation': generation, 'Data': {'x' * generation: 1}})
+    threads = [threading.Thread(target=write, args=(generation,))
+               for generation in xrange(1, 5)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    snapshot = topo_snapshot.read_snapshot(self.path)
+    self.assertEqual(snapshot['Data'], {'x' * snapshot['Generation']: 1})
+    self.assertEqual(os.listdir(self.tmpdir), ['topo.json'])
+
+
+class BulkInsertTable(db_object_range_sharded.DBObjectRangeSharded):
+  keyspace = KEYSPACE
+  table_name = 'bulk_insert_test'
+  columns_list = ['id', 'msg', 'keyspace_id']
+  sharding_key_column_name = 'id'
+
+  @classmethod
+  def sharding_key_to_keyspace_id(class_, sharding_key):
+    # ids are below 256, the high byte decides the shard.
+    return sharding_key << 56
+
+  @classmethod
+  def is_sharding_key_valid(class_, sharding_key):
+    return True
+
+
+class SongUserLookup(db_object_lookup.LookupDBObject):
+  keyspace = KEYSPACE
+  table_name = 'song_user_lookup'
+  columns_list = ['song_id', 'user_id']
+
+
+class SongTable(db_object_range_sharded.DBObjectEntityRangeSharded):
+  keyspace = KEYSPACE
+  table_name = 'song'
+  columns_list = ['song_id', 'user_id', 'keyspace_id']
+  sharding_key_column_name = 'user_id'
+  entity_id_lookup_map = {'song_id': SongUserLookup}
+
+
+class CustomShardedTable(db_object_custom_sharded.DBObjectCustomSharded):
+  keyspace = KEYSPACE
+  table_name = 'custom'
+  columns_list = ['id', 'msg']
+
+
+class TestRangeSharded(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.fake = fake_vtgate.start_server()
+    topology.read_keyspaces(zkocc.ZkOccConnection(self.server.addr, 'test_nj', 5.0))
+    self.dc = database_context.DatabaseContext(vtgate_addrs=[self.server.addr])
+
+  def tearDown(self):
+    if self.dc.vtgate_connection:
+      self.dc.close()
+    self.server.stop()
+
+  def test_custom_sharded(self):
+    conn = vtgatev2.connect([self.server.addr], 5.0)
+    cursor_method = lambda table_class: table_class.create_vtgate_cursor(
+        conn, 'replica', False, shard_name=['-80', '80-'])
+    rows = CustomShardedTable.select_by_columns(cursor_method, [('id', 1)])
+    self.assertEqual(len(rows), 10)
+    with self.assertRaises(dbexceptions.InternalError):
+      CustomShardedTable.create_vtgate_cursor(conn, 'master', True,
+                                              shard_name=['-80', '80-'])
+    cursor = CustomShardedTable.create_vtgate_cursor(conn, 'master', True,
+                                                     shard_name='-80')
+    self.assertEqual(cursor.shards, ['-80'])
+    conn.close()
+
+  def test_insert_rows_query(self):
+    query, bind_vars = sql_builder.insert_rows_query(
+        't', ['id', 'msg'], [{'id': 1, 'msg': 'a'}, {'id': 2, 'msg': 'b'}])
+    self.assertEqual(query, 'INSERT INTO t (id, msg) VALUES '
+                     '(%(id_0)s, %(msg_0)s), (%(id_1)s, %(msg_1)s)')
+    self.assertEqual(bind_vars, {'id_0': 1, 'msg_0': 'a',
+                                 'id_1': 2, 'msg_1': 'b'})
+    with self.assertRaises(ValueError):
+      sql_builder.insert_rows_query('t', ['id', 'msg'], [{'id': 1}, {'msg': 'b'}])
+    queries = sql_builder.insert_rows_queries(
+        't', ['id', 'msg'], [{'id': i, 'msg': 'x' * 10} for i in xrange(10)], 100)
+    self.assertEqual([len(bind_vars) for _, bind_vars in queries], [8, 8, 4])
+
+  def test_in_list_bind_var(self):
+    where_clause, bind_vars = sql_builder.build_where_clause(
+        [('id', [1, 2, 3]), ('msg', sql_builder.NotInValues('a', 'b'))])
+    self.assertEqual(where_clause, 'id IN %(id_1)s AND msg NOT IN %(msg_2)s')
+    self.assertEqual(bind_vars, {'id_1': [1, 2, 3], 'msg_2': ['a', 'b']})
+    self.assertTrue(isinstance(bind_vars['id_1'], field_types.List))
+    # The query text doesn't depend on the length of the list.
+    query, _ = dbapi.prepare_query_bind_vars(
+        'select * from t where ' + where_clause, bind_vars)
+    self.assertEqual(query, 'select * from t where id IN ::id_1 AND '
+                     'msg NOT IN ::msg_2')
+    self.assertEqual(
+        sql_builder.build_where_clause([('id', range(100))])[0], 'id IN %(id_1)s')
+    # Items are converted like scalar bind variables.
+    self.assertEqual(
+        field_types.convert_bind_vars(
+            {'d': field_types.List([datetime.date(2015, 1, 2)])}),
+        {'d': ['2015-01-02']})
+
+    sql_builder.USE_LIST_BIND_VARS = False
+    try:
+      where_clause, bind_vars = sql_builder.build_where_clause(
+          [('id', [1, 2])])
+    finally:
+      sql_builder.USE_LIST_BIND_VARS = True
+    self.assertEqual(where_clause, 'id IN (%(id_1)s,%(id_2)s)')
+    self.assertEqual(bind_vars, {'id_1': 1, 'id_2': 2})
+
+    conn = vtgatev2.connect([self.server.addr], 5.0)
+    cursor = conn.cursor(KEYSPACE, 'replica', keyspace_ids=[pack_kid(1)])
+    cursor.execute('select id, msg from t where id IN %(id)s',
+                   {'id': field_types.List([1, 2])})
+    self.assertEqual(len(cursor.fetchall()), 10)
+    conn.close()
+
+  def test_lookup_batched(self):
+    conn = vtgatev2.connect([self.server.addr], 5.0)
+    cursor_method = functools.partial(db_object.create_cursor_from_params,
+                                      conn, 'replica', False)
+    calls = self.fake.call_count
+    # 1200 distinct ids are resolved with 3 lookup queries.
+    entity_ids = range(1200) + range(100)
+    routing = SongTable.create_shard_routing(
+        cursor_method, entity_id_map={'song_id': entity_ids})
+    self.assertEqual(self.fake.call_count - calls, 3)
+    self.assertEqual(routing.entity_column_name, 'song_id')
+    # the fake returns the same rows for every query.
+    self.assertEqual(sorted(routing.entity_id_sharding_key_map.keys()), range(10))
+    conn.close()
+
+  def test_lookup_cached(self):
+    conn = vtgatev2.connect([self.server.addr], 5.0)
+    cursor_method = functools.partial(db_object.create_cursor_from_params,
+                                      conn, 'master', True)
+    SongUserLookup.lookup_cache = lookup_cache.LookupCache()
+    try:
+      routing = SongTable.create_shard_routing(
+          cursor_method, entity_id_map={'song_id': range(5)})
+      calls = self.fake.call_count
+      routing = SongTable.create_shard_routing(
+          cursor_method, entity_id_map={'song_id': range(5)})
+      self.assertEqual(self.fake.call_count, calls)
+      self.assertEqual(sorted(routing.entity_id_sharding_key_map), range(5))
+      routing = SongTable.create_shard_routing(
+          cursor_method, entity_id_map={'song_id': 3})
+      self.assertEqual(self.fake.call_count, calls)
+
+      # updating the lookup drops the entries of that sharding key.
+      sharding_key = routing.entity_id_sharding_key_map[3]
+      SongTable.update_sharding_key_entity_id_lookup(
+          cursor_method, sharding_key, 'song_id', 100)
+      SongTable.create_shard_routing(
+          cursor_method, entity_id_map={'song_id': 3})
+      self.assertEqual(self.fake.call_count, calls + 2)
+    finally:
+      SongUserLookup.lookup_cache = None
+    conn.close()
+
+  def test_bulk_insert(self):
+    rows = [{'id': i, 'msg': 'x' * 10} for i in xrange(1, 256, 4)]
+    with database_context.WriteTransaction(self.dc) as context:
+      calls = self.fake.call_count
+      # one batch rpc per shard, one statement per batch.
+      self.assertEqual(BulkInsertTable.bulk_insert(context.get_cursor(), rows), 2)
+      self.assertEqual(self.fake.call_count - calls, 2)
+
+  def test_bulk_insert_concurrent(self):
+    rows = [{'id': i, 'msg': 'x' * 10} for i in xrange(1, 256, 4)]
+    connection_factory = functools.partial(vtgatev2.connect,
+                                           [self.server.addr], 5.0)
+    calls = self.fake.call_count
+    with database_context.ReadFromMaster(self.dc):
+      # writes outside of a transaction still need a writable cursor.
+      cursor_method = functools.partial(self.dc.create_cursor, True)
+      rowcount = BulkInsertTable.bulk_insert(
+          cursor_method, rows, max_statement_size=200,
+          connection_factory=connection_factory)
+    # the fake counts one row per statement: 32 rows of about 45 bytes
+    # per shard is 8 statements of 4 rows.
+    self.assertEqual(rowcount, 16)
+    self.assertEqual(self.fake.call_count - calls, 2)
+
+
+  def test_select_by_ids_split(self):
+    conn = vtgatev2.connect([self.server.addr], 5.0)
+    ids = range(1, 256, 4)
+    cursor_method = lambda table_class: table_class.create_vtgate_cursor(
+        conn, 'replica', False, entity_id_map={'id': ids})
+    connection_factory = functools.partial(vtgatev2.connect,
+                                           [self.server.addr], 5.0)
+    BulkInsertTable.max_in_list_size = 10
+    try:
+      for factory in (None, connection_factory):
+        calls = self.fake.call_count
+        rows = BulkInsertTable.select_by_ids(
+            cursor_method, [('id', ids)], columns_list=['id', 'msg'],
+            connection_factory=factory)
+        # 32 ids per shard, in 4 queries of a batch rpc per shard; the
+        # fake returns 10 rows per query.
+        self.assertEqual(self.fake.call_count - calls, 2)
+        self.assertEqual(len(rows), 80)
+      # the extra create_select_query arguments are used for each chunk.
+      comments = []
+      def create_select_query(class_, where_column_value_pairs, comment=None,
+                              **kwargs):
+        comments.append(comment)
+        return db_object.DBObjectBase.create_select_query.im_func(
+            class_, where_column_value_pairs, **kwargs)
+      BulkInsertTable.create_select_query = classmethod(create_select_query)
+      try:
+        BulkInsertTable.select_by_ids(
+            cursor_method, [('id', ids)], columns_list=['id', 'msg'],
+            comment='split')
+      finally:
+        del BulkInsertTable.create_select_query
+      self.assertEqual(comments, ['split'] * 8)
+      # 25 unsharded ids in 3 queries of one batch rpc.
+      CachedTable.max_in_list_size = 10
+      calls = self.fake.call_count
+      rows = CachedTable.select_by_columns(
+          functools.partial(db_object.create_cursor_from_params,
+                            conn, 'replica', False),
+          [('id', range(25) + range(5))])
+      self.assertEqual(self.fake.call_count - calls, 1)
+      self.assertEqual(len(rows), 30)
+    finally:
+      del BulkInsertTable.max_in_list_size
+      del CachedTable.max_in_list_size
+    self.assertEqual(
+        db_object.split_in_clause([('a', 1), ('id', None)], 'id',
+                                  [1, 2, 2, 3], 2),
+        [[('a', 1), ('id', [1, 2])], [('a', 1), ('id', [3])]])
+    conn.close()
+
+
+class TestDatabaseContextRegistry(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.fake = fake_vtgate.start_server()
+    self.registry = database_context.DatabaseContextRegistry(
+        [self.server.addr], pool_size=2)
+
+  def tearDown(self):
+    self.registry.close()
+    self.server.stop()
+
+  def test_per_thread_context(self):
+    contexts = []
+    def _worker():
+      dc = self.registry.get_context()
+      self.assertIs(dc, self.registry.get_context())
+      with database_context.ReadFromReplica(dc) as context:
+        BulkInsertTable.select_by_columns(
+            context.get_cursor(entity_id_map={'id': 1}), [('id', 1)])
+      contexts.append(dc)
+    threads = [threading.Thread(target=_worker) for _ in xrange(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(len(set(id(dc) for dc in contexts)), 4)
+    # the connections went back to the pool, up to its size.
+    self.assertEqual(len(self.registry.connection_pool.idle), 2)
+    self.assertTrue(all(dc.vtgate_connection is None for dc in contexts))
+
+  def test_transaction_pinning(self):
+    dc = self.registry.get_context()
+    with database_context.WriteTransaction(dc) as context:
+      conn = dc.vtgate_connection
+      BulkInsertTable.delete_by_columns(
+          context.get_cursor(entity_id_map={'id': 1}), [('id', 1)])
+      self.assertIs(dc.vtgate_connection, conn)
+      self.assertTrue(conn.session)
+    self.assertIs(dc.vtgate_connection, None)
+    self.assertEqual(self.registry.connection_pool.idle, [conn])
+    self.assertIs(self.registry.connection_pool.get(), conn)
+
+  def test_operational_error_discards_connection(self):
+    dc = self.registry.get_context()
+    for operation in (database_context.ReadFromReplica,
+                      database_context.WriteTransaction):
+      with self.assertRaises(dbexceptions.OperationalError):
+        with operation(dc) as context:
+          BulkInsertTable.select_by_columns(
+              context.get_cursor(entity_id_map={'id': 1}), [('id', 1)])
+          conn = dc.vtgate_connection
+          raise dbexceptions.OperationalError('connection lost')
+      self.assertTrue(conn.is_closed())
+      self.assertIs(dc.vtgate_connection, None)
+      self.assertFalse(dc.in_transaction)
+      self.assertEqual(self.registry.connection_pool.idle, [])
+
+  def test_caught_read_error_fails_commit(self):
+    dc = self.registry.get_context()
+    with self.assertRaises(dbexceptions.OperationalError):
+      with database_context.WriteTransaction(dc) as context:
+        BulkInsertTable.delete_by_columns(
+            context.get_cursor(entity_id_map={'id': 1}), [('id', 1)])
+        try:
+          with database_context.ReadFromMaster(dc):
+            raise dbexceptions.OperationalError('connection lost')
+        except dbexceptions.OperationalError:
+          pass
+        # the writes were lost with the connection.
+        self.assertTrue(dc.in_transaction)
+        with self.assertRaises(dbexceptions.OperationalError):
+          dc.get_vtgate_connection()
+    self.assertFalse(dc.in_transaction)
+    self.assertIs(dc.vtgate_connection, None)
+    self.assertEqual(self.registry.connection_pool.idle, [])
+    # the next transaction works.
+    with database_context.WriteTransaction(dc) as context:
+      BulkInsertTable.delete_by_columns(
+          context.get_cursor(entity_id_map={'id': 1}), [('id', 1)])
+    self.assertFalse(dc.in_transaction)
+
+
+class TestReadCoalescing(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.fake = fake_vtgate.start_server(latency=0.2)
+    vtgate_cursor.VTGateCursor.read_coalescer = vtgate_cursor.ReadCoalescer()
+
+  def tearDown(self):
+    vtgate_cursor.VTGateCursor.read_coalescer = None
+    self.server.stop()
+
+  def _concurrent_reads(self, count, **cursor_kargs):
+    conns = [vtgatev2.connect([self.server.addr], 5.0) for _ in xrange(count)]
+    rowcounts = []
+    def _read(conn):
+      cursor = conn.cursor(KEYSPACE, 'replica', keyspace_ids=[pack_kid(1)],
+                           **cursor_kargs)
+      rowcounts.append(cursor.execute('select id from t where id = %(id)s',
+                                      {'id': [1, 2]}))
+    threads = [threading.Thread(target=_read, args=(conn,)) for conn in conns]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    for conn in conns:
+      conn.close()
+    return rowcounts
+
+  def test_coalesced(self):
+    self.assertEqual(self._concurrent_reads(5), [10] * 5)
+    self.assertEqual(self.fake.call_count, 1)
+    self.assertEqual(vtgate_cursor.VTGateCursor.read_coalescer.coalesced, 4)
+    self.assertEqual(vtgate_cursor.VTGateCursor.read_coalescer.in_flight, {})
+
+  def test_writable_not_coalesced(self):
+    self._concurrent_reads(3, writable=True)
+    self.assertEqual(self.fake.call_count, 3)
+
+
+class CachedTable(db_object_unsharded.DBObjectUnsharded):
+  keyspace = KEYSPACE
+  table_name = 'cached'
+  columns_list = ['id', 'msg']
+  id_column_name = 'id'
+
+
+class TestResultCache(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.fake = fake_vtgate.start_server()
+    self.conn = vtgatev2.connect([self.server.addr], 5.0)
+    self.cache = result_cache.ResultCache()
+    CachedTable.result_cache = self.cache
+
+  def tearDown(self):
+    CachedTable.result_cache = None
+    self.conn.close()
+    self.server.stop()
+
+  def _select(self, where_column_value_pairs, tablet_type='replica'):
+    cursor_method = functools.partial(db_object.create_cursor_from_params,
+                                      self.conn, tablet_type, False)
+    calls = self.fake.call_count
+    rows = CachedTable.select_by_columns(cursor_method, where_column_value_pairs)
+    self.assertEqual(len(rows), 10)
+    return self.fake.call_count - calls
+
+  def test_cache(self):
+    self.assertEqual(self._select([('id', 1)]), 1)
+    self.assertEqual(self._select([('id', 1)]), 0)
+    self.assertEqual(self._select([('msg', 'a')]), 1)
+    self.assertEqual(self._select([('msg', 'a')]), 0)
+    # master reads are not cached.
+    self.assertEqual(self._select([('id', 1)], tablet_type='master'), 1)
+
+    invalidator = result_cache.UpdateStreamInvalidator(self.cache, None, 'pos')
+    self.cache.active = True
+    # a dml on another row keeps the pk entry, drops the others.
+    invalidator.process_event({'Category': 'DML', 'TableName': 'cached',
+                               'PkRows': [[('id', 2)]], 'Timestamp': 0})
+    self.assertEqual(self._select([('id', 1)]), 0)
+    self.assertEqual(self._select([('msg', 'a')]), 1)
+    invalidator.process_event({'Category': 'DML', 'TableName': 'cached',
+                               'PkRows': [[('id', 1)]], 'Timestamp': 0})
+    self.assertEqual(self._select([('id', 1)]), 1)
+    self.assertEqual(self.cache.stats()['Hits'], 3)
+
+  def test_ttl(self):
+    with self.assertRaises(ValueError):
+      result_cache.ResultCache(ttl=None)
+    self.cache.ttl = 0.05
+    self.assertEqual(self._select([('id', 1)]), 1)
+    self.assertEqual(self._select([('id', 1)]), 0)
+    time.sleep(0.1)
+    # Without any invalidation, the entry expired.
+    self.assertEqual(self._select([('id', 1)]), 1)
+
+  def test_invalidator(self):
+    now = int(time.time())
+    self.fake.update_stream_events = [
+        {'Category': 'DML', 'TableName': 'cached', 'PKColNames': ['id'],
+         'PKValues': [[1]], 'Sql': None, 'Timestamp': now, 'GTIDField': None},
+        {'Category': 'POS', 'TableName': None, 'PKColNames': None,
+         'PKValues': None, 'Sql': None, 'Timestamp': 0, 'GTIDField': 'gtid'}]
+    connection_factory = functools.partial(
+        update_stream_service.UpdateStreamConnection, self.server.addr, 5.0)
+    invalidator = result_cache.UpdateStreamInvalidator(
+        self.cache, connection_factory, 'pos',
+        position_append=lambda pos, gtid: pos + ',' + gtid, retry_delay=10)
+    self.assertFalse(self.cache.active)
+    invalidator.start()
+    deadline = time.time() + 5
+    while invalidator.events < 2 and time.time() < deadline:
+      time.sleep(0.01)
+    invalidator.stop()
+    self.assertEqual(invalidator.events, 2)
+    self.assertEqual(invalidator.position, 'pos,gtid')
+    self.assertLess(invalidator.lag, 5)
+
+
+class TestHedgedReads(unittest.TestCase):
+
+  def setUp(self):
+    self.slow_server, self.slow_fake = fake_vtgate.start_server(latency=0.5)
+    self.fast_server, self.fast_fake = fake_vtgate.start_server()
+
+  def tearDown(self):
+    self.slow_server.stop()
+    self.fast_server.stop()
+
+  def test_hedged_execute(self):
+    conn = hedged_vtgate.HedgedVTGateConnection(
+        [self.slow_server.addr, self.fast_server.addr], 5.0,
+        initial_hedge_delay=0.02)
+    conn.addrs = [self.slow_server.addr, self.fast_server.addr]
+    cursor = conn.cursor(KEYSPACE, 'replica', keyspace_ids=[pack_kid(1)])
+    for _ in xrange(5):
+      start = time.time()
+      self.assertEqual(cursor.execute('select id from t', {}), 10)
+      self.assertLess(time.time() - start, 0.4)
+    # the first call is hedged, then the fast vtgate becomes primary.
+    self.assertEqual(conn.hedges, 1)
+    self.assertEqual(conn.hedge_wins, 1)
+    self.assertEqual(conn.addrs[0], self.fast_server.addr)
+    self.assertEqual(self.slow_fake.call_count, 1)
+    self.assertEqual(self.fast_fake.call_count, 5)
+
+    with self.assertRaises(dbexceptions.ProgrammingError):
+      cursor.begin()
+    conn.close()
+
+  def test_hedge_limit(self):
+    conn = hedged_vtgate.HedgedVTGateConnection(
+        [self.slow_server.addr, self.fast_server.addr], 5.0,
+        initial_hedge_delay=0.02, max_hedge_ratio=0.0, hedge_burst=0)
+    conn.addrs = [self.slow_server.addr, self.fast_server.addr]
+    cursor = conn.cursor(KEYSPACE, 'replica', keyspace_ids=[pack_kid(1)])
+    cursor.execute('select id from t', {})
+    self.assertEqual(conn.hedges, 0)
+    self.assertEqual(self.fast_fake.call_count, 0)
+    conn.close()
+
+  def test_hedge_budget_is_not_banked(self):
+    conn = hedged_vtgate.HedgedVTGateConnection(
+        [self.fast_server.addr, self.slow_server.addr], 5.0,
+        initial_hedge_delay=0.05, min_hedge_delay=0.05, max_hedge_ratio=0.1,
+        hedge_burst=2)
+    conn.addrs = [self.fast_server.addr, self.slow_server.addr]
+    cursor = conn.cursor(KEYSPACE, 'replica', keyspace_ids=[pack_kid(1)])
+    for _ in xrange(100):
+      cursor.execute('select id from t', {})
+    self.assertEqual(conn.hedge_tokens, 2.0)
+    # during a slowdown, the hedges are limited to the burst and the
+    # tokens of the slow calls.
+    hedges = conn.hedges
+    self.fast_fake.latency = 0.1
+    for _ in xrange(10):
+      cursor.execute('select id from t', {})
+    self.assertLessEqual(conn.hedges - hedges, 3)
+    self.assertGreaterEqual(conn.hedges - hedges, 2)
+    conn.close()
+
+
+class TestSplitQueryExport(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.fake = fake_vtgate.start_server(row_count=25,
+                                                      stream_batch_size=10)
+    self.connection_factory = functools.partial(vtgatev2.connect,
+                                                [self.server.addr], 5.0)
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+    self.server.stop()
+
+  def test_split_query(self):
+    conn = self.connection_factory()
+    splits = conn.split_query('select id, msg from t where id > %(id)s',
+                              {'id': 0}, KEYSPACE, 3)
+    # 2 splits per shard.
+    self.assertEqual(len(splits), 4)
+    self.assertEqual(splits[0]['Sql'], 'select id, msg from t where id > :id')
+    self.assertEqual(splits[0]['BindVariables'],
+                     {'id': 0, '_splitquery_index': 0})
+    self.assertEqual(str(splits[3]['KeyRanges'][0]), '80-')
+    conn._stream_execute_split(splits[3], 'rdonly')
+    rows = list(iter(conn._stream_next, None))
+    self.assertEqual(len(rows), 25)
+    conn.close()
+
+  def test_export(self):
+    for ordered in (False, True):
+      export = split_query_export.SplitQueryExport(
+          self.connection_factory, KEYSPACE, 'select id, msg from t',
+          split_count=4, num_workers=3, ordered=ordered, queue_size=5)
+      rows = list(export)
+      self.assertEqual(len(rows), 100)
+      self.assertEqual(export.stats(), {'Splits': 4, 'Done': 4})
+      self.assertEqual([f[0] for f in export.fields], ['id', 'msg'])
+      if ordered:
+        self.assertEqual([row[0] for row in rows[:25]], range(25))
+
+  def test_resume(self):
+    checkpoint = split_query_export.FileCheckpoint(
+        os.path.join(self.tmpdir, 'export'))
+    export = split_query_export.SplitQueryExport(
+        self.connection_factory, KEYSPACE, 'select id, msg from t',
+        split_count=4, num_workers=2, ordered=True, checkpoint=checkpoint)
+    rows = export.rows()
+    # The first split is done once the first row of the next one is read.
+    for _ in xrange(26):
+      rows.next()
+    rows.close()
+    self.assertEqual(export.done, set([0]))
+
+    calls = self.fake.call_count
+    export = split_query_export.SplitQueryExport(
+        self.connection_factory, KEYSPACE, 'select id, msg from t',
+        split_count=4, checkpoint=checkpoint)
+    self.assertEqual(len(list(export)), 75)
+    # The splits were not computed again.
+    self.assertEqual(self.fake.call_count - calls, 3)
+    self.assertEqual(checkpoint.load()['done'], [0, 1, 2, 3])
+
+
+def _dml_event(table, pks, timestamp=0):
+  return {'Category': 'DML', 'TableName': table, 'PKColNames': ['id'],
+          'PKValues': [[pk] for pk in pks], 'Sql': None,
+          'Timestamp': timestamp, 'GTIDField': None}
+
+
+def _pos_event(gtid):
+  return {'Category': 'POS', 'TableName': None, 'PKColNames': None,
+          'PKValues': None, 'Sql': None, 'Timestamp': 0, 'GTIDField': gtid}
+
+
+class TestUpdateStreamEvents(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.fake = fake_vtgate.start_server()
+    self.fake.update_stream_events = (
+        [_dml_event('t', [i, i + 100]) for i in xrange(10)] +
+        [_pos_event('gtid')])
+
+  def tearDown(self):
+    self.server.stop()
+
+  def read_events(self, compact):
+    conn = update_stream_service.UpdateStreamConnection(
+        self.server.addr, 5.0, compact=compact)
+    conn.dial()
+    events = [conn.stream_start('pos')]
+    while True:
+      batch = conn.stream_next_batch(4)
+      if not batch:
+        break
+      self.assertLessEqual(len(batch), 4)
+      events.extend(batch)
+    conn.close()
+    return events
+
+  def test_compact_events(self):
+    events = self.read_events(False)
+    compact_events = self.read_events(True)
+    self.assertEqual(len(events), 11)
+    event = compact_events[0]
+    self.assertIsInstance(event, update_stream_service.StreamEvent)
+    # The rows are built when first read.
+    self.assertEqual(event._pk_rows, None)
+    self.assertEqual(compact_events, events)
+    self.assertEqual(event['PkRows'], [[('id', 0)], [('id', 100)]])
+    self.assertEqual(event.get('Timestamp'), 0)
+    self.assertEqual(sorted(dict(event)), sorted(events[0]))
+    with self.assertRaises(KeyError):
+      event['PKValues']
+    # The column names are shared.
+    self.assertIs(compact_events[1].PKColNames, event.PKColNames)
+    self.assertEqual(compact_events[-1]['PkRows'], [])
+
+
+class TestUpdateStreamConsumer(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.fake = fake_vtgate.start_server()
+    self.connection_factory = functools.partial(
+        update_stream_service.UpdateStreamConnection, self.server.addr, 5.0,
+        compact=True)
+    self.tmpdir = tempfile.mkdtemp()
+    self.checkpoint = split_query_export.FileCheckpoint(
+        os.path.join(self.tmpdir, 'consumer'))
+    self.lock = threading.Lock()
+    self.batches = []
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+    self.server.stop()
+
+  def apply_batch(self, events):
+    with self.lock:
+      self.batches.append(events)
+
+  def applied(self, key):
+    with self.lock:
+      return [key(event) for batch in self.batches for event in batch]
+
+  def consume(self, done, **kwargs):
+    consumer = update_stream_consumer.UpdateStreamConsumer(
+        self.connection_factory, 'pos', self.apply_batch,
+        checkpoint=self.checkpoint, checkpoint_interval=0,
+        position_append=lambda pos, gtid: gtid, retry_delay=10, **kwargs)
+    consumer.start()
+    deadline = time.time() + 5
+    while not done(consumer) and time.time() < deadline:
+      time.sleep(0.01)
+    consumer.stop()
+    return consumer
+
+  def test_partition_by_table(self):
+    events = []
+    for i in xrange(20):
+      events.append(_dml_event('t{0:d}'.format(i % 3), [i], timestamp=time.time()))
+      events.append(_pos_event('gtid{0:d}'.format(i)))
+    events.append({'Category': 'DDL', 'TableName': None, 'PKColNames': None,
+                   'PKValues': None, 'Sql': 'alter table t0', 'Timestamp': 0,
+                   'GTIDField': None})
+    events.append(_pos_event('gtid_ddl'))
+    self.fake.update_stream_events = events
+    consumer = self.consume(lambda c: c.stats()['Events'] >= 21,
+                            num_workers=3, batch_size=4)
+    self.assertEqual(consumer.stats()['Events'], 21)
+    self.assertEqual(consumer.applied_position, 'gtid_ddl')
+    self.assertEqual(self.checkpoint.load()['position'], 'gtid_ddl')
+    self.assertLess(consumer.lag, 5)
+    # Events of a table are applied in order, the DDL last and alone.
+    for table in ('t0', 't1', 't2'):
+      ids = [pk_rows[0][0][1] for name, pk_rows in self.applied(
+          lambda e: (e['TableName'], e['PkRows'])) if name == table]
+      self.assertEqual(ids, sorted(ids))
+    self.assertEqual(self.batches[-1][0]['Category'], 'DDL')
+    self.assertEqual(len(self.batches[-1]), 1)
+    self.assertTrue(all(len(batch) <= 4 for batch in self.batches))
+
+    # The stream resumes from the checkpoint.
+    self.fake.update_stream_events = []
+    self.consume(lambda c: len(self.fake.update_stream_positions) == 2)
+    self.assertEqual(self.fake.update_stream_positions, ['pos', 'gtid_ddl'])
+
+  def test_partition_by_pk(self):
+    self.fake.update_stream_events = [_dml_event('t', [1, 2, 3]),
+                                      _dml_event('t', [2]),
+                                      _pos_event('gtid1')]
+    consumer = self.consume(lambda c: c.stats()['Events'] >= 4, num_workers=2,
+                            partition_by=update_stream_consumer.PARTITION_BY_PK)
+    pk_rows = self.applied(lambda e: e['PkRows'])
+    # The first event is split in one event per worker.
+    self.assertEqual(sorted(row for rows in pk_rows for row in rows),
+                     [[('id', 1)], [('id', 2)], [('id', 2)], [('id', 3)]])
+    self.assertEqual(consumer.applied_position, 'gtid1')
+
+  def test_multi_row_event_in_small_batches(self):
+    self.fake.update_stream_events = [
+        _dml_event('t', [1, 2, 3]),
+        {'Category': 'DDL', 'TableName': None, 'PKColNames': None,
+         'PKValues': None, 'Sql': 'alter table t', 'Timestamp': 0,
+         'GTIDField': None},
+        _pos_event('gtid1')]
+    self.consume(lambda c: c.stats()['Events'] >= 2, num_workers=1,
+                 batch_size=1,
+                 partition_by=update_stream_consumer.PARTITION_BY_PK)
+    # The rows of the worker stay in one event, so none of them can be
+    # applied after the DDL.
+    self.assertEqual(self.applied(lambda e: e['PkRows']),
+                     [[[('id', 1)], [('id', 2)], [('id', 3)]], []])
+    self.assertEqual(self.batches[-1][0]['Category'], 'DDL')
+
+
+class TestUpdateStreamMultiplexer(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.fake = fake_vtgate.start_server()
+    self.fake.update_stream_events = (
+        [_dml_event('t{0:d}'.format(i % 2), [i], timestamp=time.time())
+         for i in xrange(10)] + [_pos_event('gtid')])
+    self.mux = update_stream_mux.UpdateStreamMultiplexer(
+        functools.partial(update_stream_service.UpdateStreamConnection,
+                          self.server.addr, 5.0, compact=True),
+        'pos', position_append=lambda pos, gtid: gtid, retry_delay=10)
+
+  def tearDown(self):
+    self.mux.stop()
+    self.server.stop()
+
+  def run_mux(self):
+    self.mux.start()
+    deadline = time.time() + 5
+    while self.mux.stats()['Events'] < 11 and time.time() < deadline:
+      time.sleep(0.01)
+    self.mux.stop()
+
+  def read_all(self, subscription):
+    events = []
+    while True:
+      event = subscription.get(timeout=1)
+      if event is None:
+        return events
+      events.append(event)
+
+  def test_fan_out(self):
+    everything = self.mux.subscribe('all', queue_size=100)
+    t1 = self.mux.subscribe('t1', tables=['t1'])
+    self.run_mux()
+    self.assertEqual(self.mux.position, 'gtid')
+    self.assertEqual(len(self.read_all(everything)), 11)
+    events = self.read_all(t1)
+    self.assertEqual([e['PkRows'][0][0][1] for e in events[:-1]],
+                     [1, 3, 5, 7, 9])
+    self.assertEqual(events[-1]['Category'], 'POS')
+    stats = self.mux.stats()['Subscriptions']['t1']
+    self.assertEqual(stats['Delivered'], 6)
+    self.assertEqual(stats['Pending'], 0)
+    self.assertLess(t1.lag, 5)
+    self.assertEqual(len(self.fake.update_stream_positions), 1)
+
+  def test_slow_consumers(self):
+    dropping = self.mux.subscribe('drop', queue_size=3,
+                                  policy=update_stream_mux.POLICY_DROP)
+    spilling = self.mux.subscribe('spill', queue_size=3,
+                                  policy=update_stream_mux.POLICY_SPILL)
+    blocking = self.mux.subscribe('block', queue_size=3)
+    received = []
+    reader = threading.Thread(
+        target=lambda: received.extend(self.read_all(blocking)))
+    reader.start()
+    self.run_mux()
+    reader.join()
+    self.assertEqual(len(received), 11)
+
+    # The first events were dropped, and replaced by a resync.
+    events = self.read_all(dropping)
+    self.assertEqual(events[0]['Category'], update_stream_mux.RESYNC)
+    self.assertEqual(len(events), 1 + 11 - dropping.dropped)
+    self.assertEqual(dropping.resyncs, 3)
+    self.assertEqual(events[-1]['GTIDField'], 'gtid')
+
+    # All the events are received in order, the last ones from disk.
+    events = self.read_all(spilling)
+    self.assertEqual([e['PkRows'] for e in events],
+                     [e['PkRows'] for e in received])
+    self.assertEqual(spilling.spilled, 8)
+    self.assertEqual(spilling.spill, None)
+
+
+class TestLoadDriver(unittest.TestCase):
+
+  def test_run(self):
+    for client in load_driver.CLIENTS:
+      options = optparse.Values({
+          'client': client, 'op': 'execute', 'server': '', 'fork': False,
+          'threads': 2, 'duration': 0, 'requests': 10, 'batch_size': 2,
+          'keyspace': KEYSPACE, 'tablet_type': 'replica', 'timeout': 5.0,
+          'row_count': 1, 'row_size': 10, 'stream_batch_size': 10,
+          'latency': 0.0, 'error_rate': 0.0})
+      stats = load_driver.run(options)
+      self.assertEqual(len(stats.latencies), 20, client)
+      self.assertEqual(stats.errors, 0, client)
+
+
+if __name__ == '__main__':
+  utils.main()
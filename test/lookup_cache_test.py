@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import time
+import unittest
+import utils
+
+from vtdb import lookup_cache
+
+
+class TestLookupCache(unittest.TestCase):
+
+  def test_get_put(self):
+    cache = lookup_cache.LookupCache(capacity=10)
+    self.assertEqual(cache.get(('id', 1)), None)
+    cache.put(('id', 1), 100, cache.generation)
+    self.assertEqual(cache.get(('id', 1)), 100)
+    self.assertEqual(cache.stats()['Hits'], 1)
+    self.assertEqual(cache.stats()['Misses'], 1)
+    self.assertEqual(cache.hit_ratio, 0.5)
+
+  def test_lru_eviction(self):
+    cache = lookup_cache.LookupCache(capacity=2)
+    cache.put(1, 'a', cache.generation)
+    cache.put(2, 'b', cache.generation)
+    # 1 becomes the most recently used entry.
+    cache.get(1)
+    cache.put(3, 'c', cache.generation)
+    self.assertEqual(cache.get(2), None)
+    self.assertEqual(cache.get(1), 'a')
+    self.assertEqual(cache.get(3), 'c')
+    self.assertEqual(cache.evictions, 1)
+    self.assertEqual(cache.keys_by_value, {'a': set([1]), 'c': set([3])})
+
+  def test_ttl(self):
+    cache = lookup_cache.LookupCache(ttl=0.01)
+    cache.put(1, 'a', cache.generation)
+    time.sleep(0.02)
+    self.assertEqual(cache.get(1), None)
+    self.assertEqual(cache.stats()['Size'], 0)
+
+  def test_invalidate_value(self):
+    cache = lookup_cache.LookupCache()
+    cache.put(('song_id', 1), 10, cache.generation)
+    cache.put(('song_id', 2), 10, cache.generation)
+    cache.put(('song_id', 3), 11, cache.generation)
+    cache.invalidate_value(10)
+    self.assertEqual(cache.get(('song_id', 1)), None)
+    self.assertEqual(cache.get(('song_id', 2)), None)
+    self.assertEqual(cache.get(('song_id', 3)), 11)
+    self.assertEqual(cache.invalidations, 2)
+    cache.invalidate(('song_id', 3))
+    self.assertEqual(cache.get(('song_id', 3)), None)
+
+  def test_put_after_invalidation(self):
+    cache = lookup_cache.LookupCache()
+    # a lookup read before the update must not be cached after it.
+    generation = cache.generation
+    cache.invalidate_value(10)
+    cache.put(('song_id', 1), 10, generation)
+    self.assertEqual(cache.get(('song_id', 1)), None)
+    cache.put(('song_id', 1), 12, cache.generation)
+    self.assertEqual(cache.get(('song_id', 1)), 12)
+
+
+if __name__ == '__main__':
+  utils.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import unittest
+import utils
+
+from vtdb import dbapi
+from vtdb import sql_normalizer
+
+
+class TestSQLNormalizer(unittest.TestCase):
+
+  def setUp(self):
+    self.normalizer = sql_normalizer.SQLNormalizer()
+
+  def test_literals(self):
+    sql, bind_vars = self.normalizer.normalize(
+        "select id from t1 where id = 12 and msg = 'it''s 100%%' "
+        "and x = %(x)s", {'x': 3})
+    self.assertEqual(sql, 'select id from t1 where id = %(vtnorm1)s and '
+                     'msg = %(vtnorm2)s and x = %(x)s')
+    self.assertEqual(bind_vars, {'vtnorm1': 12, 'vtnorm2': "it's 100%",
+                                 'x': 3})
+    sql, bind_vars = dbapi.prepare_query_bind_vars(sql, bind_vars)
+    self.assertEqual(sql, 'select id from t1 where id = :vtnorm1 and '
+                     'msg = :vtnorm2 and x = :x')
+
+  def test_inline_literals(self):
+    for sql in [
+        'select id from t order by 1, 2 limit 10, 20',
+        'select cast(a as char(10)), 1.5, 0x1f, 1e3 from `t 1`',
+        "select id from t where d > date '2015-01-01' and s = _utf8'x'",
+        'select id from t /* 42 */ where id = :id',
+        "set names 'utf8'",
+    ]:
+      self.assertEqual(self.normalizer.normalize(sql, {}), (sql, {}))
+    sql, bind_vars = self.normalizer.normalize(
+        'select id from t where id in (1, 2) limit 10 offset 5', None)
+    self.assertEqual(sql, 'select id from t where id in '
+                     '(%(vtnorm1)s, %(vtnorm2)s) limit 10 offset 5')
+    sql, bind_vars = self.normalizer.normalize(
+        "select id from t where a like 'x!%%' escape '!'", {})
+    self.assertEqual(sql, "select id from t where a like %(vtnorm1)s escape '!'")
+    self.assertEqual(bind_vars, {'vtnorm1': 'x!%'})
+    sql, bind_vars = self.normalizer.normalize(
+        'select a, count(*) from t group by 1 having count(*) > 5 limit 5', {})
+    self.assertEqual(sql, 'select a, count(*) from t group by 1 '
+                     'having count(*) > %(vtnorm1)s limit 5')
+
+  def test_colon_style(self):
+    normalizer = sql_normalizer.SQLNormalizer(pyformat=False)
+    sql, bind_vars = normalizer.normalize(
+        "insert into vtnorm1 values (:id, 'a\\nb')", {'id': 1})
+    self.assertEqual(sql, 'insert into vtnorm1 values (:id, :vtnorm_1)')
+    self.assertEqual(bind_vars, {'id': 1, 'vtnorm_1': 'a\nb'})
+
+  def test_cache(self):
+    bind_vars = {}
+    for _ in xrange(3):
+      self.normalizer.normalize('select 1 from t where id = 5', bind_vars)
+    self.assertEqual(bind_vars, {})
+    self.assertEqual(self.normalizer.stats(),
+                     {'Size': 1, 'Hits': 2, 'Misses': 1})
+
+
+if __name__ == '__main__':
+  utils.main()